@@ -1,29 +1,64 @@
 import asyncio
 import aiohttp
-import sqlite3
 import json
-import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
-import time
-import shutil
+import numpy as np
+from books_scheduler import BOOKS_URL, books_scheduler
+from book_distance import METRICS
+from book_metrics import BOOK_METRICS_UPSERT, CREATE_BOOK_METRICS, DEFAULT_TICK, top_of_book
+from book_replay import event_arrays, levels_from_json, replay_state, verify_jobs
+import resources
+
+# one column per side and book_distance metric, e.g. bids_l1
+METRIC_COLUMNS = [f"{side}_{metric}" for side in ("bids", "asks") for metric in METRICS]
+
+INSERT_COLUMNS = [
+    "collector_version", "token_id", "server_time", "initial_book_time", "last_event_time",
+    *METRIC_COLUMNS,
+    "bids_depth_difference", "asks_depth_difference",
+    "book_count", "price_change_count", "last_trade_count",
+    "local_bids", "local_asks", "remote_bids", "remote_asks",
+]
+
 
 class analytics:
-    def __init__(self, verbosity="DEBUG", reset=True, token_id_ref, conn_pool):
-        # sql resources
-        self.__conn_pool = conn_pool
+    def __init__(self, verbosity="DEBUG", reset=True, token_id_ref=None, db_pool=None, http_session=None, workers=0,
+                 chunk_size=5000, depth_ticks=5, late_margin=10_000):
+        # sql resources, an injected pool is used but never closed
+        self.__db_pool = db_pool
+        self.__owns_pool = db_pool is None
         self.__reset = reset
 
-        self.__token_ids = token_id_ref
+        self.__token_ids = token_id_ref if token_id_ref is not None else []
         self.__last_market_row = 0
-        self.__payload = []
+        # token_id -> replay_state, kept between cycles so only new rows are replayed
+        self.__replay_states = {}
+        # token_id -> asyncio.Lock, one replay per token at a time so no chunk of events is folded in twice
+        self.__replay_locks = {}
+        # rows per server-side cursor fetch when streaming events into a replay
+        self.__chunk_size = chunk_size
+        # changes rows are re-read this many row ids behind the last one read, a serial is
+        # assigned at insert but the row only shows up on commit, possibly after higher ones
+        self.__late_margin = late_margin
+        # book_metrics depth counts the levels within this many ticks of the touch
+        self.__depth_ticks = depth_ticks
+
+        # replay and comparison run in this many processes, 0 keeps them on the event loop
+        self.__workers = workers
+        self.__pool = None
 
-    
         # logging
         self.__verbosity = verbosity.upper()
 
-        # markets endpoint
-        self.__books_url = "https://clob.polymarket.com/books"
+        # books endpoint, polled by the scheduler
+        self.__books_url = BOOKS_URL
         self._analytics_cli = None
+        self.__http_session = http_session
+        self.__scheduler = None
+        self.__market_task = None
+        # wait for the collectors to catch up with a fetched book before comparing
         self.__sleep = 2
 
         # liveness
@@ -31,46 +66,83 @@ class analytics:
 
         # version
         self.__version = 1
-    
+
     async def start(self) -> bool:
         if self.__running:
             self.__log("analytics already started", "ERROR")
             return False
         try:
-            
+            if self.__owns_pool:
+                self.__db_pool = await resources.create_resource("pg_pool")
+
             if self.__reset:
                 async with self.__db_pool.acquire() as conn:
                     await conn.execute("""
                     DROP TABLE IF EXISTS analytics;
+                    DROP TABLE IF EXISTS book_metrics;
                 """)
+            metric_columns = ",\n".join(f"                        {column} REAL" for column in METRIC_COLUMNS)
             async with self.__db_pool.acquire() as conn:
-                await conn.execute("""
+                await conn.execute(f"""
                     CREATE TABLE IF NOT EXISTS analytics (
                         row_index SERIAL PRIMARY KEY,
                         collector_version INTEGER,
                         insert_time TIMESTAMP(3) WITH TIME ZONE DEFAULT now(),
-                        token_id (100),
+                        token_id VARCHAR(100),
+                        server_time BIGINT, --ms unix utc timestamp of the remote book
+                        initial_book_time BIGINT,
+                        last_event_time BIGINT,
+{metric_columns},
+                        bids_depth_difference INTEGER,
+                        asks_depth_difference INTEGER,
+                        book_count INTEGER,
+                        price_change_count INTEGER,
+                        last_trade_count INTEGER,
                         local_bids TEXT,
                         local_asks TEXT,
                         remote_bids TEXT,
                         remote_asks TEXT,
-                        remote_time --ms integer unix utc timestamp
-                        last_event_time ^,
-                        ambiguous_end_ms_events,
-                        initial_book_time ^
+                        UNIQUE (token_id, server_time)
                     );
+                    CREATE INDEX IF NOT EXISTS analytics_server_time ON analytics (server_time);
                 """)
+                await conn.execute(CREATE_BOOK_METRICS)
 
         except Exception as e:
             self.__log(f"analytics failed to start: {e}", "ERROR")
+            await self.__clean_up()
             return False
 
-        connector = aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=99999)
-        self._analytics_cli = aiohttp.ClientSession(connector=connector)
+        if self.__http_session is not None:
+            self._analytics_cli = self.__http_session
+        else:
+            connector = aiohttp.TCPConnector(limit_per_host=4, keepalive_timeout=99999)
+            self._analytics_cli = aiohttp.ClientSession(connector=connector)
+
+        if self.__workers > 0:
+            self.__pool = ProcessPoolExecutor(max_workers=self.__workers, mp_context=multiprocessing.get_context("spawn"))
 
+        self.__scheduler = books_scheduler(self._analytics_cli, self.__handle_books, url=self.__books_url, log=self.__log)
         self.__running = True
+        self.__market_task = asyncio.create_task(self.__market_loop(), name="market_loop")
+        tasks = {self.__market_task, self.__scheduler.start()}
         self.__log("analytics started", "INFO")
 
+        # like the collectors, start() only returns once analytics stops
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            await self.__clean_up()
+            raise
+        if not self.__running:
+            return True
+        for task in done:
+            error = None if task.cancelled() else task.exception()
+            self.__log(f"analytics {task.get_name()} stopped unexpectedly: {error!r}", "ERROR")
+        self.__log("analytics aborted", "ERROR")
+        await self.__clean_up()
+        return False
+
 
     async def stop(self)->bool:
         await self.__clean_up()
@@ -79,21 +151,31 @@ class analytics:
 
     async def __clean_up(self):
         self.__log("analytics cleanup started", "DEBUG")
-        if self._analytics_cli is not None:
+        self.__running = False
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
+        if self.__market_task is not None:
+            self.__market_task.cancel()
+            await asyncio.gather(self.__market_task, return_exceptions=True)
+            self.__market_task = None
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+        if self._analytics_cli is not None and self._analytics_cli is not self.__http_session:
             try:
                 await self._analytics_cli.close()
                 self.__log("analytics closed aiohttp client", "DEBUG")
             except Exception as e:
                 self.__log(f"analytics error closing aiohttp client: {e}", "ERROR")
-            self._analytics_cli = None
+        self._analytics_cli = None
 
-        if self.__db_conn is not None:
+        if self.__db_pool is not None and self.__owns_pool:
             try:
-                await self.__db_conn.close()
-                self.__log("analytics closed DB connection", "DEBUG")
+                await resources.close_resource("pg_pool", self.__db_pool)
+                self.__log("analytics closed DB pool", "DEBUG")
             except Exception as e:
-                self.__log(f"analytics error closing DB connection: {e}", "ERROR")
-            self.__db_conn = None
+                self.__log(f"analytics error closing DB pool: {e}", "ERROR")
+            self.__db_pool = None
 
         self.__running = False
         self.__log("analytics cleanup finished", "INFO")
@@ -116,108 +198,38 @@ class analytics:
         try:
             async with self.__db_pool.acquire() as conn:
                 new_token_pairs = await conn.fetch(
-                    "SELECT token_id1, token_id2 FROM markets WHERE row_index > $1",
+                    "SELECT row_index, token_id1, token_id2 FROM markets WHERE row_index > $1 ORDER BY row_index",
                     self.__last_market_row
                 )
-
-            new_token_count = len(new_token_pairs)
-            self.__last_market_row += new_token_count
-
-            for tok1, tok2 in new_token_pairs:
-                self.__token_ids.extend([tok1, tok2])
-
-            if new_token_count > 0:
-                self.__log(f"event_collector found {new_token_count} new token pairs from markets db, now subscribing to {min(len(self.__token_ids), self.__max_subscriptions)}", "INFO")
-                # Trigger resubscribe immediately
-                if self.__events_cli is None or self.__events_cli.closed:
-                    return True
-                await self.__resubscribe()
-            return True
-
         except Exception as e:
-            self.__log(f"event_collector failed to query markets: {e}", "ERROR")
-            return False
-
-
-    async def __query_markets(self)->bool:
-        cursor = self.__markets_db.cursor()
-        cursor.execute(f"""
-            SELECT clobTokenIds1, clobTokenIds2 FROM markets WHERE row_index > {self.__last_market_row}
-        """)
-        new_token_pairs = cursor.fetchall()
-        new_token_count = len(new_token_pairs)
-        self.__last_market_row += new_token_count
-
-        self.__log(f"analytics found {new_token_pairs} pairs from markets db", "INFO")
-
-        for [tok1, tok2] in new_token_pairs:
-            self.__payload.append({"token_id":tok1})
-            self.__payload.append({"token_id":tok2})
-            self.__token_ids.append(tok1)
-            self.__token_ids.append(tok2)
-
-        if new_token_count > 0 and not self.__create_tables(new_token_pairs):
-            self.__log(f"analytics failed to create tables", "ERROR")
+            self.__log(f"analytics failed to query markets: {e}", "ERROR")
             return False
 
-        debug_payload = self.__payload[:300]
-        try:
-            self.__log(f"Sending request to {self.__books_url} with {json.dumps(debug_payload)}")
-            resp = await self._analytics_cli.post(self.__books_url, json=debug_payload)
-            if resp.status != 200:
-                self.__log(f"analytics fetch failed: {resp.status}", "ERROR")
-                await resp.release()
-                return False
-            books = await resp.json()
-            resp.release()
-        except aiohttp.ClientError as e:
-            self.__log(f"analytics HTTP request failed: {e}", "ERROR")
-            return False
+        if not new_token_pairs:
+            return True
+        self.__last_market_row = new_token_pairs[-1]["row_index"]
+
+        new_tokens = []
+        for _, tok1, tok2 in new_token_pairs:
+            new_tokens.extend(tok for tok in (tok1, tok2) if tok)
+        self.__token_ids.extend(new_tokens)
+        self.__scheduler.add_tokens(new_tokens)
+        self.__log(f"analytics found {len(new_token_pairs)} new token pairs from markets db, now verifying {len(self.__token_ids)} tokens", "INFO")
+        return True
 
-        self.__log(f"analytics fetch succeeded going to sleep for {self.__sleep} before doing analytics", "INFO")
+    async def __handle_books(self, books):
+        self.__log(f"analytics fetch succeeded going to sleep for {self.__sleep} before doing analytics", "DEBUG")
         await asyncio.sleep(self.__sleep)
 
-        if not self.__process_response(books):
+        if not await self.__process_response(books):
             self.__log(f"analytics failed to process response for {json.dumps(books)}", "ERROR")
-            return False
-        return True
 
-    def __create_tables(self, token_pair_list)->bool:
-        buffer = []
-        for toks in token_pair_list:
-            if len(toks) != 2:
-                self.__log(f"event collector create tables found {len(toks)} token ids for a market")
-            for tok in toks:
-                buffer.append(f"""CREATE TABLE IF NOT EXISTS analytics_{tok} 
-                    (row_index INTEGER PRIMARY KEY AUTOINCREMENT,
-                    insert_time TEXT,
-                    bids_depth_difference INTEGER,
-                    asks_depth_difference INTEGER,
-                    ordered_bids_distance REAL,
-                    ordered_asks_distance REAL,
-                    local_bids TEXT,
-                    local_asks TEXT,
-                    fetched_bids TEXT,
-                    fetched_asks TEXT,
-                    last_event_type TEXT,
-                    last_event_time INTEGER,
-                    book_event_count INTEGER,
-                    price_change_count INTEGER,
-                    last_trade_count INTEGER,
-                    server_time INTEGER);""")
-        create_table_stmt = "".join(buffer)
-        try:
-            cursor = self.__analytics_db.cursor()
-            cursor.executescript(create_table_stmt)
-            self.__analytics_db.commit()
-            self.__log(f"analytics created new tables succesfully", "DEBUG")
-            return True
-        except Exception as e:
-            self.__log(f"analytics failed to create new tables for {create_table_stmt}", "DEBUG")
-            return False
+    async def __process_response(self, books):
+        """Compare every fetched book with the local replay and insert all results in one batch.
 
-    def __process_response(self, books):
-        """Process order books, compute distances, and insert analytics with detailed logging."""
+        Reading the events and advancing the replay cursors stays on the event
+        loop; the replays themselves are split into one shard per worker.
+        """
         if not isinstance(books, list):
             if not isinstance(books, dict):
                 self.__log(f"analytics invalid books input: {books}", "ERROR")
@@ -228,66 +240,84 @@ class analytics:
             self.__log("analytics empty books array", "WARNING")
             return False
 
-        cursor = self.__analytics_db.cursor()
         success = True
-
+        jobs = []
+        meta = []
         try:
-            for book in books:
-                try:
-                    tok = book["asset_id"]
-                    time_stm = int(book["timestamp"])
-                    bids = {float(x["price"]): float(x["size"]) for x in book["bids"]}
-                    asks = {float(x["price"]): float(x["size"]) for x in book["asks"]}
-                except Exception as e:
-                    self.__log(f"analytics invalid book: {e} | {json.dumps(book)}", "ERROR")
-                    success = False
-                    continue
-
-                # Debug
-                self.__log(f"Processing book for token {tok}: {json.dumps(book)}", "DEBUG")
-
-                try:
-                    bids_dist, loc_bids, asks_dist, loc_asks = self.__create_loc_book(bids, asks, tok, time_stm)
-                except Exception as e:
-                    self.__log(f"analytics failed to create local book for token {tok}: {e}", "ERROR")
-                    success = False
-                    continue
-
-                # depth diffs
-                bids_diff = abs(len(loc_bids) - len(bids))
-                asks_diff = abs(len(loc_asks) - len(asks))
-                now_iso = datetime.now(timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z")
-
-                # --- NEW: event stats ---
-                last_event_time, book_count, pc_count, lt_count = self.__get_event_stats(tok)
-
-                insert_sql = f"""
-                    INSERT INTO analytics_{tok} (
-                        insert_time, bids_depth_difference, asks_depth_difference,
-                        ordered_bids_distance, ordered_asks_distance,
-                        local_bids, local_asks, fetched_bids, fetched_asks,
-                        last_event_time, book_event_count, price_change_count, last_trade_count,
-                        server_time
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                params = (
-                    now_iso, bids_diff, asks_diff,
-                    bids_dist, asks_dist,
-                    json.dumps(loc_bids), json.dumps(loc_asks),
-                    json.dumps(bids), json.dumps(asks),
-                    last_event_time, book_count, pc_count, lt_count,
-                    time_stm
-                )
+            async with self.__db_pool.acquire() as conn:
+                for book in books:
+                    try:
+                        tok = book["asset_id"]
+                        time_stm = int(book["timestamp"])
+                        bids = {float(x["price"]): float(x["size"]) for x in book["bids"]}
+                        asks = {float(x["price"]): float(x["size"]) for x in book["asks"]}
+                        tick = float(book.get("tick_size") or DEFAULT_TICK)
+                    except Exception as e:
+                        self.__log(f"analytics invalid book: {e} | {json.dumps(book)}", "ERROR")
+                        success = False
+                        continue
+
+                    # Debug
+                    self.__log(f"Processing book for token {tok}: {json.dumps(book)}", "DEBUG")
+
+                    try:
+                        async with self.__replay_locks.setdefault(tok, asyncio.Lock()):
+                            job = await self.__prepare_job(conn, bids, asks, tok, time_stm)
+                            state = self.__replay_states[tok]
+                            book_time, last_event_time = state.book_time, state.last_event_time
+                        book_count, pc_count, lt_count = await self.__get_event_stats(conn, tok)
+                    except Exception as e:
+                        self.__log(f"analytics failed to create local book for token {tok}: {e}", "ERROR")
+                        success = False
+                        continue
+
+                    jobs.append(job)
+                    meta.append((time_stm, book_time, last_event_time, len(bids), len(asks),
+                                 book_count, pc_count, lt_count, json.dumps(bids), json.dumps(asks),
+                                 top_of_book(bids, asks, tick, self.__depth_ticks)))
 
-                try:
-                    cursor.execute(insert_sql, params)
-                except Exception as e:
-                    self.__log(f"analytics failed to insert book for token {tok}: {e}", "ERROR")
-                    success = False
+            try:
+                results = await self.__verify(jobs)
+            except Exception as e:
+                self.__log(f"analytics failed to verify {len(jobs)} books: {e}", "ERROR")
+                return False
 
-            # --- one commit for all inserts ---
-            self.__analytics_db.commit()
-            self.__log("Committed all inserts to analytics DB", "DEBUG")
+            rows = []
+            metric_rows = []
+            for result, (time_stm, book_time, last_event_time, n_bids, n_asks,
+                         book_count, pc_count, lt_count, remote_bids, remote_asks, top) in zip(results, meta):
+                tok = result["token_id"]
+                bids_metrics, asks_metrics = result["bids_metrics"], result["asks_metrics"]
+                self.__log(f"Final min distance for {tok}: bids={bids_metrics}, asks={asks_metrics}, last_event_time={last_event_time}", "DEBUG")
+                discrepancy = bids_metrics["l1"] + asks_metrics["l1"]
+                # tokens that drifted are verified again before the rotation comes back to them
+                self.__scheduler.report(tok, mismatch=discrepancy)
+                metric_rows.append((
+                    tok, time_stm, top["best_bid"], top["best_ask"], top["spread"], top["mid"],
+                    top["bid_depth"], top["ask_depth"], top["bid_depth"] + top["ask_depth"], top["asymmetry"],
+                    discrepancy,
+                ))
+                rows.append((
+                    self.__version, tok, time_stm, book_time, last_event_time,
+                    *(bids_metrics[metric] for metric in METRICS),
+                    *(asks_metrics[metric] for metric in METRICS),
+                    abs(result["bids_depth"] - n_bids), abs(result["asks_depth"] - n_asks),
+                    book_count, pc_count, lt_count,
+                    result["local_bids"], result["local_asks"], remote_bids, remote_asks,
+                ))
+
+            if rows:
+                placeholders = ", ".join(f"${i + 1}" for i in range(len(INSERT_COLUMNS)))
+                # a book polled twice in the same millisecond is only stored once
+                async with self.__db_pool.acquire() as conn, conn.transaction():
+                    await conn.executemany(
+                        f"""INSERT INTO analytics ({", ".join(INSERT_COLUMNS)}) VALUES ({placeholders})
+                        ON CONFLICT (token_id, server_time) DO NOTHING""",
+                        rows
+                    )
+                    # current book properties per token, so queries on them never replay events
+                    await conn.executemany(BOOK_METRICS_UPSERT, metric_rows)
+                self.__log(f"analytics inserted {len(rows)} results", "DEBUG")
 
         except Exception as e:
             self.__log(f"analytics critical error in process_response: {e}", "ERROR")
@@ -295,137 +325,151 @@ class analytics:
 
         return success
 
+    async def __verify(self, jobs) -> list:
+        if self.__pool is None or len(jobs) < 2:
+            return verify_jobs(jobs)
+        # contiguous shards, so results come back in job order
+        n_shards = min(self.__workers, len(jobs))
+        bounds = [len(jobs) * i // n_shards for i in range(n_shards + 1)]
+        loop = asyncio.get_running_loop()
+        shards = await asyncio.gather(*(
+            loop.run_in_executor(self.__pool, verify_jobs, jobs[lo:hi]) for lo, hi in zip(bounds, bounds[1:])
+        ))
+        return [result for shard in shards for result in shard]
+
+    async def __get_event_stats(self, conn, tok: str):
+        """Event counts of one token, kept up to date by event_collector in token_stats."""
+        row = await conn.fetchrow(
+            "SELECT book_count, price_change_count, last_trade_count FROM token_stats WHERE token_id = $1",
+            tok
+        )
+        if row is None:
+            return 0, 0, 0
+        return row["book_count"], row["price_change_count"], row["last_trade_count"]
 
-    def __get_event_stats(self, tok: str):
-        """Helper to fetch last_event_time and row counts for one token."""
-        cursor = self.__events_db.cursor()
-        try:
-            cursor.execute(f"SELECT MAX(server_time) FROM book_{tok}")
-            book_time = cursor.fetchone()[0] or 0
-
-            cursor.execute(f"SELECT MAX(server_time) FROM price_change_{tok}")
-            pc_time = cursor.fetchone()[0] or 0
-
-            cursor.execute(f"SELECT MAX(server_time) FROM last_trade_price_{tok}")
-            lt_time = cursor.fetchone()[0] or 0
-
-            cursor.execute(f"SELECT MAX(server_time) FROM tick_size_change_{tok}")
-            ts_time = cursor.fetchone()[0] or 0
-
-            last_event_time = max(book_time, pc_time, lt_time, ts_time)
-
-            cursor.execute(f"SELECT COUNT(*) FROM book_{tok}")
-            book_count = cursor.fetchone()[0]
-
-            cursor.execute(f"SELECT COUNT(*) FROM price_change_{tok}")
-            pc_count = cursor.fetchone()[0]
-
-            cursor.execute(f"SELECT COUNT(*) FROM last_trade_price_{tok}")
-            lt_count = cursor.fetchone()[0]
-
-            return last_event_time, book_count, pc_count, lt_count
-        except Exception as e:
-            self.__log(f"analytics failed to get event stats for {tok}: {e}", "ERROR")
-            return 0, 0, 0, 0
-
-
+    async def __prepare_job(self, conn, bids: dict, asks: dict, tok: str, time_stm: int) -> tuple:
+        end_ms_lb = time_stm - 10
+        end_ms_ub = end_ms_lb + 10
 
-    def __create_loc_book(self, bids: dict, asks: dict, tok: str, time_stm: int):
         try:
-            cursor = self.__events_db.cursor()
-            cursor.execute(f"SELECT * FROM book_{tok} ORDER BY insert_time DESC LIMIT 1")
-            newest_book = cursor.fetchone()
-            cursor.execute(f"SELECT * FROM tick_size_change_{tok} ORDER BY insert_time DESC LIMIT 1")
-            newest_tsc = cursor.fetchone()
+            newest_book = await conn.fetchrow(
+                """SELECT bids, asks, server_time FROM books WHERE token_id = $1
+                ORDER BY server_time DESC, row_index DESC LIMIT 1""",
+                tok
+            )
+            newest_tsc = await conn.fetchval("SELECT MAX(server_time) FROM tick_changes WHERE token_id = $1", tok)
         except Exception as e:
             self.__log(f"analytics failed to fetch newest book for {tok}: {e}", "ERROR")
             raise
 
-
+        book_time = newest_book["server_time"] if newest_book else 0
+        state = self.__replay_states.get(tok)
+        if state is None or state.book_time != book_time:
+            state = self.__new_replay_state(tok, newest_book)
+        elif state.cursor_time > max(end_ms_lb, state.book_time):
+            # the window starts before events that were already folded in
+            self.__log(f"analytics window for {tok} is behind the replay cursor, rebuilding", "DEBUG")
+            state = self.__new_replay_state(tok, newest_book)
+
+        window = await self.__stream_events(conn, tok, state, end_ms_lb, end_ms_ub)
+        if window is None:
+            # rows were inserted behind the cursor after it moved past them
+            self.__log(f"analytics late events for {tok} behind the replay cursor, rebuilding", "WARNING")
+            state = self.__new_replay_state(tok, newest_book)
+            window = await self.__stream_events(conn, tok, state, end_ms_lb, end_ms_ub)
+
+        state.last_event_time = max(state.last_event_time, newest_tsc or 0)
+        self.__replay_states[tok] = state
+
+        # the replay may run after later books of this token already moved the state on
+        return (tok, dict(state.bids), dict(state.asks), window, bids, asks, end_ms_lb, end_ms_ub)
+
+    def __new_replay_state(self, tok: str, newest_book) -> replay_state:
         if newest_book:
-            loc_bids = json.loads(newest_book[3])
-            loc_asks = json.loads(newest_book[4])
-            book_time = newest_book[5]
+            state = replay_state(newest_book["server_time"], levels_from_json(newest_book["bids"]),
+                                 levels_from_json(newest_book["asks"]))
         else:
-            loc_bids, loc_asks, book_time = {}, {}, 0
-
+            state = replay_state(0, {}, {})
         self.__log(
-            f"Newest local book for {tok}: bids={json.dumps(loc_bids)}, asks={json.dumps(loc_asks)}, book_time={book_time}",
+            f"Newest local book for {tok}: bids={json.dumps(state.bids)}, asks={json.dumps(state.asks)}, book_time={state.book_time}",
             "DEBUG"
         )
-
+        return state
+
+    async def __stream_events(self, conn, tok: str, state: replay_state, lb: int, ub: int):
+        """Fold changes rows before lb into the state and return the events in [lb, ub].
+
+        Rows at or after the replay cursor, plus any row less than late_margin
+        ids behind the last one read, are read through a server-side cursor in chunks of
+        chunk_size, so memory stays bounded however many events a token has
+        piled up since its last snapshot. Rows after ub cannot change the
+        comparison and are left for the next cycle. Returns None when a row
+        arrived behind the cursor; the state is then partly applied and the
+        caller has to rebuild it.
+        """
+        last_row = state.last_rows.get("changes")
+        start_cursor = state.cursor_time
+        window = []
+        folded = set()
+        n_events = 0
         try:
-            cursor.execute(f"SELECT * FROM price_change_{tok} WHERE server_time >= ? ORDER BY server_time ASC", (book_time,))
-            price_changes = cursor.fetchall()
-            cursor.execute(f"SELECT * FROM last_trade_price_{tok} WHERE server_time >= ? ORDER BY server_time ASC", (book_time,))
-            last_trades = cursor.fetchall()
+            async with conn.transaction(readonly=True):
+                if last_row is None:
+                    # nothing read yet, every later row is new
+                    last_row = await conn.fetchval("SELECT COALESCE(MAX(row_index), 0) FROM changes")
+                    cursor = await conn.cursor(
+                        """SELECT row_index, event_type, price, size, side, server_time FROM changes
+                        WHERE token_id = $1 AND server_time >= $2 AND server_time <= $3
+                        ORDER BY server_time, row_index""",
+                        tok, start_cursor, ub
+                    )
+                else:
+                    cursor = await conn.cursor(
+                        """SELECT row_index, event_type, price, size, side, server_time FROM changes
+                        WHERE token_id = $1 AND server_time <= $3 AND (server_time >= $2 OR row_index > $4)
+                        ORDER BY server_time, row_index""",
+                        tok, start_cursor, ub, last_row - self.__late_margin
+                    )
+
+                while True:
+                    rows = await cursor.fetch(self.__chunk_size)
+                    if not rows:
+                        break
+                    last_row = max(last_row, max(r["row_index"] for r in rows))
+                    # rows behind the cursor that were folded in on an earlier cycle are only read for the overlap
+                    rows = [r for r in rows if r["server_time"] >= start_cursor or r["row_index"] not in state.recent_rows]
+                    folded.update(r["row_index"] for r in rows if r["server_time"] < lb)
+                    events = self.__to_events(tok, rows)
+                    # ordered by server time, so late rows come first
+                    if (events.time < start_cursor).any():
+                        return None
+                    if len(events):
+                        state.last_event_time = max(state.last_event_time, int(events.time[-1]))
+                    n_events += len(events)
+                    # everything before the window is final, fold it in and only replay the rest
+                    settled = events.time < lb
+                    state.apply(events.take(settled), state.cursor_time)
+                    window.append(events.take(~settled))
         except Exception as e:
             self.__log(f"analytics failed to fetch price changes/trades for {tok}: {e}", "ERROR")
             raise
 
-        # grab newest rows (if any exist)
-        newest_pc = price_changes[-1] if price_changes else None
-        newest_lt = last_trades[-1] if last_trades else None
-
-        # --- FIX: safe max of timestamps ---
-        last_event_time = max(
-            newest_book[5] if newest_book else 0,
-            newest_tsc[5] if newest_tsc else 0,
-            newest_pc[8] if newest_pc else 0,  # price_change.server_time
-            newest_lt[7] if newest_lt else 0,  # last_trade_price.server_time
-        )
-
-        end_ms_lb = time_stm - 10
-        end_ms_ub = end_ms_lb + 10
-
-        critical_asks_interval = []
-        critical_bids_interval = []
-
-        ordered_bids = sorted(bids.items(), key=lambda x: x[0], reverse=True)
-        ordered_asks = sorted(asks.items(), key=lambda x: x[0])
-
-        combined = [("price_change", r) for r in price_changes] + [("last_trade", r) for r in last_trades]
-        combined.sort(key=lambda x: x[1][-1])  # sort by server_time col
-
-        for event_type, row in combined:
-            if event_type == "price_change":
-                side, price, size, time_ = row[5], row[3], row[4], row[8]
-                if side == "BUY":
-                    loc_bids[price] = loc_bids.get(price, 0) + size
-                elif side == "SELL":
-                    loc_asks[price] = loc_asks.get(price, 0) + size
-                else:
-                    self.__log(f"analytics invalid side {side} in price_change for {tok}", "ERROR")
-                    raise ValueError(f"Invalid side: {side}")
-            else:  # last_trade
-                side, price, size, time_ = row[5], row[4], row[6], row[7]
-                if side == "BUY":
-                    loc_bids[price] = loc_bids.get(price, 0) - size
-                elif side == "SELL":
-                    loc_asks[price] = loc_asks.get(price, 0) - size
-                else:
-                    self.__log(f"analytics invalid side {side} in last_trade for {tok}", "ERROR")
-                    raise ValueError(f"Invalid side: {side}")
-
-            self.__log(f"{event_type} update for {tok} at time {time_}: bids={json.dumps(loc_bids)}, asks={json.dumps(loc_asks)}", "DEBUG")
-
-            if end_ms_lb <= time_ <= end_ms_ub:
-                critical_bids_interval.append([self.__distance(loc_bids, ordered_bids, reverse=True), loc_bids.copy()])
-                critical_asks_interval.append([self.__distance(loc_asks, ordered_asks, reverse=False), loc_asks.copy()])
-            elif time_ > end_ms_ub:
-                break
-
-        min_bids_dist = min(critical_bids_interval, key=lambda x: x[0], default=[0, {}])
-        min_asks_dist = min(critical_asks_interval, key=lambda x: x[0], default=[0, {}])
-
-        self.__log(f"Final min distance for {tok}: bids={min_bids_dist}, asks={min_asks_dist}, last_event_time={last_event_time}", "DEBUG")
-        return [min_bids_dist[0], min_bids_dist[1], min_asks_dist[0], min_asks_dist[1]]
-
-
-    def __distance(self, local, ordered, reverse=True):
-        """Compute a simplistic distance metric for book orders."""
-        dist = 0.0
-        for idx, (price, size) in enumerate(ordered):
-            local_size = local.get(price, 0)
-            dist += abs(local_size - size)
-        return dist
+        state.cursor_time = max(state.cursor_time, lb)
+        state.last_rows["changes"] = last_row
+        horizon = last_row - self.__late_margin
+        state.recent_rows = {i for i in state.recent_rows | folded if i > horizon}
+        self.__scheduler.report(tok, activity=n_events)
+        return event_arrays.merge(*window)
+
+    def __to_events(self, tok: str, rows) -> event_arrays:
+        # price_change rows add to a level, last_trade_price rows take from it;
+        # rows on the same server_time are applied in insert order
+        rows = [r for r in rows if r["event_type"] in ("price_change", "last_trade_price")]
+        sign = np.array([1.0 if r["event_type"] == "price_change" else -1.0 for r in rows])
+        try:
+            return event_arrays.from_columns(
+                [r["server_time"] for r in rows], [r["side"] for r in rows],
+                [r["price"] for r in rows], [r["size"] for r in rows], sign)
+        except ValueError as e:
+            self.__log(f"analytics invalid event for {tok}: {e}", "ERROR")
+            raise
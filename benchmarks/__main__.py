@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+
+from benchmarks.suite import (bench_analytics, bench_distance, bench_insert, bench_replay, final_books,
+                              null_pool, peak_memory)
+from benchmarks.workload import workload
+
+BENCHES = ("replay", "distance", "insert", "analytics")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def max_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(opts) -> dict:
+    wl = workload(tokens=opts.tokens, levels=opts.levels, events=opts.events, zipf=opts.zipf,
+                  burst=opts.burst, trade_ratio=opts.trade_ratio, seed=opts.seed)
+    start = time.perf_counter()
+    messages = list(wl.messages())
+    events = wl.token_events(messages)
+    remote = final_books(wl, events)
+    print(f"[bench] generated {len(messages)} messages for {opts.tokens} tokens in {time.perf_counter() - start:.2f}s")
+
+    pool = None
+    if opts.pg:
+        from resources import create_resource
+        pool = await create_resource("pg_pool")
+
+    results = {}
+    try:
+        for name in opts.bench:
+            if name == "replay":
+                rec = bench_replay(wl, events, remote)
+                result = rec.result()
+                if opts.memory:
+                    result["peak_mb"] = peak_memory(bench_replay, wl, events, remote)
+            elif name == "distance":
+                rec = bench_distance(wl, remote)
+                result = rec.result()
+                if opts.memory:
+                    result["peak_mb"] = peak_memory(bench_distance, wl, remote)
+            elif name == "insert":
+                rec = await bench_insert(wl, wl.book_messages() + messages, pool or null_pool())
+                result = dict(rec.result(), pool="postgres" if pool else "null")
+            elif name == "analytics":
+                if pool is None:
+                    print("[bench] analytics needs --pg and a database filled by the insert bench, skipped")
+                    continue
+                result = (await bench_analytics(wl, remote, pool)).result()
+            result["max_rss_mb"] = max_rss_mb()
+            results[name] = result
+            print(f"[bench] {name}: {result['events_per_s']:.0f} events/s, "
+                  f"p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    finally:
+        if pool is not None:
+            await pool.close()
+
+    return {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workload": wl.params(),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="book replay, distance and insert benchmarks on a synthetic workload")
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--levels", type=int, default=50, help="levels per side in each snapshot")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the per-token activity distribution")
+    parser.add_argument("--burst", type=int, default=5, help="mean price changes per price_change message")
+    parser.add_argument("--trade-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bench", nargs="+", choices=BENCHES, default=["replay", "distance", "insert"])
+    parser.add_argument("--pg", action="store_true",
+                        help="insert into the Postgres configured by PG_* instead of a null pool; "
+                             "the tables must exist, start event_collector once to create them")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the traced second pass that measures peak allocation")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    opts = parser.parse_args()
+
+    report = asyncio.run(run(opts))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[bench] results written to {opts.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import contextlib
+import time
+import tracemalloc
+
+import numpy as np
+
+from book_distance import ASK, BID, compare_batch
+from book_replay import replay_state, verify_jobs
+
+
+class recorder:
+    """Per-operation latencies plus the number of events each operation covered."""
+
+    def __init__(self):
+        self.latencies = []
+        self.events = 0
+        self.__wall = 0.0
+
+    @contextlib.contextmanager
+    def op(self, events=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.latencies.append(elapsed)
+            self.__wall += elapsed
+            self.events += events
+
+    def result(self) -> dict:
+        latencies = np.array(self.latencies) * 1000
+        seconds = self.__wall
+        return {
+            "ops": len(latencies),
+            "events": self.events,
+            "seconds": seconds,
+            "ops_per_s": len(latencies) / seconds if seconds else None,
+            "events_per_s": self.events / seconds if seconds else None,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+
+def peak_memory(fn, *args):
+    """Peak traced Python allocation of one more run of fn, in MiB."""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def final_books(wl, events) -> dict:
+    """token -> (bids, asks) after every event, used as the 'remote' book."""
+    books = {}
+    for i, tok in enumerate(wl.tokens):
+        state = replay_state(0, *wl.snapshot(i))
+        if tok in events:
+            state.apply(events[tok], np.iinfo(np.int64).max)
+        books[tok] = (state.bids, state.asks)
+    return books
+
+
+def bench_replay(wl, events, remote, window=0.1):
+    """What analytics does per fetched book: fold settled events into the state, replay the window.
+
+    The last `window` share of a token's events is replayed and compared
+    against the remote book, everything before it is applied to the state.
+    """
+    rec = recorder()
+    for i, tok in enumerate(wl.tokens):
+        token_events = events.get(tok)
+        if token_events is None:
+            continue
+        split = int(len(token_events) * (1 - window))
+        lb = int(token_events.time[split]) if split < len(token_events) else int(token_events.time[-1]) + 1
+        ub = int(token_events.time[-1])
+        remote_bids, remote_asks = remote[tok]
+        with rec.op(len(token_events)):
+            state = replay_state(0, *wl.snapshot(i))
+            settled = token_events.time < lb
+            state.apply(token_events.take(settled), lb)
+            verify_jobs([(tok, state.bids, state.asks, token_events.take(~settled), remote_bids, remote_asks, lb, ub)])
+    return rec
+
+
+def bench_distance(wl, remote, batch=300, noise=0.05, seed=0):
+    """compare_batch over /books-sized batches of (local, slightly perturbed remote) pairs."""
+    rng = np.random.default_rng(seed)
+    pairs = {BID: [], ASK: []}
+    for i, tok in enumerate(wl.tokens):
+        for side, local in zip((BID, ASK), remote[tok]):
+            scale = 1 + rng.normal(0, noise, len(local))
+            pairs[side].append((local, {p: s * f for (p, s), f in zip(local.items(), scale)}))
+
+    rec = recorder()
+    for lo in range(0, len(wl.tokens), batch):
+        with rec.op(2 * min(batch, len(wl.tokens) - lo)):
+            for side in (BID, ASK):
+                compare_batch(pairs[side][lo:lo + batch], side)
+    return rec
+
+
+class null_pool:
+    """Takes the place of an asyncpg pool so the insert path is timed without a database."""
+
+    class connection:
+        async def execute(self, *args):
+            return None
+
+        async def executemany(self, *args):
+            return None
+
+        def transaction(self):
+            return contextlib.nullcontext()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield null_pool.connection()
+
+
+async def bench_insert(wl, messages, pool):
+    """event_collector's per-message insert, including the token_stats upsert."""
+    from event_collector import event_collector
+    collector = event_collector(verbosity="ERROR", reset=False, db_pool=pool)
+    insert = collector._event_collector__insert
+    rec = recorder()
+    for msg in messages:
+        n = len(msg["price_changes"]) if msg["event_type"] == "price_change" else 1
+        with rec.op(n):
+            await insert(msg)
+    return rec
+
+
+async def bench_analytics(wl, remote, pool, batch=300):
+    """analytics end to end on a populated database: read events, replay, compare, insert."""
+    from analytics import analytics
+    an = analytics(verbosity="ERROR", reset=False, conn_pool=pool)
+    # start() creates the results table and the scheduler the replay reports to
+    await an.start()
+    await an.stop()
+    process = an._analytics__process_response
+
+    now = str(int(time.time() * 1000))
+    books = [
+        {"asset_id": tok, "timestamp": now,
+         "bids": [{"price": str(p), "size": str(s)} for p, s in remote[tok][0].items()],
+         "asks": [{"price": str(p), "size": str(s)} for p, s in remote[tok][1].items()]}
+        for tok in wl.tokens
+    ]
+    rec = recorder()
+    for lo in range(0, len(books), batch):
+        chunk = books[lo:lo + batch]
+        with rec.op(len(chunk)):
+            await process(chunk)
+    return rec
@@ -0,0 +1,128 @@
+import numpy as np
+
+from book_replay import event_arrays
+
+
+def zipf_weights(n, s=1.1):
+    """Activity share per token rank, the first tokens take most of the events."""
+    weights = 1.0 / np.arange(1, n + 1) ** s
+    return weights / weights.sum()
+
+
+class workload:
+    """Synthetic market data shaped like the Polymarket CLOB websocket feed.
+
+    Every token starts with a book snapshot of `levels` levels per side
+    around a random mid. After that, messages are either price_change bursts
+    (burst changes close to the touch on one token, sharing a timestamp) or
+    last_trade_price events, with tokens drawn from a Zipf distribution.
+    The same seed always produces the same stream.
+    """
+
+    def __init__(self, tokens=1000, levels=50, events=100000, zipf=1.1, burst=5, trade_ratio=0.1,
+                 tick=0.01, start_ms=1_700_000_000_000, seed=0):
+        self.n_tokens = tokens
+        self.levels = levels
+        self.n_events = events
+        self.zipf = zipf
+        self.burst = burst
+        self.trade_ratio = trade_ratio
+        self.tick = tick
+        self.start_ms = start_ms
+        self.seed = seed
+
+        self.tokens = [f"{10**20 + i}" for i in range(tokens)]
+        self.markets = [f"0x{i // 2:064x}" for i in range(tokens)]
+
+        rng = np.random.default_rng(seed)
+        # mids on the tick grid, far enough from 0 and 1 for `levels` levels per side
+        lo = levels + 1
+        hi = int(round(1 / tick)) - levels - 1
+        self.__mids = rng.integers(lo, max(hi, lo + 1), tokens)
+        self.__rng = rng
+
+    def params(self) -> dict:
+        return {
+            "tokens": self.n_tokens, "levels": self.levels, "events": self.n_events, "zipf": self.zipf,
+            "burst": self.burst, "trade_ratio": self.trade_ratio, "tick": self.tick, "seed": self.seed,
+        }
+
+    def price(self, ticks) -> float:
+        return round(int(ticks) * self.tick, 6)
+
+    def snapshot(self, i) -> tuple:
+        """(bids, asks) price -> size dicts of token i's initial book."""
+        rng = np.random.default_rng((self.seed, i))
+        mid = self.__mids[i]
+        sizes = rng.gamma(2.0, 50.0, 2 * self.levels).round(2) + 1
+        bids = {self.price(mid - 1 - k): float(sizes[k]) for k in range(self.levels)}
+        asks = {self.price(mid + 1 + k): float(sizes[self.levels + k]) for k in range(self.levels)}
+        return bids, asks
+
+    def book_messages(self) -> list:
+        messages = []
+        for i, tok in enumerate(self.tokens):
+            bids, asks = self.snapshot(i)
+            messages.append({
+                "event_type": "book", "asset_id": tok, "market": self.markets[i], "timestamp": str(self.start_ms),
+                "bids": [{"price": str(p), "size": str(s)} for p, s in sorted(bids.items())],
+                "asks": [{"price": str(p), "size": str(s)} for p, s in sorted(asks.items())],
+            })
+        return messages
+
+    def messages(self):
+        """Yield websocket messages until n_events single events have been produced."""
+        rng = self.__rng
+        weights = zipf_weights(self.n_tokens, self.zipf)
+        now = self.start_ms
+        produced = 0
+        while produced < self.n_events:
+            i = int(rng.choice(self.n_tokens, p=weights))
+            tok = self.tokens[i]
+            mid = self.__mids[i]
+            now += int(rng.integers(1, 20))
+            if rng.random() < self.trade_ratio:
+                side = "BUY" if rng.random() < 0.5 else "SELL"
+                ticks = mid - 1 if side == "BUY" else mid + 1
+                produced += 1
+                yield {
+                    "event_type": "last_trade_price", "asset_id": tok, "market": self.markets[i],
+                    "timestamp": str(now), "side": side, "price": str(self.price(ticks)),
+                    "size": str(round(float(rng.gamma(1.5, 10.0)) + 0.01, 2)), "fee_rate_bps": "0",
+                }
+                continue
+
+            n = min(int(rng.integers(1, 2 * self.burst)), self.n_events - produced)
+            changes = []
+            for _ in range(n):
+                side = "BUY" if rng.random() < 0.5 else "SELL"
+                # changes cluster at the touch, geometric in distance
+                depth = min(int(rng.geometric(0.35)), self.levels)
+                ticks = mid - depth if side == "BUY" else mid + depth
+                changes.append({
+                    "asset_id": tok, "side": side, "price": str(self.price(ticks)),
+                    "size": str(round(float(rng.normal(0.0, 20.0)), 2)),
+                    "best_bid": str(self.price(mid - 1)), "best_ask": str(self.price(mid + 1)),
+                })
+            produced += n
+            yield {"event_type": "price_change", "market": self.markets[i], "asset_id": tok,
+                   "timestamp": str(now), "price_changes": changes}
+
+    def token_events(self, messages) -> dict:
+        """token -> event_arrays with the replay semantics analytics applies to stored rows."""
+        columns = {}
+        for msg in messages:
+            ts = int(msg["timestamp"])
+            if msg["event_type"] == "price_change":
+                for change in msg["price_changes"]:
+                    cols = columns.setdefault(change["asset_id"], ([], [], [], [], []))
+                    for col, value in zip(cols, (ts, change["side"], float(change["price"]), float(change["size"]), 1.0)):
+                        col.append(value)
+            elif msg["event_type"] == "last_trade_price":
+                cols = columns.setdefault(msg["asset_id"], ([], [], [], [], []))
+                for col, value in zip(cols, (ts, msg["side"], float(msg["price"]), float(msg["size"]), -1.0)):
+                    col.append(value)
+        return {
+            tok: event_arrays.from_columns(time, side, price, size, np.array(sign))
+            for tok, (time, side, price, size, sign) in columns.items()
+        }
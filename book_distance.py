@@ -0,0 +1,142 @@
+import numpy as np
+
+BID = 0
+ASK = 1
+METRICS = ("l1", "l2", "top_n", "best_price_mismatch", "depth_weighted")
+
+
+def level_arrays(levels: dict):
+    """Sorted (prices, sizes) arrays of a price -> size dict."""
+    if not levels:
+        return np.empty(0), np.empty(0)
+    prices = np.fromiter(levels.keys(), dtype=np.float64, count=len(levels))
+    sizes = np.fromiter(levels.values(), dtype=np.float64, count=len(levels))
+    order = np.argsort(prices)
+    return prices[order], sizes[order]
+
+
+def _segment_metrics(segment, prices, local, remote, n_segments, top_n):
+    """Metrics for many aligned books laid out back to back.
+
+    Every input is one entry per (segment, price level), grouped by segment
+    and ordered best price first inside it. Levels that are empty on both
+    sides are ignored, so the depth rank only counts levels that exist on
+    either book. Everything is a bincount over the segment ids, there is no
+    loop per book.
+    """
+    diff = np.abs(local - remote)
+    present = (local != 0) | (remote != 0)
+
+    # depth rank of each present level inside its segment, 1 for the best level
+    running = np.cumsum(present)
+    starts = np.searchsorted(segment, np.arange(n_segments), side="left")
+    offset = np.concatenate(([0], running))[starts]
+    rank = running - offset[segment]
+    weight = np.where(present, 1.0 / np.maximum(rank, 1), 0.0)
+
+    l1 = np.bincount(segment, weights=diff, minlength=n_segments)
+    l2 = np.sqrt(np.bincount(segment, weights=diff * diff, minlength=n_segments))
+    top = np.bincount(segment, weights=np.where(present & (rank <= top_n), diff, 0.0), minlength=n_segments)
+    depth = np.bincount(segment, weights=diff * weight, minlength=n_segments)
+
+    return {
+        "l1": l1,
+        "l2": l2,
+        "top_n": top,
+        "best_price_mismatch": _best_mismatch(segment, prices, local, remote, n_segments),
+        "depth_weighted": depth,
+    }
+
+
+def _best_mismatch(segment, prices, local, remote, n_segments):
+    """|best local price - best remote price|, inf when only one book has levels."""
+    local_best = np.full(n_segments, np.nan)
+    remote_best = np.full(n_segments, np.nan)
+    for best, sizes in ((local_best, local), (remote_best, remote)):
+        mask = sizes != 0
+        seg, first = np.unique(segment[mask], return_index=True)
+        best[seg] = prices[mask][first]
+    mismatch = np.abs(local_best - remote_best)
+    one_sided = np.isnan(local_best) != np.isnan(remote_best)
+    mismatch[one_sided] = np.inf
+    mismatch[np.isnan(local_best) & np.isnan(remote_best)] = 0.0
+    return mismatch
+
+
+def _best_first(prices, side):
+    # bids are best at the highest price, asks at the lowest
+    return prices[::-1] if side == BID else prices
+
+
+def compare_books(levels, books, remote: dict, side, top_n=10) -> dict:
+    """Metrics of every evaluated local book against one remote side.
+
+    levels is the sorted price axis and books[k] the local sizes on it, as
+    returned by book_replay.side_books. Remote levels missing from the axis
+    are added with zero local size, so levels present on only one side
+    always count. Returns metric -> array with one value per book.
+    """
+    books = np.atleast_2d(np.asarray(books, dtype=np.float64))
+    remote_prices, remote_sizes = level_arrays(remote)
+    union = np.union1d(levels, remote_prices)
+    local = np.zeros((len(books), len(union)))
+    local[:, np.searchsorted(union, levels)] = books
+    remote_row = np.zeros(len(union))
+    remote_row[np.searchsorted(union, remote_prices)] = remote_sizes
+
+    order = _best_first(np.arange(len(union)), side)
+    n_books, n_levels = local.shape
+    segment = np.repeat(np.arange(n_books), n_levels)
+    return _segment_metrics(segment, np.tile(union[order], n_books), local[:, order].ravel(),
+                            np.tile(remote_row[order], n_books), n_books, top_n)
+
+
+def compare_batch(pairs, side, top_n=10) -> dict:
+    """Metrics for many (local, remote) price -> size dict pairs of one side at once.
+
+    All pairs are flattened into one array keyed by pair index and price and
+    aligned with a single lexsort, so a whole /books response is compared in
+    a handful of numpy calls. Returns metric -> array with one value per pair.
+    """
+    n_pairs = len(pairs)
+    if n_pairs == 0:
+        return {metric: np.empty(0) for metric in METRICS}
+
+    pair_ids, prices, sizes, origins = [], [], [], []
+    for i, (local, remote) in enumerate(pairs):
+        for origin, levels in ((0, local), (1, remote)):
+            level_prices, level_sizes = level_arrays(levels)
+            pair_ids.append(np.full(len(level_prices), i))
+            prices.append(level_prices)
+            sizes.append(level_sizes)
+            origins.append(np.full(len(level_prices), origin))
+    pair_ids = np.concatenate(pair_ids)
+    prices = np.concatenate(prices)
+    sizes = np.concatenate(sizes)
+    origins = np.concatenate(origins)
+
+    if len(prices) == 0:
+        return {metric: np.zeros(n_pairs) for metric in METRICS}
+
+    key = -prices if side == BID else prices
+    order = np.lexsort((key, pair_ids))
+    pair_ids, prices, sizes, origins = pair_ids[order], prices[order], sizes[order], origins[order]
+
+    # one group per (pair, price), local and remote sizes summed into it
+    new_group = np.ones(len(prices), dtype=bool)
+    new_group[1:] = (pair_ids[1:] != pair_ids[:-1]) | (prices[1:] != prices[:-1])
+    group = np.cumsum(new_group) - 1
+    n_groups = group[-1] + 1
+    local = np.bincount(group, weights=np.where(origins == 0, sizes, 0.0), minlength=n_groups)
+    remote = np.bincount(group, weights=np.where(origins == 1, sizes, 0.0), minlength=n_groups)
+
+    return _segment_metrics(pair_ids[new_group], prices[new_group], local, remote, n_pairs, top_n)
+
+
+def compare(local_bids: dict, local_asks: dict, remote_bids: dict, remote_asks: dict, top_n=10) -> dict:
+    """All metrics of one local book against one remote book, as plain floats."""
+    result = {}
+    for name, side, local, remote in (("bids", BID, local_bids, remote_bids), ("asks", ASK, local_asks, remote_asks)):
+        metrics = compare_batch([(local, remote)], side, top_n)
+        result[name] = {metric: float(values[0]) for metric, values in metrics.items()}
+    return result
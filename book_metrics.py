@@ -0,0 +1,58 @@
+DEFAULT_TICK = 0.01
+
+# one row per token, written by analytics for every verified /books snapshot
+BOOK_METRICS_COLUMNS = (
+    "token_id", "server_time", "best_bid", "best_ask", "spread", "mid",
+    "bid_depth", "ask_depth", "depth", "asymmetry", "discrepancy",
+)
+
+CREATE_BOOK_METRICS = """
+    CREATE TABLE IF NOT EXISTS book_metrics (
+        token_id VARCHAR(100) PRIMARY KEY,
+        server_time BIGINT, --ms unix utc timestamp of the book the metrics describe
+        best_bid REAL,
+        best_ask REAL,
+        spread REAL,
+        mid REAL,
+        bid_depth REAL,
+        ask_depth REAL,
+        depth REAL,
+        asymmetry REAL,
+        discrepancy REAL, --bids plus asks L1 distance of the local replay at its last verification
+        update_time TIMESTAMP(3) WITH TIME ZONE DEFAULT now()
+    );
+    -- the web query DSL filters and sorts on these as BOOK_*
+    CREATE INDEX IF NOT EXISTS book_metrics_spread ON book_metrics (spread);
+    CREATE INDEX IF NOT EXISTS book_metrics_depth ON book_metrics (depth);
+    CREATE INDEX IF NOT EXISTS book_metrics_asymmetry ON book_metrics (asymmetry);
+    CREATE INDEX IF NOT EXISTS book_metrics_discrepancy ON book_metrics (discrepancy);
+"""
+
+# a late snapshot never overwrites a newer one
+BOOK_METRICS_UPSERT = f"""
+    INSERT INTO book_metrics ({", ".join(BOOK_METRICS_COLUMNS)})
+    VALUES ({", ".join(f"${i + 1}" for i in range(len(BOOK_METRICS_COLUMNS)))})
+    ON CONFLICT (token_id) DO UPDATE SET
+        {", ".join(f"{c} = EXCLUDED.{c}" for c in BOOK_METRICS_COLUMNS if c != "token_id")},
+        update_time = now()
+    WHERE book_metrics.server_time IS NULL OR book_metrics.server_time <= EXCLUDED.server_time
+"""
+
+
+def top_of_book(bids: dict, asks: dict, tick=DEFAULT_TICK, depth_ticks=5) -> dict:
+    """Best prices, spread, mid and the size resting within depth_ticks ticks of each touch."""
+    best_bid = max(bids, default=None)
+    best_ask = min(asks, default=None)
+    reach = tick * (depth_ticks - 0.5)
+    bid_depth = sum(s for p, s in bids.items() if p >= best_bid - reach) if best_bid is not None else 0.0
+    ask_depth = sum(s for p, s in asks.items() if p <= best_ask + reach) if best_ask is not None else 0.0
+    both = best_bid is not None and best_ask is not None
+    return {
+        "best_bid": best_bid,
+        "best_ask": best_ask,
+        "spread": best_ask - best_bid if both else None,
+        "mid": (best_ask + best_bid) / 2 if both else None,
+        "bid_depth": bid_depth,
+        "ask_depth": ask_depth,
+        "asymmetry": (bid_depth - ask_depth) / (bid_depth + ask_depth) if bid_depth + ask_depth else None,
+    }
@@ -0,0 +1,205 @@
+import json
+
+import numpy as np
+
+from book_distance import ASK, BID, compare_books, level_arrays
+
+SIDES = {"BUY": BID, "SELL": ASK}
+
+# a level at or below this size is removed; float sums of decimal sizes rarely land on exactly 0
+SIZE_EPSILON = 1e-9
+
+
+def levels_from_json(levels) -> dict:
+    """price -> size from a stored book side, either [{"price", "size"}, ...] or {price: size}."""
+    if isinstance(levels, str):
+        levels = json.loads(levels)
+    if not levels:
+        return {}
+    if isinstance(levels, dict):
+        return {float(price): float(size) for price, size in levels.items()}
+    return {float(level["price"]): float(level["size"]) for level in levels}
+
+
+class event_arrays:
+    """Book updates as parallel arrays ordered by server time.
+
+    delta is the signed size applied to the level: price_change rows add
+    their size, last_trade_price rows subtract it.
+    """
+
+    __slots__ = ("time", "side", "price", "delta")
+
+    def __init__(self, time, side, price, delta):
+        self.time = np.asarray(time, dtype=np.int64)
+        self.side = np.asarray(side, dtype=np.int8)
+        self.price = np.asarray(price, dtype=np.float64)
+        self.delta = np.asarray(delta, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.time)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.empty(0), np.empty(0))
+
+    @classmethod
+    def from_columns(cls, time, side, price, size, sign):
+        """Build from raw columns; side holds "BUY"/"SELL" strings and sign is +1 or -1."""
+        side_codes = np.fromiter((SIDES.get(s, -1) for s in side), dtype=np.int8, count=len(side))
+        if (side_codes < 0).any():
+            bad = next(s for s in side if s not in SIDES)
+            raise ValueError(f"Invalid side: {bad}")
+        size = np.asarray(size, dtype=np.float64)
+        return cls(time, side_codes, price, sign * size)
+
+    @classmethod
+    def merge(cls, *parts):
+        """Concatenate and stable-sort by time, so earlier parts win ties."""
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls.empty()
+        time = np.concatenate([p.time for p in parts])
+        order = np.argsort(time, kind="stable")
+        return cls(time[order],
+                   np.concatenate([p.side for p in parts])[order],
+                   np.concatenate([p.price for p in parts])[order],
+                   np.concatenate([p.delta for p in parts])[order])
+
+    def take(self, selector):
+        return event_arrays(self.time[selector], self.side[selector], self.price[selector], self.delta[selector])
+
+
+def eval_prefixes(times, lb, ub):
+    """Event counts after which the book is evaluated.
+
+    The book is checked after every event whose time falls in [lb, ub]. When
+    the window holds no event, the book as of ub is the only candidate.
+    """
+    start = np.searchsorted(times, lb, side="left")
+    end = np.searchsorted(times, ub, side="right")
+    if end > start:
+        return np.arange(start + 1, end + 1)
+    return np.array([end])
+
+
+def side_books(initial: dict, events: event_arrays, side, prefixes, extra_prices=None):
+    """Replay one side of the book and return it at every prefix in one pass.
+
+    Returns (levels, books) where levels is the sorted union of every price
+    seen and books[k] holds the size per level after the first prefixes[k]
+    events. Each event is binned into the evaluation segment it precedes,
+    segment sums are computed with one bincount and a cumulative sum over
+    segments yields all evaluation points.
+    """
+    mask = events.side == side
+    positions = np.flatnonzero(mask)
+    prices = events.price[mask]
+    deltas = events.delta[mask]
+
+    init_prices, init_sizes = level_arrays(initial)
+    candidates = [init_prices, prices]
+    if extra_prices is not None:
+        candidates.append(np.asarray(extra_prices, dtype=np.float64))
+    levels = np.unique(np.concatenate(candidates))
+    n_levels = len(levels)
+    n_evals = len(prefixes)
+
+    base = np.zeros(n_levels)
+    base[np.searchsorted(levels, init_prices)] = init_sizes
+
+    # event j belongs to segment k when prefixes[k-1] <= j < prefixes[k]
+    segment = np.searchsorted(prefixes, positions, side="right")
+    keep = segment < n_evals
+    flat = segment[keep] * n_levels + np.searchsorted(levels, prices[keep])
+    sums = np.bincount(flat, weights=deltas[keep], minlength=n_evals * n_levels).reshape(n_evals, n_levels)
+    books = base + np.cumsum(sums, axis=0)
+    books[books <= SIZE_EPSILON] = 0.0
+    return levels, books
+
+
+def book_dict(levels, sizes) -> dict:
+    nonzero = sizes != 0
+    return dict(zip(levels[nonzero].tolist(), sizes[nonzero].tolist()))
+
+
+def replay_window(bids: dict, asks: dict, events: event_arrays, remote_bids: dict, remote_asks: dict, lb, ub, top_n=10):
+    """Replay events onto a book snapshot and pick the closest match to a remote book.
+
+    The local book is evaluated after every event in [lb, ub]; for each side the
+    evaluation with the smallest L1 distance to the remote side is returned as
+    [bids_metrics, bids, asks_metrics, asks], where the metrics are the
+    book_distance metrics of that evaluation.
+    """
+    prefixes = eval_prefixes(events.time, lb, ub)
+    result = []
+    for side, initial, remote in ((BID, bids, remote_bids), (ASK, asks, remote_asks)):
+        levels, books = side_books(initial, events, side, prefixes, extra_prices=list(remote))
+        metrics = compare_books(levels, books, remote, side, top_n)
+        best = int(np.argmin(metrics["l1"]))
+        result.extend([{metric: float(values[best]) for metric, values in metrics.items()},
+                       book_dict(levels, books[best])])
+    return result
+
+
+def verify_jobs(jobs, top_n=10) -> list:
+    """replay_window over a batch of tokens, the unit of work analytics hands to its process pool.
+
+    Each job is (token_id, bids, asks, events, remote_bids, remote_asks, lb, ub).
+    Results are kept small and already serialized so the parent only has to
+    insert them: one dict per job with both sides' metrics, the closest local
+    book as JSON and its depth.
+    """
+    results = []
+    for token_id, bids, asks, events, remote_bids, remote_asks, lb, ub in jobs:
+        bids_metrics, best_bids, asks_metrics, best_asks = replay_window(
+            bids, asks, events, remote_bids, remote_asks, lb, ub, top_n)
+        results.append({
+            "token_id": token_id,
+            "bids_metrics": bids_metrics,
+            "asks_metrics": asks_metrics,
+            "local_bids": json.dumps(best_bids),
+            "local_asks": json.dumps(best_asks),
+            "bids_depth": len(best_bids),
+            "asks_depth": len(best_asks),
+        })
+    return results
+
+
+class replay_state:
+    """Local book of one token kept between analytics cycles.
+
+    Every event with server time before cursor_time has been applied to bids
+    and asks; later events are replayed again each cycle. last_rows holds the
+    highest row id read per source table, so rows that are inserted late
+    behind the cursor can be detected and force a rebuild. recent_rows holds
+    the ids of folded rows close to that high-water mark, so rows read again
+    in the overlap behind it are told apart from late ones.
+    """
+
+    __slots__ = ("book_time", "cursor_time", "bids", "asks", "last_rows", "recent_rows", "last_event_time")
+
+    def __init__(self, book_time, bids: dict, asks: dict):
+        self.book_time = book_time
+        self.cursor_time = book_time
+        self.bids = dict(bids)
+        self.asks = dict(asks)
+        self.last_rows = {}
+        self.recent_rows = set()
+        self.last_event_time = book_time
+
+    def apply(self, events: event_arrays, cursor_time):
+        """Fold events (all older than cursor_time) into the book and advance the cursor."""
+        for side, levels in ((BID, self.bids), (ASK, self.asks)):
+            mask = events.side == side
+            if not mask.any():
+                continue
+            prices, inverse = np.unique(events.price[mask], return_inverse=True)
+            sums = np.bincount(inverse, weights=events.delta[mask])
+            for price, delta in zip(prices.tolist(), sums.tolist()):
+                size = levels.get(price, 0.0) + delta
+                if size <= SIZE_EPSILON:
+                    levels.pop(price, None)
+                else:
+                    levels[price] = size
+        self.cursor_time = max(self.cursor_time, cursor_time)
@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import math
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from metrics import REGISTRY
+
+BOOKS_URL = "https://clob.polymarket.com/books"
+
+
+class books_scheduler:
+    """Keeps every known token verified against the /books endpoint.
+
+    Each request carries up to batch_size tokens. Part of every batch
+    (priority_share) goes to the tokens with the highest score, the rest is
+    filled by walking the token list round robin, so a token is checked at
+    least once per coverage_period() no matter how the scores look, as long
+    as handlers keep up, i.e. a batch is requested and handled within
+    concurrency / rate seconds.
+    Requests start at most `rate` times per second, each response is handed
+    to `handler` as soon as it arrives, and at most `concurrency` batches are
+    requested or handled at once, so slow handlers hold back new requests
+    instead of piling up.
+    """
+
+    def __init__(self, session, handler, url=BOOKS_URL, batch_size=300, concurrency=4, rate=2.0,
+                 priority_share=0.5, decay=0.5, log=None):
+        self.__session = session
+        self.__handler = handler
+        self.__url = url
+        self.__batch_size = batch_size
+        self.__rate = rate
+        self.__priority_slots = int(batch_size * priority_share)
+        self.__decay = decay
+        self.__log = log or (lambda msg, level="INFO": None)
+
+        self.__tokens = []
+        self.__known = set()
+        self.__cursor = 0
+        self.__scores = {}
+        # token -> monotonic time of its last check, or of being added if never checked,
+        # least recent first so the oldest check is read without a scan
+        self.__last_checked = OrderedDict()
+
+        self.__slots = asyncio.Semaphore(concurrency)
+        self.__next_start = 0.0
+        self.__task = None
+        self.__inflight = set()
+
+        self.__requests = REGISTRY.counter("books_scheduler_requests", "/books requests sent")
+        self.__failures = REGISTRY.counter("books_scheduler_failures", "/books requests that failed")
+        self.__request_latency = REGISTRY.histogram("books_scheduler_request_seconds", "/books request latency")
+        self.__books = REGISTRY.counter("books_scheduler_books", "books returned by /books")
+        self.__staleness = REGISTRY.gauge("books_scheduler_oldest_check_seconds", "age of the least recently verified token")
+
+    def add_tokens(self, tokens):
+        now = time.monotonic()
+        for tok in tokens:
+            if tok not in self.__known:
+                self.__known.add(tok)
+                self.__tokens.append(tok)
+                self.__last_checked[tok] = now
+
+    def report(self, tok, activity=0.0, mismatch=0.0):
+        """Raise a token's priority by its recent event count and last mismatch."""
+        if tok in self.__known:
+            self.__scores[tok] = self.__scores.get(tok, 0.0) * self.__decay + activity + mismatch
+
+    def coverage_period(self) -> float:
+        """Upper bound in seconds on the time between two checks of one token, while handlers keep up with rate."""
+        rotation = max(self.__batch_size - self.__priority_slots, 1)
+        return math.ceil(len(self.__tokens) / rotation) / self.__rate
+
+    def next_batch(self) -> list:
+        batch = []
+        picked = set()
+        if self.__priority_slots and self.__scores:
+            for tok, score in heapq.nlargest(self.__priority_slots, self.__scores.items(), key=lambda item: item[1]):
+                if score <= 0:
+                    break
+                batch.append(tok)
+                picked.add(tok)
+                # the score is earned again by new activity or another mismatch
+                del self.__scores[tok]
+
+        n_tokens = len(self.__tokens)
+        walked = 0
+        while len(batch) < self.__batch_size and walked < n_tokens:
+            tok = self.__tokens[self.__cursor]
+            self.__cursor = (self.__cursor + 1) % n_tokens
+            walked += 1
+            if tok not in picked:
+                batch.append(tok)
+                picked.add(tok)
+        return batch
+
+    def running(self) -> bool:
+        return self.__task is not None and not self.__task.done()
+
+    def start(self):
+        """Start requesting batches, returns the task doing it."""
+        if not self.running():
+            self.__task = asyncio.create_task(self.__run(), name="books_scheduler")
+        return self.__task
+
+    async def stop(self):
+        tasks = list(self.__inflight)
+        if self.__task is not None:
+            tasks.append(self.__task)
+            self.__task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            "tokens": len(self.__tokens),
+            "prioritized": sum(1 for score in self.__scores.values() if score > 0),
+            "inflight": len(self.__inflight),
+            "coverage_period": self.coverage_period(),
+            "oldest_check_seconds": self.__oldest_check(now),
+        }
+
+    def __oldest_check(self, now):
+        """Seconds since the least recently checked token was checked or added, None without tokens."""
+        if not self.__last_checked:
+            return None
+        return now - next(iter(self.__last_checked.values()))
+
+    async def __run(self):
+        while True:
+            await self.__wait_turn()
+            batch = self.next_batch()
+            if not batch:
+                continue
+            await self.__slots.acquire()
+            task = asyncio.create_task(self.__fetch(batch))
+            self.__inflight.add(task)
+            task.add_done_callback(self.__inflight.discard)
+
+    async def __wait_turn(self):
+        now = time.monotonic()
+        if self.__next_start > now:
+            await asyncio.sleep(self.__next_start - now)
+        self.__next_start = max(now, self.__next_start) + 1 / self.__rate
+
+    async def __fetch(self, batch):
+        try:
+            books = await self.__request(batch)
+            if books is None:
+                return
+            await self.__handler(books)
+        except Exception as e:
+            self.__log(f"books scheduler failed to handle a batch of {len(batch)} tokens: {e}", "ERROR")
+        finally:
+            # the slot covers the handler too, so handlers never outnumber it
+            self.__slots.release()
+
+    async def __request(self, batch):
+        """The parsed /books response for batch, None when the request failed."""
+        self.__requests.inc()
+        start = time.perf_counter()
+        try:
+            async with self.__session.post(self.__url, json=[{"token_id": tok} for tok in batch]) as resp:
+                if resp.status != 200:
+                    raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                books = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # ValueError covers a 200 whose body is not JSON
+            self.__failures.inc()
+            self.__log(f"books scheduler request for {len(batch)} tokens failed: {e}", "ERROR")
+            # retry the batch first thing
+            for tok in batch:
+                self.report(tok, mismatch=math.inf)
+            return None
+        finally:
+            self.__request_latency.observe(time.perf_counter() - start)
+
+        now = time.monotonic()
+        for tok in batch:
+            self.__last_checked[tok] = now
+            self.__last_checked.move_to_end(tok)
+        self.__books.inc(len(books) if isinstance(books, list) else 1)
+        self.__staleness.set(self.__oldest_check(now))
+        return books
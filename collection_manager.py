@@ -1,24 +1,47 @@
+import argparse
 import asyncio
 import json
 import importlib
 import sys
 import traceback
 import os
+import time
+from aiohttp import web
+from task_supervisor import supervised_task
+from control_protocol import SOCKET_PATH, read_frame, control_writer
+from instance_worker import worker_proxy, SUPERVISION_FIELDS
+from metrics import REGISTRY, render_prometheus
+from resources import resource_registry
+from loop_monitor import loop_monitor
+import profiler
+
+# control request types, anything else is counted as "other" so clients cannot add label series
+MESSAGE_TYPES = (
+    "add_class", "remove_class", "create_instance", "destroy_instance", "invoke_function", "status", "cancel",
+    "add_resource", "remove_resource", "monitor_loop", "profile", "stats", "ls",
+)
 
-SOCKET_PATH = "/tmp/collection_manager.sock"
 
 class collection_manager:
     def __init__(self):
         self.classes = {}
         self.class_sources = {}
+        self.class_dependencies = {}
         self.instances = {}
-        self.running = set()
+        self.running = {}
+        self.resources = resource_registry()
+        self.loop_monitor = None
+        self.request_latency = REGISTRY.histogram("collection_manager_request_seconds", "control request handling latency")
 
     async def handle_message(self, writer, message):
+        request_start = time.perf_counter()
         try:
             print(f"[Server] Received message: {message}")
             data = json.loads(message)
+            writer.request_id = data.get("request_id")
             msg_type = data.get("type")
+            REGISTRY.counter("collection_manager_requests", "control requests by type",
+                             type=msg_type if msg_type in MESSAGE_TYPES else "other").inc()
 
             if msg_type == "add_class":
                 await self._handle_add_class(writer, data)
@@ -30,6 +53,20 @@ class collection_manager:
                 await self._handle_destroy_instance(writer, data)
             elif msg_type == "invoke_function":
                 await self._handle_invoke_function(writer, data)
+            elif msg_type == "status":
+                await self._handle_status(writer, data)
+            elif msg_type == "cancel":
+                await self._handle_cancel(writer, data)
+            elif msg_type == "add_resource":
+                await self._handle_add_resource(writer, data)
+            elif msg_type == "remove_resource":
+                await self._handle_remove_resource(writer, data)
+            elif msg_type == "monitor_loop":
+                await self._handle_monitor_loop(writer, data)
+            elif msg_type == "profile":
+                await self._handle_profile(writer, data)
+            elif msg_type == "stats":
+                await self._handle_stats(writer, data)
             elif msg_type == "ls":
                 await self._handle_ls(writer)
             else:
@@ -45,11 +82,10 @@ class collection_manager:
                 "error": f"Exception in message handler: {e}",
                 "traceback": traceback.format_exc()
             })
+        self.request_latency.observe(time.perf_counter() - request_start)
 
     async def _send(self, writer, obj):
-        msg = json.dumps(obj).encode("utf-8")
-        writer.write(msg)
-        await writer.drain()
+        await writer.send(obj)
 
     async def _handle_add_class(self, writer, data):
         class_name = data.get("class_name")
@@ -95,6 +131,7 @@ class collection_manager:
 
         self.classes[class_name] = cls
         self.class_sources[class_name] = code
+        self.class_dependencies[class_name] = dependencies
         await self._send(writer, {"status": "success", "message": f"Class {class_name} added successfully"})
 
     
@@ -103,41 +140,94 @@ class collection_manager:
         if class_name not in self.classes:
             await self._send(writer, {"status": "failure", "error": f"Class {class_name} does not exist"})
             return
-        if any(isinstance(inst, self.classes[class_name]) for inst in self.instances.values()):
+        if any(self._is_instance_of(inst, class_name) for inst in self.instances.values()):
             await self._send(writer, {"status": "failure", "error": f"Cannot remove class {class_name}, instances exist"})
             return
         del self.classes[class_name]
         del self.class_sources[class_name]
+        del self.class_dependencies[class_name]
         await self._send(writer, {"status": "success", "message": f"Class {class_name} removed"})
 
     async def _handle_create_instance(self, writer, data):
         class_name = data.get("class_name")
         instance_name = data.get("instance_name")
         args = data.get("args", {})
+        resources = data.get("resources", {})
         if class_name not in self.classes:
             await self._send(writer, {"status": "failure", "error": f"Class {class_name} does not exist"})
             return
         if instance_name in self.instances:
             await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} already exists"})
             return
+        missing = [name for name in resources.values() if name not in self.resources]
+        if missing:
+            await self._send(writer, {"status": "failure", "error": f"Resources {missing} do not exist"})
+            return
+        if data.get("isolated", False):
+            await self._create_isolated_instance(writer, class_name, instance_name, args, resources, data)
+            return
         cls = self.classes[class_name]
+        shared = {kwarg: self.resources.acquire(name, instance_name) for kwarg, name in resources.items()}
         try:
-            instance = cls(**args)
+            instance = cls(**args, **shared)
         except TypeError as e:
+            self.resources.release(instance_name)
             await self._send(writer, {"status": "failure", "error": f"Invalid constructor args: {e}"})
             return
+        except Exception as e:
+            # the instance never existed, it must not keep the resources in use
+            self.resources.release(instance_name)
+            await self._send(writer, {"status": "failure", "error": f"Constructor of {class_name} failed: {e}",
+                                      "traceback": traceback.format_exc()})
+            return
         self.instances[instance_name] = instance
         await self._send(writer, {"status": "success", "message": f"Instance {instance_name} created"})
 
+    async def _create_isolated_instance(self, writer, class_name, instance_name, args, resources, data):
+        proxy = worker_proxy(
+            instance_name,
+            class_name,
+            self.class_sources[class_name],
+            args,
+            dependencies=self.class_dependencies[class_name],
+            resource_specs={kwarg: self.resources.spec(name) for kwarg, name in resources.items()},
+            restart=data.get("restart_worker", True),
+            backoff_initial=data.get("backoff_initial", 1.0),
+            backoff_max=data.get("backoff_max", 60.0)
+        )
+        # reserve the name while the worker process boots
+        self.instances[instance_name] = proxy
+        try:
+            resp = await proxy.start()
+        except Exception as e:
+            resp = {"status": "failure", "error": f"Failed to start worker: {e}", "traceback": traceback.format_exc()}
+        if resp.get("status") != "success":
+            del self.instances[instance_name]
+            await proxy.destroy()
+            await self._send(writer, resp)
+            return
+        await self._send(writer, {"status": "success", "message": f"Instance {instance_name} created in worker {proxy.process.pid}"})
+
+    def _is_instance_of(self, instance, class_name):
+        if isinstance(instance, worker_proxy):
+            return instance.class_name == class_name
+        return isinstance(instance, self.classes[class_name])
+
     async def _handle_destroy_instance(self, writer, data):
         instance_name = data.get("instance_name")
         if instance_name not in self.instances:
             await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} does not exist"})
             return
-        if instance_name in self.running:
+        if instance_name in self.running and self.running[instance_name].active():
             await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} is running"})
             return
-        del self.instances[instance_name]
+        instance = self.instances.pop(instance_name)
+        self.running.pop(instance_name, None)
+        self.resources.release(instance_name)
+        await self._unwatch_loop(instance_name)
+        if isinstance(instance, worker_proxy):
+            await self._send(writer, await instance.destroy())
+            return
         await self._send(writer, {"status": "success", "message": f"Instance {instance_name} destroyed"})
 
     async def _handle_invoke_function(self, writer, data):
@@ -151,11 +241,19 @@ class collection_manager:
             return
 
         instance = self.instances[instance_name]
+        if isinstance(instance, worker_proxy):
+            fields = {key: data[key] for key in SUPERVISION_FIELDS if key in data}
+            await self._send(writer, await instance.request(
+                "invoke", function_name=func_name, args=args, background=data.get("background", False), **fields))
+            return
         if not hasattr(instance, func_name):
             await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} has no function {func_name}"})
             return
 
         func = getattr(instance, func_name)
+        if data.get("background", False):
+            await self._spawn_supervised(writer, instance_name, func_name, func, args, data)
+            return
         try:
             if asyncio.iscoroutinefunction(func):
                 result = await func(**args)
@@ -165,33 +263,271 @@ class collection_manager:
         except Exception as e:
             await self._send(writer, {"status": "failure", "error": f"Failed to invoke {func_name}: {e}", "traceback": traceback.format_exc()})
 
+    async def _spawn_supervised(self, writer, instance_name, func_name, func, args, data):
+        if instance_name in self.running and self.running[instance_name].active():
+            await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} is already running {self.running[instance_name].name}"})
+            return
+
+        cleanup = None
+        cleanup_name = data.get("cleanup_function")
+        if cleanup_name is not None:
+            if not hasattr(self.instances[instance_name], cleanup_name):
+                await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} has no function {cleanup_name}"})
+                return
+            cleanup = getattr(self.instances[instance_name], cleanup_name)
+
+        try:
+            task = supervised_task(
+                name=f"{instance_name}.{func_name}",
+                func=func,
+                args=args,
+                restart=data.get("restart", "never"),
+                max_restarts=data.get("max_restarts"),
+                backoff_initial=data.get("backoff_initial", 1.0),
+                backoff_max=data.get("backoff_max", 60.0),
+                cleanup=cleanup
+            )
+        except ValueError as e:
+            await self._send(writer, {"status": "failure", "error": str(e)})
+            return
+
+        task.start()
+        self.running[instance_name] = task
+        await self._send(writer, {"status": "success", "message": f"Spawned {func_name} on {instance_name}", "task": task.status()})
+
+    async def _handle_status(self, writer, data):
+        instance_name = data.get("instance_name")
+        if instance_name is None:
+            tasks = {name: task.status() for name, task in self.running.items()}
+            workers = {}
+            for name, instance in self.instances.items():
+                if isinstance(instance, worker_proxy):
+                    resp = await instance.request("status")
+                    workers[name] = dict(instance.info(), task=resp.get("task"))
+            await self._send(writer, {"status": "success", "tasks": tasks, "workers": workers})
+            return
+        instance = self.instances.get(instance_name)
+        if isinstance(instance, worker_proxy):
+            resp = await instance.request("status")
+            resp["worker"] = instance.info()
+            await self._send(writer, resp)
+            return
+        if instance_name not in self.running:
+            await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} has no supervised task"})
+            return
+        await self._send(writer, {"status": "success", "task": self.running[instance_name].status()})
+
+    async def _handle_cancel(self, writer, data):
+        instance_name = data.get("instance_name")
+        instance = self.instances.get(instance_name)
+        if isinstance(instance, worker_proxy):
+            await self._send(writer, await instance.request("cancel"))
+            return
+        if instance_name not in self.running or not self.running[instance_name].active():
+            await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} is not running"})
+            return
+        task = self.running[instance_name]
+        await task.cancel()
+        await self._send(writer, {"status": "success", "message": f"Cancelled {task.name}", "task": task.status()})
+
+    async def collect_stats(self, consumer="stats") -> dict:
+        """Metric snapshots of this process and of every worker process, rates since consumer's last call."""
+        REGISTRY.gauge("collection_manager_instances", "instances managed").set(len(self.instances))
+        REGISTRY.gauge("collection_manager_running_tasks", "active supervised tasks").set(
+            sum(1 for task in self.running.values() if task.active()))
+        REGISTRY.gauge("collection_manager_task_restarts", "restarts across supervised tasks").set(
+            sum(task.restarts for task in self.running.values()))
+        stats = {"manager": REGISTRY.snapshot(consumer), "workers": {}}
+        for name, instance in self.instances.items():
+            if isinstance(instance, worker_proxy):
+                resp = await instance.request("stats", consumer=consumer)
+                if resp.get("status") == "success":
+                    stats["workers"][name] = resp["stats"]
+        return stats
+
+    async def metrics_text(self, consumer="prometheus") -> str:
+        stats = await self.collect_stats(consumer)
+        snapshots = [({}, stats["manager"])]
+        snapshots.extend(({"worker": name}, snapshot) for name, snapshot in stats["workers"].items())
+        return render_prometheus(snapshots)
+
+    async def _handle_stats(self, writer, data):
+        if data.get("format", "json") == "prometheus":
+            await self._send(writer, {"status": "success", "text": await self.metrics_text("stats")})
+            return
+        await self._send(writer, {"status": "success", "stats": await self.collect_stats()})
+
+    async def _handle_add_resource(self, writer, data):
+        name = data.get("name")
+        try:
+            await self.resources.add(name, data.get("kind"), data.get("options", {}))
+        except Exception as e:
+            await self._send(writer, {"status": "failure", "error": f"Failed to add resource {name}: {e}"})
+            return
+        await self._send(writer, {"status": "success", "message": f"Resource {name} added"})
+
+    async def _handle_remove_resource(self, writer, data):
+        name = data.get("name")
+        if name not in self.resources:
+            await self._send(writer, {"status": "failure", "error": f"Resource {name} does not exist"})
+            return
+        try:
+            await self.resources.remove(name)
+        except ValueError as e:
+            await self._send(writer, {"status": "failure", "error": str(e)})
+            return
+        await self._send(writer, {"status": "success", "message": f"Resource {name} removed"})
+
+    async def _handle_monitor_loop(self, writer, data):
+        instance_name = data.get("instance_name")
+        action = data.get("action", "report")
+        if instance_name not in self.instances:
+            await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} does not exist"})
+            return
+        instance = self.instances[instance_name]
+        if isinstance(instance, worker_proxy):
+            await self._send(writer, await instance.request("monitor_loop", **{k: v for k, v in data.items() if k not in ("type", "request_id")}))
+            return
+
+        if action == "enable":
+            if self.loop_monitor is None:
+                self.loop_monitor = loop_monitor(
+                    interval=data.get("interval_ms", 50) / 1000,
+                    threshold=data.get("threshold_ms", 100) / 1000
+                )
+                self.loop_monitor.start()
+            self.loop_monitor.watch(instance_name, instance)
+            await self._send(writer, {"status": "success", "message": f"Loop monitor enabled for {instance_name}"})
+        elif action == "disable":
+            await self._unwatch_loop(instance_name)
+            await self._send(writer, {"status": "success", "message": f"Loop monitor disabled for {instance_name}"})
+        elif action == "report":
+            if self.loop_monitor is None or instance_name not in self.loop_monitor.watched:
+                await self._send(writer, {"status": "failure", "error": f"Loop monitor not enabled for {instance_name}"})
+                return
+            await self._send(writer, {"status": "success", "report": self.loop_monitor.report(instance_name)})
+        else:
+            await self._send(writer, {"status": "failure", "error": f"Unknown monitor_loop action: {action}"})
+
+    async def _handle_profile(self, writer, data):
+        instance_name = data.get("instance_name")
+        if instance_name not in self.instances:
+            await self._send(writer, {"status": "failure", "error": f"Instance {instance_name} does not exist"})
+            return
+        instance = self.instances[instance_name]
+        if isinstance(instance, worker_proxy):
+            await self._send(writer, await instance.request("profile", **{k: v for k, v in data.items() if k not in ("type", "request_id")}))
+            return
+        try:
+            result = await profiler.profile(
+                {instance_name: instance},
+                seconds=data.get("seconds", 10),
+                mode=data.get("mode", "sampling"),
+                interval=data.get("interval_ms", 5) / 1000,
+                output_dir=data.get("output_dir"),
+                top=data.get("top", 30),
+                name=instance_name
+            )
+        except ValueError as e:
+            await self._send(writer, {"status": "failure", "error": str(e)})
+            return
+        await self._send(writer, {"status": "success", "profile": result})
+
+    async def _unwatch_loop(self, instance_name):
+        if self.loop_monitor is None:
+            return
+        self.loop_monitor.unwatch(instance_name)
+        # the monitor is shared by the whole loop, stop it with the last watcher
+        if not self.loop_monitor.watched:
+            await self.loop_monitor.stop()
+            self.loop_monitor = None
+
     async def _handle_ls(self, writer):
-        overview = {cls_name: [inst_name for inst_name, obj in self.instances.items() if isinstance(obj, cls)]
-                    for cls_name, cls in self.classes.items()}
-        await self._send(writer, {"status": "success", "overview": overview})
+        overview = {cls_name: [inst_name for inst_name, obj in self.instances.items() if self._is_instance_of(obj, cls_name)]
+                    for cls_name in self.classes}
+        await self._send(writer, {"status": "success", "overview": overview, "resources": self.resources.describe()})
 
 
-async def server_loop():
+async def start_metrics_server(cm, host, port):
+    async def handle_metrics(request):
+        return web.Response(text=await cm.metrics_text(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"[Server] Prometheus metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+def tagged(message) -> bool:
+    """Whether a request frame carries a request_id its response can be matched by."""
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get("request_id") is not None
+
+
+async def server_loop(metrics_host="127.0.0.1", metrics_port=None):
     if os.path.exists(SOCKET_PATH):
         os.remove(SOCKET_PATH)
 
     cm = collection_manager()
+    metrics_runner = None
+    if metrics_port is not None:
+        metrics_runner = await start_metrics_server(cm, metrics_host, metrics_port)
 
     async def handler(reader, writer):
-        data = await reader.read(65536)
-        message = data.decode()
-        await cm.handle_message(writer, message)
-        writer.close()
-        await writer.wait_closed()
+        # persistent connection: requests tagged with a request_id are dispatched
+        # in arrival order and answered as they complete; untagged requests come
+        # from clients that match responses by order, so they are handled inline
+        lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                message = payload.decode()
+                handling = cm.handle_message(control_writer(writer, lock), message)
+                if not tagged(message):
+                    await handling
+                    continue
+                task = asyncio.create_task(handling)
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            print(f"[Server] Dropping client connection: {e}")
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
     server = await asyncio.start_unix_server(handler, path=SOCKET_PATH)
     print(f"[Server] collection_manager listening on {SOCKET_PATH}")
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await cm.resources.close_all()
 
 def main():
+    parser = argparse.ArgumentParser(description="collection_manager control server")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus text metrics on this port")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    opts = parser.parse_args()
     try:
-        asyncio.run(server_loop())
+        asyncio.run(server_loop(opts.metrics_host, opts.metrics_port))
     except KeyboardInterrupt:
         print("[Server] collection_manager shutting down")
 
@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import json
+import struct
+
+SOCKET_PATH = "/tmp/collection_manager.sock"
+
+# every frame is a 4 byte big-endian payload length followed by a utf-8 json object
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+async def read_frame(reader):
+    """Read one frame payload, or return None if the peer closed cleanly between frames."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"frame of {length} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return await reader.readexactly(length)
+
+
+def encode_frame(obj) -> bytes:
+    payload = json.dumps(obj).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+
+class control_writer:
+    """Response side of one request on a persistent connection.
+
+    Several requests on the same connection are handled concurrently, so the
+    lock keeps each frame contiguous on the stream and request_id lets the
+    client match responses that complete out of order.
+    """
+
+    def __init__(self, writer, lock):
+        self.writer = writer
+        self.lock = lock
+        self.request_id = None
+
+    async def send(self, obj):
+        if self.request_id is not None:
+            obj["request_id"] = self.request_id
+        async with self.lock:
+            self.writer.write(encode_frame(obj))
+            await self.writer.drain()
+
+
+class control_client:
+    """Async client for the collection_manager control socket.
+
+    Requests can be pipelined: each call to request() gets its own request_id
+    and awaits the matching response, while other calls share the connection.
+
+        async with control_client() as cli:
+            resp = await cli.request("status")
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.__path = path
+        self.__reader = None
+        self.__writer = None
+        self.__lock = asyncio.Lock()
+        self.__pending = {}
+        self.__ids = itertools.count(1)
+        self.__read_task = None
+
+    async def connect(self):
+        self.__reader, self.__writer = await asyncio.open_unix_connection(self.__path)
+        self.__read_task = asyncio.create_task(self.__read_loop())
+        return self
+
+    async def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            try:
+                await self.__writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.__writer = None
+        if self.__read_task is not None:
+            self.__read_task.cancel()
+            try:
+                await self.__read_task
+            except asyncio.CancelledError:
+                pass
+            self.__read_task = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def request(self, msg_type, **fields) -> dict:
+        if self.__writer is None:
+            raise ConnectionError("control_client is not connected")
+        request_id = next(self.__ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[request_id] = future
+        message = dict(fields, type=msg_type, request_id=request_id)
+        try:
+            async with self.__lock:
+                self.__writer.write(encode_frame(message))
+                await self.__writer.drain()
+            return await future
+        finally:
+            self.__pending.pop(request_id, None)
+
+    async def __read_loop(self):
+        error = ConnectionError("collection_manager closed the connection")
+        try:
+            while True:
+                payload = await read_frame(self.__reader)
+                if payload is None:
+                    break
+                response = json.loads(payload)
+                future = self.__pending.get(response.get("request_id"))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            error = ConnectionError(f"control connection failed: {e}")
+        finally:
+            for future in self.__pending.values():
+                if not future.done():
+                    future.set_exception(error)
@@ -0,0 +1,120 @@
+import os
+import time
+
+# counts are kept per BUCKET_MS bucket, enough to give rates over every window
+BUCKET_MS = 10_000
+WINDOWS = {"1m": 60_000, "5m": 300_000, "1h": 3_600_000}
+
+# negrisks counts distinct negRiskMarketID groups, not markets flagged negRisk
+MARKET_COUNTERS = ("markets", "tokens", "negrisks")
+EVENT_COUNTERS = ("events", "books", "price_changes", "last_trades", "tick_size_changes")
+
+# every writing process has its own shard row, so collectors never wait on each other's row locks
+CREATE_COUNTERS = """
+    CREATE TABLE IF NOT EXISTS counters (
+        name VARCHAR(40),
+        bucket BIGINT, --ms unix utc start of the bucket
+        shard INTEGER,
+        value BIGINT,
+        PRIMARY KEY (name, bucket, shard)
+    );
+    CREATE INDEX IF NOT EXISTS counters_bucket ON counters (bucket);
+"""
+
+COUNTERS_UPSERT = """
+    INSERT INTO counters (name, bucket, shard, value) VALUES ($1, $2, $3, $4)
+    ON CONFLICT (name, bucket, shard) DO UPDATE SET value = counters.value + EXCLUDED.value
+"""
+
+# a collector started with reset only clears its own counters
+COUNTERS_RESET = "DELETE FROM counters WHERE name = ANY($1::text[])"
+
+
+def counter_rows(counts: dict, now_ms=None) -> list:
+    """COUNTERS_UPSERT rows adding `counts` to the current bucket of this process."""
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    bucket = now_ms - now_ms % BUCKET_MS
+    shard = os.getpid()
+    return [(name, bucket, shard, value) for name, value in counts.items() if value]
+
+
+class counters_view:
+    """Totals and windowed rates read from the counters table, refreshed incrementally.
+
+    Totals of the buckets older than the last hour are summed over the table
+    once every `settle_interval` seconds; every other refresh only re-reads
+    the buckets from the last hour, which always stay in memory for the
+    rates. Such a refresh costs one index range scan over a few hundred rows,
+    whatever the table size, and refreshes closer together than `interval`
+    seconds are answered from memory. A recent bucket that shrank or went
+    missing means a collector reset its counters, and the settled totals are
+    summed again right away.
+    """
+
+    def __init__(self, interval=1.0, settle_interval=60.0):
+        self.__interval = interval
+        self.__settle_interval = settle_interval
+        self.__settled = {}  # name -> total of the buckets older than the recent window
+        self.__recent = {}  # (name, bucket) -> value
+        self.__since = None  # first bucket kept in __recent
+        self.__settle_time = 0.0
+        self.__read_time = 0.0
+        self.__snapshot = None
+
+    async def read(self, connect, timeout=None) -> dict:
+        """Current totals and rates; connect() gives an async context manager yielding a connection, such as pool.acquire."""
+        now = time.monotonic()
+        if self.__snapshot is not None and now - self.__read_time < self.__interval:
+            return self.__snapshot
+
+        now_ms = int(time.time() * 1000)
+        horizon = now_ms - max(WINDOWS.values())
+        horizon -= horizon % BUCKET_MS
+        async with connect() as conn:
+            if self.__since is None or now - self.__settle_time >= self.__settle_interval:
+                await self.__settle(conn, horizon, now, timeout)
+            recent = await self.__read_recent(conn, timeout)
+            if any(recent.get((name, bucket), 0) < value
+                   for (name, bucket), value in self.__recent.items() if bucket >= self.__since):
+                # rows were deleted, the settled totals may include them too
+                await self.__settle(conn, horizon, now, timeout)
+                recent = await self.__read_recent(conn, timeout)
+        self.__recent = recent
+
+        # buckets that left the last hour move into the settled totals
+        for (name, bucket), value in list(self.__recent.items()):
+            if bucket < horizon:
+                self.__settled[name] = self.__settled.get(name, 0) + value
+                del self.__recent[(name, bucket)]
+        self.__since = horizon
+
+        totals = dict(self.__settled)
+        for (name, _), value in self.__recent.items():
+            totals[name] = totals.get(name, 0) + value
+        rates = {}
+        for window, width in WINDOWS.items():
+            counts = {}
+            for (name, bucket), value in self.__recent.items():
+                if bucket >= now_ms - width:
+                    counts[name] = counts.get(name, 0) + value
+            rates[window] = {name: value * 1000 / width for name, value in counts.items()}
+
+        self.__snapshot = {"time": now_ms, "totals": totals, "rates_per_s": rates}
+        self.__read_time = now
+        return self.__snapshot
+
+    async def __settle(self, conn, horizon, now, timeout):
+        rows = await conn.fetch(
+            "SELECT name, SUM(value) AS value FROM counters WHERE bucket < $1 GROUP BY name", horizon,
+            timeout=timeout
+        )
+        self.__settled = {row["name"]: row["value"] for row in rows}
+        self.__since = horizon
+        self.__settle_time = now
+
+    async def __read_recent(self, conn, timeout) -> dict:
+        rows = await conn.fetch(
+            "SELECT name, bucket, SUM(value) AS value FROM counters WHERE bucket >= $1 GROUP BY name, bucket",
+            self.__since, timeout=timeout
+        )
+        return {(row["name"], row["bucket"]): row["value"] for row in rows}
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import json
+
+from metrics import REGISTRY
+
+# tables pushed to browsers, in the order the collectors insert them
+FEED_TABLES = ("markets", "attributes")
+
+
+def _event(table, rows, marks) -> bytes:
+    """One server-sent event with every new row of a table, null columns left out.
+
+    The event id carries the high-water mark of every table, a reconnecting
+    EventSource sends it back as Last-Event-ID and misses nothing.
+    """
+    data = json.dumps(
+        [{k: v for k, v in dict(row).items() if v is not None} for row in rows], default=str, separators=(",", ":")
+    )
+    event_id = ",".join(str(marks[t]) for t in FEED_TABLES)
+    return f"id: {event_id}\nevent: {table}\ndata: {data}\n\n".encode()
+
+
+class delta_feed:
+    """One database watcher fanning new market and attribute rows out to any number of clients.
+
+    The watcher polls each table for rows past its row_index high-water mark
+    every `interval` seconds, however many clients are connected. Every
+    batch is encoded once and handed to each subscriber queue without
+    waiting; a client whose queue is full is disconnected instead of
+    slowing down the others, and its EventSource reconnects and catches up
+    from its Last-Event-ID.
+    """
+
+    def __init__(self, pool, interval=1.0, batch_size=1000, queue_size=256, keepalive=15.0, log=None):
+        self.__pool = pool
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__queue_size = queue_size
+        self.__keepalive = keepalive
+        self.__log = log or (lambda msg, level="INFO": None)
+
+        self.__marks = None
+        self.__subscribers = set()
+        self.__task = None
+
+        self.__clients = REGISTRY.gauge("delta_feed_clients", "connected delta feed clients")
+        self.__sent = REGISTRY.counter("delta_feed_events", "delta feed events fanned out")
+        self.__dropped = REGISTRY.counter("delta_feed_dropped", "delta feed clients dropped for falling behind")
+
+    async def start(self):
+        async with self.__pool.acquire() as conn:
+            self.__marks = {t: await conn.fetchval(f"SELECT COALESCE(MAX(row_index), 0) FROM {t}") for t in FEED_TABLES}
+        self.__task = asyncio.create_task(self.__watch())
+
+    async def stop(self):
+        if self.__task:
+            self.__task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.__task
+            self.__task = None
+        for queue in list(self.__subscribers):
+            self.__close(queue)
+
+    async def __watch(self):
+        while True:
+            try:
+                async with self.__pool.acquire() as conn:
+                    for table in FEED_TABLES:
+                        rows = await self.__read(conn, table, self.__marks[table])
+                        while rows:
+                            self.__marks[table] = rows[-1]["row_index"]
+                            self.__publish(_event(table, rows, self.__marks))
+                            if len(rows) < self.__batch_size:
+                                break
+                            rows = await self.__read(conn, table, self.__marks[table])
+            except Exception as e:
+                self.__log(f"delta feed failed to read new rows: {e}", "ERROR")
+            await asyncio.sleep(self.__interval)
+
+    async def __read(self, conn, table, after, until=None):
+        if until is None:
+            return await conn.fetch(
+                f"SELECT * FROM {table} WHERE row_index > $1 ORDER BY row_index LIMIT $2", after, self.__batch_size
+            )
+        return await conn.fetch(
+            f"SELECT * FROM {table} WHERE row_index > $1 AND row_index <= $2 ORDER BY row_index LIMIT $3",
+            after, until, self.__batch_size
+        )
+
+    def __publish(self, event: bytes):
+        self.__sent.inc()
+        for queue in list(self.__subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.__dropped.inc()
+                self.__log("delta feed client fell behind, disconnecting it", "WARNING")
+                self.__close(queue)
+
+    def __close(self, queue):
+        self.__subscribers.discard(queue)
+        self.__clients.set(len(self.__subscribers))
+        # wake the client so it sees the end of the feed, dropping what it has not sent
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    @staticmethod
+    def parse_last_id(value):
+        """Marks from a Last-Event-ID header, None when absent or malformed."""
+        try:
+            marks = [int(v) for v in value.split(",")]
+        except (AttributeError, ValueError):
+            return None
+        return dict(zip(FEED_TABLES, marks)) if len(marks) == len(FEED_TABLES) else None
+
+    async def subscribe(self, last_marks=None):
+        """Yield encoded events for one client, first the rows it missed since `last_marks`, then live ones."""
+        queue = asyncio.Queue(self.__queue_size)
+        # registering and taking the marks in one step, every later row arrives through the queue
+        self.__subscribers.add(queue)
+        self.__clients.set(len(self.__subscribers))
+        snapshot = dict(self.__marks)
+        try:
+            if last_marks:
+                async for event in self.__backfill(last_marks, snapshot):
+                    yield event
+            yield f"id: {','.join(str(snapshot[t]) for t in FEED_TABLES)}\nevent: ready\ndata: {{}}\n\n".encode()
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), self.__keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.__subscribers.discard(queue)
+            self.__clients.set(len(self.__subscribers))
+
+    async def __backfill(self, last_marks, snapshot):
+        # tables are caught up in order, so every event id is a point the client can resume from
+        marks = {t: min(last_marks.get(t, 0), snapshot[t]) for t in FEED_TABLES}
+        async with self.__pool.acquire() as conn:
+            for table in FEED_TABLES:
+                while marks[table] < snapshot[table]:
+                    rows = await self.__read(conn, table, marks[table], snapshot[table])
+                    if not rows:
+                        break
+                    marks[table] = rows[-1]["row_index"]
+                    yield _event(table, rows, marks)
+                marks[table] = snapshot[table]
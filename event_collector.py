@@ -3,13 +3,46 @@ import websockets
 import asyncpg
 import json
 import pathlib
+import time
 from datetime import datetime, timezone
+from metrics import REGISTRY
+from counters import COUNTERS_RESET, COUNTERS_UPSERT, CREATE_COUNTERS, EVENT_COUNTERS, counter_rows
+from rollups import RESOLUTIONS, bar_batch, bars_upsert_sql, create_bars_sql
+
+TOKEN_STATS_COLUMNS = (
+    "token_id", "market", "book_count", "price_change_count", "last_trade_count", "tick_size_change_count",
+    "first_server_time", "last_server_time", "last_price", "last_trade_time", "best_bid", "best_ask", "bbo_time",
+)
+
+# counts add up, the last price and BBO only move forward in server time
+TOKEN_STATS_UPSERT = f"""
+    INSERT INTO token_stats ({", ".join(TOKEN_STATS_COLUMNS)})
+    VALUES ({", ".join(f"${i + 1}" for i in range(len(TOKEN_STATS_COLUMNS)))})
+    ON CONFLICT (token_id) DO UPDATE SET
+        market = COALESCE(EXCLUDED.market, token_stats.market),
+        book_count = token_stats.book_count + EXCLUDED.book_count,
+        price_change_count = token_stats.price_change_count + EXCLUDED.price_change_count,
+        last_trade_count = token_stats.last_trade_count + EXCLUDED.last_trade_count,
+        tick_size_change_count = token_stats.tick_size_change_count + EXCLUDED.tick_size_change_count,
+        first_server_time = LEAST(token_stats.first_server_time, EXCLUDED.first_server_time),
+        last_server_time = GREATEST(token_stats.last_server_time, EXCLUDED.last_server_time),
+        last_price = CASE WHEN EXCLUDED.last_trade_time >= COALESCE(token_stats.last_trade_time, EXCLUDED.last_trade_time)
+            THEN EXCLUDED.last_price ELSE token_stats.last_price END,
+        last_trade_time = GREATEST(token_stats.last_trade_time, EXCLUDED.last_trade_time),
+        best_bid = CASE WHEN EXCLUDED.bbo_time >= COALESCE(token_stats.bbo_time, EXCLUDED.bbo_time)
+            THEN EXCLUDED.best_bid ELSE token_stats.best_bid END,
+        best_ask = CASE WHEN EXCLUDED.bbo_time >= COALESCE(token_stats.bbo_time, EXCLUDED.bbo_time)
+            THEN EXCLUDED.best_ask ELSE token_stats.best_ask END,
+        bbo_time = GREATEST(token_stats.bbo_time, EXCLUDED.bbo_time),
+        update_time = now()
+"""
 
 
 class event_collector:
-    def __init__(self, data_dir="data", verbosity="DEBUG", reset=True):
-        # DB
-        self.__db_pool = None
+    def __init__(self, data_dir="data", verbosity="DEBUG", reset=True, db_pool=None):
+        # DB, a pool injected by collection_manager is shared and never closed here
+        self.__db_pool = db_pool
+        self.__owns_pool = db_pool is None
         self.__token_ids = []
         self.__last_market_row = 0
         self.__reset = reset
@@ -28,27 +61,43 @@ class event_collector:
 
         # Version
         self.__version = 1
+        self.__bars_upserts = {table: bars_upsert_sql(table) for table in RESOLUTIONS}
 
         # Async tasks
         self.__market_task = None
         self.__ws_task = None
 
+        # Metrics
+        self.__messages = REGISTRY.counter("event_collector_messages", "websocket messages received")
+        self.__events = {
+            event_type: REGISTRY.counter("event_collector_events", "events received by type", event_type=event_type)
+            for event_type in ("book", "price_change", "last_trade_price", "tick_size_change")
+        }
+        self.__insert_latency = REGISTRY.histogram("event_collector_insert_seconds", "latency of inserting one websocket message")
+        # the collector inserts inline, so receive lag is where a backlog shows up
+        self.__receive_lag = REGISTRY.histogram(
+            "event_collector_receive_lag_seconds", "local receive time minus server timestamp",
+            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+        self.__subscribed = REGISTRY.gauge("event_collector_subscribed_tokens", "tokens in the current subscription")
+        self.__resubscriptions = REGISTRY.counter("event_collector_resubscriptions", "websocket resubscriptions")
+
     async def start(self) -> bool:
         if self.__running:
             self.__log("event_collector already started", "ERROR")
             return False
 
         try:
-            socket_dir = str(pathlib.Path("../.pgsocket").resolve())
-            self.__db_pool = await asyncpg.create_pool(
-                user="client",
-                password="clientpass",
-                database="data",
-                host=socket_dir,
-                port=5432,
-                min_size=1,
-                max_size=10,
-            )
+            if self.__owns_pool:
+                socket_dir = str(pathlib.Path("../.pgsocket").resolve())
+                self.__db_pool = await asyncpg.create_pool(
+                    user="client",
+                    password="clientpass",
+                    database="data",
+                    host=socket_dir,
+                    port=5432,
+                    min_size=1,
+                    max_size=10,
+                )
 
             if self.__reset:
                 async with self.__db_pool.acquire() as conn:
@@ -56,7 +105,8 @@ class event_collector:
                         DROP TABLE IF EXISTS changes;
                         DROP TABLE IF EXISTS books;
                         DROP TABLE IF EXISTS tick_changes;
-                    """)
+                        DROP TABLE IF EXISTS token_stats;
+                    """ + "".join(f"DROP TABLE IF EXISTS {table};" for table in RESOLUTIONS))
 
             async with self.__db_pool.acquire() as conn:
                 await conn.execute("""
@@ -95,7 +145,34 @@ class event_collector:
                         new_tick_size REAL,
                         server_time BIGINT
                     );
+                    -- one row per token, maintained by __insert so readers never count event rows
+                    CREATE TABLE IF NOT EXISTS token_stats (
+                        token_id VARCHAR(100) PRIMARY KEY,
+                        market VARCHAR(100),
+                        book_count BIGINT DEFAULT 0,
+                        price_change_count BIGINT DEFAULT 0,
+                        last_trade_count BIGINT DEFAULT 0,
+                        tick_size_change_count BIGINT DEFAULT 0,
+                        first_server_time BIGINT,
+                        last_server_time BIGINT,
+                        last_price REAL,
+                        last_trade_time BIGINT,
+                        best_bid REAL,
+                        best_ask REAL,
+                        bbo_time BIGINT,
+                        update_time TIMESTAMP(3) WITH TIME ZONE DEFAULT now()
+                    );
+                    -- analytics and the web server look events up per token and time
+                    CREATE INDEX IF NOT EXISTS changes_token_time ON changes (token_id, server_time);
+                    CREATE INDEX IF NOT EXISTS books_token_time ON books (token_id, server_time);
+                    CREATE INDEX IF NOT EXISTS tick_changes_token_time ON tick_changes (token_id, server_time);
                 """)
+                # OHLCV bars per token, maintained by __insert like token_stats
+                await conn.execute(create_bars_sql())
+                # global totals for the dashboard
+                await conn.execute(CREATE_COUNTERS)
+                if self.__reset:
+                    await conn.execute(COUNTERS_RESET, list(EVENT_COUNTERS))
 
         except Exception as e:
             self.__log(f"event_collector failed to start: {e}", "ERROR")
@@ -131,7 +208,7 @@ class event_collector:
                 self.__log(f"event_collector closing websocket client: {e}", "ERROR")
             self.__events_cli = None
 
-        if self.__db_pool:
+        if self.__db_pool and self.__owns_pool:
             await self.__db_pool.close()
             self.__db_pool = None
             self.__log("event_collector closed DB pool", "DEBUG")
@@ -215,6 +292,8 @@ class event_collector:
 
             self.__events_cli = new_cli
             self.__resubscription_count += 1
+            self.__resubscriptions.inc()
+            self.__subscribed.set(len(subscription["assets_ids"]))
             self.__log(f"market_collector resubscription {self.__resubscription_count} complete", "INFO")
             return True
 
@@ -226,10 +305,13 @@ class event_collector:
         try:
             async for message in self.__events_cli:
                 self.__log(f"event_collector raw message: {message}", "DEBUG")
+                self.__messages.inc()
                 msg_json = json.loads(message)
+                insert_start = time.perf_counter()
                 if not await self.__insert(msg_json):
                     self.__log("event_collector failed to insert", "ERROR")
                     return False
+                self.__insert_latency.observe(time.perf_counter() - insert_start)
             return True
         except websockets.exceptions.ConnectionClosed:
             self.__log("WebSocket closed, will attempt reconnect and resubscribe", "WARNING")
@@ -238,6 +320,29 @@ class event_collector:
     # ------------------------------
     # Insert into DB
     # ------------------------------
+    @staticmethod
+    def __count(stats, token, market, column, ts) -> dict:
+        """Add one event to the token_stats delta of this message."""
+        entry = stats.get(token)
+        if entry is None:
+            entry = dict.fromkeys(TOKEN_STATS_COLUMNS)
+            entry.update(token_id=token, market=market, book_count=0, price_change_count=0,
+                         last_trade_count=0, tick_size_change_count=0)
+            stats[token] = entry
+        entry[column] += 1
+        if ts is not None:
+            entry["first_server_time"] = min(entry["first_server_time"] or ts, ts)
+            entry["last_server_time"] = max(entry["last_server_time"] or ts, ts)
+        return entry
+
+    @staticmethod
+    def __bbo(stats, token, ts, best_bid, best_ask):
+        entry = stats[token]
+        if ts is not None and ts >= (entry["bbo_time"] or ts):
+            entry["best_bid"] = best_bid
+            entry["best_ask"] = best_ask
+            entry["bbo_time"] = ts
+
     async def __insert(self, msg_json) -> bool:
         if isinstance(msg_json, dict):
             msg_json = [msg_json]
@@ -272,16 +377,30 @@ class event_collector:
             except:
                 return None
 
+        now_ms = time.time() * 1000
+        stats = {}
+        bars = bar_batch()
         try:
-            async with self.__db_pool.acquire() as conn:
+            async with self.__db_pool.acquire() as conn, conn.transaction():
                 for obj in msg_json:
                     token = obj.get("asset_id")
                     event_type = obj.get("event_type")
                     market = obj.get("market")
                     collector_version = self.__version
                     ts = cast_int(obj.get("timestamp"))
+                    if ts is not None:
+                        self.__receive_lag.observe((now_ms - ts) / 1000)
+                    if event_type in self.__events:
+                        self.__events[event_type].inc()
 
                     if event_type == "book" and token:
+                        bids, asks = obj.get("bids") or [], obj.get("asks") or []
+                        self.__count(stats, token, market, "book_count", ts)
+                        bid_prices = [p for p in (cast_float(b.get("price")) for b in bids) if p is not None]
+                        ask_prices = [p for p in (cast_float(a.get("price")) for a in asks) if p is not None]
+                        best_bid, best_ask = max(bid_prices, default=None), min(ask_prices, default=None)
+                        self.__bbo(stats, token, ts, best_bid, best_ask)
+                        bars.mid(token, ts, best_bid, best_ask)
                         await conn.execute(
                             """INSERT INTO books (collector_version, market, token_id, bids, asks, server_time)
                             VALUES ($1,$2,$3,$4,$5,$6)""",
@@ -291,6 +410,10 @@ class event_collector:
                     elif event_type == "price_change" and token:
                         for change in obj.get("price_changes", []):
                             token_change = change.get("asset_id")
+                            if token_change:
+                                self.__count(stats, token_change, market, "price_change_count", ts)
+                                self.__bbo(stats, token_change, ts, cast_float(change.get("best_bid")), cast_float(change.get("best_ask")))
+                                bars.mid(token_change, ts, cast_float(change.get("best_bid")), cast_float(change.get("best_ask")))
                             await conn.execute(
                                 """INSERT INTO changes
                                 (collector_version, market, token_id, event_type, price, size, side, best_bid, best_ask, server_time)
@@ -301,6 +424,11 @@ class event_collector:
                             )
 
                     elif event_type == "last_trade_price" and token:
+                        entry = self.__count(stats, token, market, "last_trade_count", ts)
+                        if ts is not None and ts >= (entry["last_trade_time"] or ts):
+                            entry["last_price"] = cast_float(obj.get("price"))
+                            entry["last_trade_time"] = ts
+                        bars.trade(token, ts, cast_float(obj.get("size")))
                         await conn.execute(
                             """INSERT INTO changes
                             (collector_version, market, token_id, event_type, fee_rate_bps, price, side, size, server_time)
@@ -311,6 +439,7 @@ class event_collector:
                         )
 
                     elif event_type == "tick_size_change" and token:
+                        self.__count(stats, token, market, "tick_size_change_count", ts)
                         await conn.execute(
                             """INSERT INTO tick_changes
                             (collector_version, market, token_id, old_tick_size, new_tick_size, server_time)
@@ -319,6 +448,22 @@ class event_collector:
                             cast_float(obj.get("new_tick_size")), ts
                         )
 
+                if stats:
+                    await conn.executemany(TOKEN_STATS_UPSERT, [
+                        tuple(entry[column] for column in TOKEN_STATS_COLUMNS) for entry in stats.values()
+                    ])
+                for table, rows in bars.rows():
+                    await conn.executemany(self.__bars_upserts[table], rows)
+                counts = {column: sum(entry[column] for entry in stats.values()) for column in
+                          ("book_count", "price_change_count", "last_trade_count", "tick_size_change_count")}
+                await conn.executemany(COUNTERS_UPSERT, counter_rows({
+                    "events": sum(counts.values()),
+                    "books": counts["book_count"],
+                    "price_changes": counts["price_change_count"],
+                    "last_trades": counts["last_trade_count"],
+                    "tick_size_changes": counts["tick_size_change_count"],
+                }))
+
             return True
 
         except Exception as e:
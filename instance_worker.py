@@ -0,0 +1,391 @@
+import asyncio
+import itertools
+import multiprocessing
+import sys
+import importlib
+import time
+import traceback
+
+from task_supervisor import supervised_task
+from metrics import REGISTRY
+from resources import create_resource, close_resource
+from loop_monitor import loop_monitor
+import profiler
+
+# supervised_task options that are forwarded from an invoke_function message
+SUPERVISION_FIELDS = ("restart", "max_restarts", "backoff_initial", "backoff_max", "cleanup_function")
+
+
+# ------------------------------
+# Worker process side
+# ------------------------------
+class instance_worker:
+    """Hosts a single collector instance in its own process and event loop.
+
+    Commands arrive over a multiprocessing pipe as dicts with an "id" and an
+    "op"; every command is answered with a dict carrying the same id and the
+    same status/error fields the manager sends to its clients.
+    """
+
+    def __init__(self, conn, instance_name, class_name, code, args, dependencies, resource_specs):
+        self.conn = conn
+        self.instance_name = instance_name
+        self.class_name = class_name
+        self.code = code
+        self.args = args
+        self.dependencies = dependencies
+        # kwarg -> (kind, options); connections cannot cross processes, so the
+        # worker opens its own copy of each shared resource
+        self.resource_specs = resource_specs
+        self.resources = {}
+        self.instance = None
+        self.task = None
+        self.done = None
+        self.loop_monitor = None
+
+    async def create(self) -> dict:
+        try:
+            for dep in self.dependencies:
+                if dep not in sys.modules:
+                    importlib.import_module(dep)
+            namespace = {}
+            exec(self.code, namespace)
+            cls = namespace.get(self.class_name)
+            if cls is None or not isinstance(cls, type):
+                return {"status": "failure", "error": f"Class {self.class_name} not found"}
+            for kwarg, (kind, options) in self.resource_specs.items():
+                self.resources[kwarg] = (kind, await create_resource(kind, options))
+            self.instance = cls(**self.args, **{kwarg: obj for kwarg, (kind, obj) in self.resources.items()})
+        except Exception as e:
+            return {"status": "failure", "error": f"Failed to create instance in worker: {e}", "traceback": traceback.format_exc()}
+        return {"status": "success"}
+
+    async def close_resources(self):
+        for kwarg, (kind, obj) in self.resources.items():
+            try:
+                await close_resource(kind, obj)
+            except Exception as e:
+                print(f"[Worker {self.instance_name}] Failed to close resource {kwarg}: {e}")
+        self.resources = {}
+
+    async def run(self):
+        ready = await self.create()
+        ready["id"] = 0
+        self.conn.send(ready)
+        try:
+            if ready["status"] == "success":
+                await self.serve()
+        finally:
+            await self.close_resources()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        loop.add_reader(self.conn.fileno(), self.__on_readable)
+        try:
+            await self.done
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            if self.task is not None and self.task.active():
+                await self.task.cancel()
+            if self.loop_monitor is not None:
+                await self.loop_monitor.stop()
+
+    def __on_readable(self):
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                asyncio.create_task(self.__dispatch(msg))
+        except (EOFError, OSError):
+            # manager went away, nothing left to serve
+            if not self.done.done():
+                self.done.set_result(None)
+
+    def __reply(self, msg, obj):
+        obj["id"] = msg.get("id")
+        try:
+            self.conn.send(obj)
+        except (BrokenPipeError, OSError):
+            pass
+
+    async def __dispatch(self, msg):
+        op = msg.get("op")
+        try:
+            if op == "invoke":
+                resp = await self.__invoke(msg)
+            elif op == "status":
+                resp = {"status": "success", "task": self.task.status() if self.task is not None else None}
+            elif op == "stats":
+                resp = {"status": "success", "stats": REGISTRY.snapshot(msg.get("consumer", "default"))}
+            elif op == "monitor_loop":
+                resp = await self.__monitor_loop(msg)
+            elif op == "profile":
+                resp = await self.__profile(msg)
+            elif op == "cancel":
+                if self.task is None or not self.task.active():
+                    resp = {"status": "failure", "error": f"Instance {self.instance_name} is not running"}
+                else:
+                    await self.task.cancel()
+                    resp = {"status": "success", "message": f"Cancelled {self.task.name}", "task": self.task.status()}
+            elif op == "destroy":
+                if self.task is not None and self.task.active():
+                    await self.task.cancel()
+                resp = {"status": "success", "message": f"Instance {self.instance_name} destroyed"}
+                self.__reply(msg, resp)
+                self.done.set_result(None)
+                return
+            else:
+                resp = {"status": "failure", "error": f"Unknown worker op: {op}"}
+        except Exception as e:
+            resp = {"status": "failure", "error": f"Exception in worker handler: {e}", "traceback": traceback.format_exc()}
+        self.__reply(msg, resp)
+
+    async def __monitor_loop(self, msg) -> dict:
+        action = msg.get("action", "report")
+        if action == "enable":
+            if self.loop_monitor is None:
+                self.loop_monitor = loop_monitor(
+                    interval=msg.get("interval_ms", 50) / 1000,
+                    threshold=msg.get("threshold_ms", 100) / 1000
+                )
+                self.loop_monitor.watch(self.instance_name, self.instance)
+                self.loop_monitor.start()
+            return {"status": "success", "message": f"Loop monitor enabled for {self.instance_name}"}
+        if action == "disable":
+            if self.loop_monitor is not None:
+                await self.loop_monitor.stop()
+                self.loop_monitor = None
+            return {"status": "success", "message": f"Loop monitor disabled for {self.instance_name}"}
+        if action == "report":
+            if self.loop_monitor is None:
+                return {"status": "failure", "error": f"Loop monitor not enabled for {self.instance_name}"}
+            return {"status": "success", "report": self.loop_monitor.report()}
+        return {"status": "failure", "error": f"Unknown monitor_loop action: {action}"}
+
+    async def __profile(self, msg) -> dict:
+        try:
+            result = await profiler.profile(
+                {self.instance_name: self.instance},
+                seconds=msg.get("seconds", 10),
+                mode=msg.get("mode", "sampling"),
+                interval=msg.get("interval_ms", 5) / 1000,
+                output_dir=msg.get("output_dir"),
+                top=msg.get("top", 30),
+                name=self.instance_name
+            )
+        except ValueError as e:
+            return {"status": "failure", "error": str(e)}
+        return {"status": "success", "profile": result}
+
+    async def __invoke(self, msg) -> dict:
+        func_name = msg.get("function_name")
+        args = msg.get("args", {})
+        if not hasattr(self.instance, func_name):
+            return {"status": "failure", "error": f"Instance {self.instance_name} has no function {func_name}"}
+        func = getattr(self.instance, func_name)
+
+        if msg.get("background", False):
+            if self.task is not None and self.task.active():
+                return {"status": "failure", "error": f"Instance {self.instance_name} is already running {self.task.name}"}
+            cleanup_name = msg.get("cleanup_function")
+            if cleanup_name is not None and not hasattr(self.instance, cleanup_name):
+                return {"status": "failure", "error": f"Instance {self.instance_name} has no function {cleanup_name}"}
+            try:
+                self.task = supervised_task(
+                    name=f"{self.instance_name}.{func_name}",
+                    func=func,
+                    args=args,
+                    restart=msg.get("restart", "never"),
+                    max_restarts=msg.get("max_restarts"),
+                    backoff_initial=msg.get("backoff_initial", 1.0),
+                    backoff_max=msg.get("backoff_max", 60.0),
+                    cleanup=getattr(self.instance, cleanup_name) if cleanup_name is not None else None
+                )
+            except ValueError as e:
+                return {"status": "failure", "error": str(e)}
+            self.task.start()
+            return {"status": "success", "message": f"Spawned {func_name} on {self.instance_name}", "task": self.task.status()}
+
+        try:
+            if asyncio.iscoroutinefunction(func):
+                result = await func(**args)
+            else:
+                result = func(**args)
+            return {"status": "success", "message": f"Invoked {func_name} on {self.instance_name}", "result": result}
+        except Exception as e:
+            return {"status": "failure", "error": f"Failed to invoke {func_name}: {e}", "traceback": traceback.format_exc()}
+
+
+def worker_main(conn, instance_name, class_name, code, args, dependencies, resource_specs):
+    worker = instance_worker(conn, instance_name, class_name, code, args, dependencies, resource_specs)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+# ------------------------------
+# Manager side
+# ------------------------------
+class worker_proxy:
+    """Manager-side handle of an instance that lives in a worker process.
+
+    Requests are proxied over a pipe. If the process dies without being
+    destroyed it is respawned with exponential backoff and the last background
+    invocation is issued again, so a supervised start() survives hard crashes
+    (segfaults, OOM kills) as well as exceptions.
+    """
+
+    def __init__(self, instance_name, class_name, code, args, dependencies=None, resource_specs=None,
+                 restart=True, backoff_initial=1.0, backoff_max=60.0):
+        self.instance_name = instance_name
+        self.class_name = class_name
+        self.code = code
+        self.args = args
+        self.dependencies = dependencies or []
+        self.resource_specs = resource_specs or {}
+        self.restart = restart
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.process = None
+        self.start_time = None
+        self.restarts = 0
+        self.exit_code = None
+        self.background = None
+
+        self.__crashes = 0
+
+        self.__conn = None
+        self.__pending = {}
+        self.__ids = itertools.count(1)
+        self.__destroyed = False
+        self.__respawn_task = None
+
+    async def start(self) -> dict:
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=worker_main,
+            args=(child_conn, self.instance_name, self.class_name, self.code, self.args, self.dependencies, self.resource_specs),
+            name=f"collection_manager:{self.instance_name}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.__conn = parent_conn
+        self.start_time = time.time()
+        self.exit_code = None
+
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        self.__pending[0] = ready
+        loop.add_reader(self.__conn.fileno(), self.__on_readable)
+        return await ready
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def info(self) -> dict:
+        return {
+            "pid": self.process.pid if self.process is not None else None,
+            "alive": self.alive(),
+            "start_time": self.start_time,
+            "restarts": self.restarts,
+            "exit_code": self.exit_code,
+        }
+
+    async def request(self, op, **fields) -> dict:
+        if self.__conn is None:
+            return {"status": "failure", "error": f"Worker for {self.instance_name} is not running"}
+        request_id = next(self.__ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[request_id] = future
+        try:
+            self.__conn.send(dict(fields, op=op, id=request_id))
+            resp = await future
+        except (BrokenPipeError, OSError, EOFError) as e:
+            return {"status": "failure", "error": f"Worker for {self.instance_name} is unreachable: {e}"}
+        finally:
+            self.__pending.pop(request_id, None)
+
+        if op == "invoke" and fields.get("background") and resp.get("status") == "success":
+            self.background = fields
+        elif op == "cancel" and resp.get("status") == "success":
+            self.background = None
+        return resp
+
+    async def destroy(self, timeout=5.0) -> dict:
+        self.__destroyed = True
+        if self.__respawn_task is not None:
+            self.__respawn_task.cancel()
+        resp = await self.request("destroy")
+        loop = asyncio.get_running_loop()
+        if self.process is not None and self.process.pid is not None:
+            await loop.run_in_executor(None, self.process.join, timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                await loop.run_in_executor(None, self.process.join, timeout)
+        self.__close_conn()
+        return resp
+
+    def __on_readable(self):
+        try:
+            while self.__conn is not None and self.__conn.poll():
+                resp = self.__conn.recv()
+                future = self.__pending.get(resp.pop("id", None))
+                if future is not None and not future.done():
+                    future.set_result(resp)
+        except (EOFError, OSError):
+            self.__on_worker_exit()
+
+    def __close_conn(self):
+        if self.__conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self.__conn.fileno())
+        except (ValueError, OSError):
+            pass
+        self.__conn.close()
+        self.__conn = None
+
+    def __on_worker_exit(self):
+        self.__close_conn()
+        self.__respawn_task = asyncio.create_task(self.__reap())
+
+    async def __reap(self, timeout=5.0):
+        # the pipe closes before the child is reaped, exitcode is only set once join returns
+        try:
+            if self.process is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.process.join, timeout)
+                self.exit_code = self.process.exitcode
+        finally:
+            for future in self.__pending.values():
+                if not future.done():
+                    future.set_result({"status": "failure", "error": f"Worker for {self.instance_name} exited with code {self.exit_code}"})
+        if self.__destroyed or not self.restart:
+            return
+        print(f"[Server] Worker for {self.instance_name} died with exit code {self.exit_code}")
+        await self.__respawn()
+
+    async def __respawn(self):
+        # runs shorter than the backoff cap count as consecutive crashes
+        if time.time() - self.start_time >= self.backoff_max:
+            self.__crashes = 0
+        delay = min(self.backoff_initial * (2 ** self.__crashes), self.backoff_max)
+        self.__crashes += 1
+        await asyncio.sleep(delay)
+        if self.__destroyed:
+            return
+        self.restarts += 1
+        resp = await self.start()
+        if resp.get("status") != "success":
+            print(f"[Server] Worker for {self.instance_name} failed to restart: {resp.get('error')}")
+            return
+        print(f"[Server] Worker for {self.instance_name} restarted as pid {self.process.pid}")
+        if self.background is not None:
+            resp = await self.request("invoke", **self.background)
+            if resp.get("status") != "success":
+                print(f"[Server] Worker for {self.instance_name} failed to resume {self.background.get('function_name')}: {resp.get('error')}")
@@ -0,0 +1,220 @@
+import asyncio
+import contextlib
+import json
+
+import websockets
+
+from book_distance import BID
+from book_metrics import DEFAULT_TICK, top_of_book
+from book_replay import SIDES, levels_from_json
+from metrics import REGISTRY
+
+EVENTS_URL = "wss://ws-subscriptions-clob.polymarket.com/ws/market"
+
+
+class book_client:
+    """One websocket client of live_books, with its own token set and update rate.
+
+    Ingestion only marks the client's tokens dirty; updates() sends the
+    latest state of every dirty token at most max_rate times a second, so
+    however many events arrive in between, a client gets one update per
+    token and a slow client only falls behind itself.
+    """
+
+    def __init__(self, books, max_rate=5.0):
+        self.tokens = set()
+        self.max_rate = max_rate
+        self.__books = books
+        self.__dirty = set()
+        self.__ready = asyncio.Event()
+
+    def mark(self, token):
+        self.__dirty.add(token)
+        self.__ready.set()
+
+    async def updates(self):
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+            dirty, self.__dirty = self.__dirty, set()
+            tops = [top for top in (self.__books.top(t) for t in dirty if t in self.tokens) if top is not None]
+            if tops:
+                yield tops
+            await asyncio.sleep(1 / self.max_rate)
+
+
+class live_books:
+    """In-process books for the tokens web clients are subscribed to, fed by the CLOB market websocket.
+
+    The websocket subscription follows the union of the clients' tokens and
+    is renewed shortly after that union changes. Books follow the same
+    semantics as the analytics replay: a book message replaces a token's
+    levels, price_change adds its size to a level, last_trade_price
+    subtracts it.
+    """
+
+    def __init__(self, url=EVENTS_URL, max_tokens=500, depth_ticks=5, resubscribe_delay=0.5, log=None):
+        self.__url = url
+        self.__max_tokens = max_tokens
+        self.__depth_ticks = depth_ticks
+        self.__resubscribe_delay = resubscribe_delay
+        self.__log = log or (lambda msg, level="INFO": None)
+
+        self.__books = {}  # token -> (bids, asks)
+        self.__ticks = {}
+        self.__tops = {}
+        self.__clients = set()
+        self.__watchers = {}  # token -> clients subscribed to it
+        self.__changed = asyncio.Event()
+        self.__running = False
+        self.__task = None
+
+        self.__messages = REGISTRY.counter("live_books_messages", "market websocket messages applied to live books")
+        self.__tokens = REGISTRY.gauge("live_books_tokens", "tokens with a live book")
+        self.__n_clients = REGISTRY.gauge("live_books_clients", "connected live book clients")
+
+    async def start(self):
+        self.__running = True
+        self.__task = asyncio.create_task(self.__ws_loop())
+
+    async def stop(self):
+        self.__running = False
+        if self.__task:
+            self.__task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.__task
+            self.__task = None
+
+    # ---- clients ----
+
+    def client(self, max_rate=5.0) -> book_client:
+        client = book_client(self, max_rate)
+        self.__clients.add(client)
+        self.__n_clients.set(len(self.__clients))
+        return client
+
+    def remove(self, client):
+        self.unsubscribe(client, list(client.tokens))
+        self.__clients.discard(client)
+        self.__n_clients.set(len(self.__clients))
+
+    def subscribe(self, client, tokens) -> list:
+        """Add tokens to a client, returns the ones refused because max_tokens are already live."""
+        refused = []
+        for token in tokens:
+            if token not in self.__watchers:
+                if len(self.__watchers) >= self.__max_tokens:
+                    refused.append(token)
+                    continue
+                self.__watchers[token] = set()
+                self.__changed.set()
+            self.__watchers[token].add(client)
+            client.tokens.add(token)
+            if token in self.__tops:
+                client.mark(token)
+        return refused
+
+    def unsubscribe(self, client, tokens):
+        for token in tokens:
+            client.tokens.discard(token)
+            watchers = self.__watchers.get(token)
+            if watchers is None:
+                continue
+            watchers.discard(client)
+            if not watchers:
+                del self.__watchers[token]
+                for state in (self.__books, self.__ticks, self.__tops):
+                    state.pop(token, None)
+                self.__changed.set()
+        self.__tokens.set(len(self.__books))
+
+    def top(self, token):
+        top = self.__tops.get(token)
+        return None if top is None else {"token_id": token, **top}
+
+    # ---- ingestion ----
+
+    async def __ws_loop(self):
+        while self.__running:
+            await self.__changed.wait()
+            # let a burst of subscriptions settle into one websocket subscription
+            await asyncio.sleep(self.__resubscribe_delay)
+            self.__changed.clear()
+            tokens = list(self.__watchers)
+            if not tokens:
+                continue
+            try:
+                async with websockets.connect(self.__url, ping_interval=20, ping_timeout=5) as ws:
+                    await ws.send(json.dumps({"type": "market", "initial_dump": True, "assets_ids": tokens}))
+                    self.__log(f"live books subscribed to {len(tokens)} tokens", "DEBUG")
+                    await self.__read(ws)
+            except Exception as e:
+                self.__log(f"live books websocket error: {e}, reconnecting", "WARNING")
+                self.__changed.set()
+                await asyncio.sleep(1)
+
+    async def __read(self, ws):
+        changed = asyncio.create_task(self.__changed.wait())
+        receive = None
+        try:
+            while not changed.done():
+                receive = asyncio.create_task(ws.recv())
+                await asyncio.wait((receive, changed), return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    break
+                self.__apply(json.loads(receive.result()))
+        finally:
+            changed.cancel()
+            if receive is not None and not receive.done():
+                receive.cancel()
+
+    def __apply(self, msg):
+        self.__messages.inc()
+        touched = {}  # token -> server time of its latest event
+        for obj in msg if isinstance(msg, list) else [msg]:
+            event_type = obj.get("event_type")
+            token = obj.get("asset_id")
+            ts = obj.get("timestamp")
+            if event_type == "book" and token in self.__watchers:
+                self.__books[token] = (levels_from_json(obj.get("bids")), levels_from_json(obj.get("asks")))
+                touched[token] = ts
+            elif event_type == "price_change":
+                for change in obj.get("price_changes", []):
+                    if self.__update(change.get("asset_id"), change, 1.0):
+                        touched[change["asset_id"]] = ts
+            elif event_type == "last_trade_price":
+                if self.__update(token, obj, -1.0):
+                    touched[token] = ts
+            elif event_type == "tick_size_change" and token in self.__watchers:
+                with contextlib.suppress(TypeError, ValueError):
+                    self.__ticks[token] = float(obj.get("new_tick_size"))
+                    touched[token] = ts
+
+        for token, ts in touched.items():
+            if token not in self.__books:
+                continue
+            bids, asks = self.__books[token]
+            top = top_of_book(bids, asks, self.__ticks.get(token, DEFAULT_TICK), self.__depth_ticks)
+            top["server_time"] = int(ts) if ts else None
+            self.__tops[token] = top
+            for client in self.__watchers.get(token, ()):
+                client.mark(token)
+        self.__tokens.set(len(self.__books))
+
+    def __update(self, token, obj, sign) -> bool:
+        book = self.__books.get(token)
+        side = SIDES.get(obj.get("side"))
+        if book is None or side is None:
+            # nothing to apply a change to before the first book message
+            return False
+        try:
+            price, size = float(obj["price"]), float(obj["size"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        levels = book[0] if side == BID else book[1]
+        size = levels.get(price, 0.0) + sign * size
+        if size > 0:
+            levels[price] = size
+        else:
+            levels.pop(price, None)
+        return True
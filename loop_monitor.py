@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import inspect
+import sys
+import threading
+import time
+import traceback
+
+from metrics import REGISTRY
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def owner_of(frames, watched):
+    """Name of the watched instance whose methods appear in the stack, innermost first."""
+    for frame in reversed(frames):
+        owner = frame.f_locals.get("self")
+        if owner is None:
+            continue
+        for name, instance in watched.items():
+            if owner is instance:
+                return name
+    return None
+
+
+def stack_of(frame, limit):
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames[-limit:]
+
+
+class loop_monitor:
+    """Measures event loop scheduling delay and captures what blocked it.
+
+    A heartbeat coroutine sleeps for `interval` and records how late it woke
+    up. A watchdog thread notices when the heartbeat is overdue by more than
+    `threshold` while the loop is still blocked, samples the loop thread's
+    stack and attributes the stall to the watched instance whose method is
+    on that stack.
+    """
+
+    def __init__(self, interval=0.05, threshold=0.1, max_records=200, stack_limit=40):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_limit = stack_limit
+        self.records = collections.deque(maxlen=max_records)
+        self.watched = {}
+        self.max_lag = 0.0
+
+        self.__lag = REGISTRY.histogram("event_loop_lag_seconds", "event loop scheduling delay", buckets=LAG_BUCKETS)
+        self.__slow = REGISTRY.counter("event_loop_slow_callbacks", "loop stalls longer than the monitor threshold")
+
+        self.__loop = None
+        self.__loop_thread_id = None
+        self.__heartbeat_task = None
+        self.__watchdog = None
+        self.__stopped = threading.Event()
+        self.__beat = time.monotonic()
+        self.__pending = None
+
+    def watch(self, name, instance):
+        self.watched[name] = instance
+
+    def unwatch(self, name):
+        self.watched.pop(name, None)
+
+    def running(self) -> bool:
+        return self.__heartbeat_task is not None and not self.__heartbeat_task.done()
+
+    def start(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__loop_thread_id = threading.get_ident()
+        self.__stopped.clear()
+        self.__beat = time.monotonic()
+        self.__heartbeat_task = asyncio.create_task(self.__heartbeat(), name="loop_monitor.heartbeat")
+        self.__watchdog = threading.Thread(target=self.__watch_loop, name="loop_monitor.watchdog", daemon=True)
+        self.__watchdog.start()
+
+    async def stop(self):
+        self.__stopped.set()
+        if self.__heartbeat_task is not None:
+            self.__heartbeat_task.cancel()
+            try:
+                await self.__heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.__heartbeat_task = None
+        if self.__watchdog is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.__watchdog.join)
+            self.__watchdog = None
+
+    def report(self, name=None) -> dict:
+        records = [r for r in self.records if name is None or r["instance"] in (name, None)]
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "watched": sorted(self.watched),
+            "lag_p50": self.__lag.quantile(0.5),
+            "lag_p99": self.__lag.quantile(0.99),
+            "max_lag": self.max_lag,
+            "slow_callbacks": self.__slow.value,
+            "records": records,
+        }
+
+    async def __heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self.__beat = now
+            self.__lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            pending = self.__pending
+            if pending is not None:
+                # the stall is over, record how long it actually lasted
+                pending["lag"] = lag
+                self.__pending = None
+
+    def __watch_loop(self):
+        poll = min(self.interval, self.threshold) / 2
+        while not self.__stopped.wait(poll):
+            overdue = time.monotonic() - self.__beat - self.interval
+            if overdue < self.threshold or self.__pending is not None:
+                continue
+            # only one sample per stall, the heartbeat clears __pending when the loop recovers
+            record = self.__sample(overdue)
+            if record is not None:
+                self.__slow.inc()
+                self.records.append(record)
+                self.__pending = record
+
+    def __sample(self, overdue):
+        frame = sys._current_frames().get(self.__loop_thread_id)
+        if frame is None:
+            return None
+        frames = stack_of(frame, self.stack_limit)
+        task = asyncio.current_task(self.__loop)
+        coroutine = None
+        for f in reversed(frames):
+            if f.f_code.co_flags & inspect.CO_COROUTINE:
+                coroutine = f.f_code.co_qualname
+                break
+        return {
+            "time": time.time(),
+            "lag": overdue,
+            "instance": owner_of(frames, self.watched),
+            "task": task.get_name() if task is not None else None,
+            "coroutine": coroutine,
+            "stack": traceback.format_list(traceback.extract_stack(frame, limit=self.stack_limit)),
+        }
@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+
+# gamma market key -> attributes column and query type, the web query DSL
+# exposes each one as MARKET_<key>
+ATTRIBUTES = [
+    ("id", "market_id", "string"),
+    ("conditionId", "condition_id", "string"),
+    ("question", "question", "string"),
+    ("questionID", "question_id", "string"),
+    ("negRiskMarketID", "negrisk_id", "string"),
+    ("umaResolutionStatuses", "uma_resolution_statuses", "string"),
+    ("umaBond", "uma_bond", "number"),
+    ("umaReward", "uma_reward", "number"),
+    ("orderPriceMinTickSize", "order_price_min_tick_size", "number"),
+    ("orderMinSize", "order_min_size", "number"),
+    ("customLiveness", "custom_liveness", "number"),
+    ("competitive", "competitive", "number"),
+    ("rewardsMinSize", "rewards_min_size", "number"),
+    ("rewardsMaxSpread", "rewards_max_spread", "number"),
+    ("spread", "spread", "number"),
+    ("bestBid", "best_bid", "number"),
+    ("bestAsk", "best_ask", "number"),
+    ("startDate", "start_date", "time"),
+    ("endDate", "end_date", "time"),
+    ("createdAt", "created_at", "time"),
+    ("updatedAt", "updated_at", "time"),
+    ("closedAt", "closed_at", "time"),
+    ("deployingTimestamp", "deploying_timestamp", "time"),
+    ("umaEndDate", "uma_end_date", "time"),
+    ("acceptingOrdersTimestamp", "accepting_orders_timestamp", "time"),
+    ("negRisk", "negrisk", "predicate"),
+    ("enableOrderBook", "enable_order_book", "predicate"),
+    ("acceptingOrders", "accepting_orders", "predicate"),
+    ("holdingRewardsEnabled", "holding_rewards_enabled", "predicate"),
+    ("feesEnabled", "fees_enabled", "predicate"),
+]
+
+SQL_TYPES = {
+    "number": "DOUBLE PRECISION",
+    "time": "TIMESTAMP(3) WITH TIME ZONE",
+    "string": "TEXT",
+    "predicate": "BOOLEAN",
+}
+
+
+def create_attributes_sql() -> str:
+    """attributes table, one row per market, with an index on every orderable column.
+
+    update_index is taken from its own sequence on insert and again on every
+    update, so MAX(update_index) moves whenever any row changes, which
+    row_index does not.
+    """
+    columns = ",\n".join(
+        f"            {column} {SQL_TYPES[kind]}{' UNIQUE' if column == 'market_id' else ''}"
+        for _, column, kind in ATTRIBUTES
+    )
+    indexes = "\n".join(
+        f"        CREATE INDEX IF NOT EXISTS attributes_{column} ON attributes ({column});"
+        for _, column, kind in ATTRIBUTES if kind in ("number", "time")
+    )
+    return f"""
+        CREATE TABLE IF NOT EXISTS attributes (
+            row_index SERIAL PRIMARY KEY,
+            collector_version INTEGER,
+            insert_time TIMESTAMP(3) WITH TIME ZONE DEFAULT now(),
+            token_id1 VARCHAR(100),
+            token_id2 VARCHAR(100),
+{columns}
+        );
+        ALTER TABLE attributes ADD COLUMN IF NOT EXISTS update_index BIGSERIAL;
+        CREATE INDEX IF NOT EXISTS attributes_update_index ON attributes (update_index);
+{indexes}
+    """
+
+
+def upsert_attributes_sql() -> str:
+    names = ["collector_version", "token_id1", "token_id2"] + [column for _, column, _ in ATTRIBUTES]
+    placeholders = ", ".join(f"${i + 1}" for i in range(len(names)))
+    updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in names if name != "market_id")
+    return f"""
+        INSERT INTO attributes ({", ".join(names)}) VALUES ({placeholders})
+        ON CONFLICT (market_id) DO UPDATE SET {updates}, update_index = nextval('attributes_update_index_seq')
+    """
+
+
+def attribute_values(market_obj: dict) -> list:
+    """Typed values of ATTRIBUTES in order, None where gamma left a field out or it does not parse."""
+    values = []
+    for key, _, kind in ATTRIBUTES:
+        raw = market_obj.get(key)
+        values.append(None if raw is None else _convert(raw, kind))
+    return values
+
+
+def _convert(raw, kind):
+    try:
+        if kind == "number":
+            return float(raw)
+        if kind == "time":
+            value = datetime.fromisoformat(str(raw).replace("Z", "+00:00"))
+            return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if kind == "predicate":
+            return raw if isinstance(raw, bool) else str(raw).lower() == "true"
+        return raw if isinstance(raw, str) else str(raw)
+    except (TypeError, ValueError):
+        return None
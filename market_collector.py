@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import aiohttp
 import asyncpg
 import json
@@ -6,12 +7,18 @@ import os
 import time
 from datetime import datetime, timezone
 import pathlib
+from metrics import REGISTRY
+from market_attributes import attribute_values, create_attributes_sql, upsert_attributes_sql
+from counters import COUNTERS_RESET, COUNTERS_UPSERT, CREATE_COUNTERS, MARKET_COUNTERS, counter_rows
 
 class market_collector:
-    def __init__(self, verbosity="DEBUG", reset=True, batch_size=500, offset=0):
+    def __init__(self, verbosity="DEBUG", reset=True, batch_size=500, offset=0, db_pool=None, http_session=None):
         # Database & directorie
         self.__db_conn = None
         self.__reset = reset
+        # shared resources injected by collection_manager are used but never closed
+        self.__db_pool = db_pool
+        self.__http_session = http_session
 
         # logging
         self.__verbosity = verbosity.upper()
@@ -29,23 +36,37 @@ class market_collector:
 
         # version
         self.__version = 1
+        self.__upsert_attributes = upsert_attributes_sql()
+
+        # metrics
+        self.__requests = REGISTRY.counter("market_collector_requests", "gamma markets requests sent")
+        self.__request_latency = REGISTRY.histogram("market_collector_request_seconds", "gamma markets request latency")
+        self.__markets_fetched = REGISTRY.counter("market_collector_fetched_markets", "markets returned by gamma")
+        self.__markets_inserted = REGISTRY.counter("market_collector_inserted_markets", "non-closed markets inserted")
+        self.__insert_latency = REGISTRY.histogram("market_collector_insert_seconds", "markets row insert latency")
+        self.__offset_gauge = REGISTRY.gauge("market_collector_offset", "current gamma markets offset")
 
     async def start(self) -> bool:
         if self.__running:
             self.__log("market_collector already started", "ERROR")
             return False
         try:
-            socket_dir = str(pathlib.Path("../.pgsocket").resolve()) 
-            self.__db_conn = await asyncpg.connect(
-                user="client",
-                password="clientpass",
-                database="data",
-                host=socket_dir,  # directory containing the socket
-                port=5432
-            )
+            if self.__db_pool is not None:
+                self.__db_conn = self.__db_pool
+            else:
+                socket_dir = str(pathlib.Path("../.pgsocket").resolve()) 
+                self.__db_conn = await asyncpg.connect(
+                    user="client",
+                    password="clientpass",
+                    database="data",
+                    host=socket_dir,  # directory containing the socket
+                    port=5432
+                )
             if self.__reset:
                 await self.__db_conn.execute("""
                 DROP TABLE IF EXISTS markets;
+                DROP TABLE IF EXISTS attributes;
+                DROP TABLE IF EXISTS negrisk_groups;
             """)
 
             await self.__db_conn.execute("""
@@ -58,14 +79,31 @@ class market_collector:
                     token_id2 VARCHAR(100),
                     negrisk_id VARCHAR(100)
                 );
+                -- one row per negRisk group, the first market of a group claims it for the negrisks counter
+                CREATE TABLE IF NOT EXISTS negrisk_groups (
+                    negrisk_id VARCHAR(100) PRIMARY KEY,
+                    insert_time TIMESTAMP(3) WITH TIME ZONE DEFAULT now()
+                );
+                INSERT INTO negrisk_groups (negrisk_id)
+                SELECT DISTINCT negrisk_id FROM markets WHERE negrisk_id <> ''
+                ON CONFLICT DO NOTHING;
             """)
+            # typed gamma fields for the web query DSL, one row per market
+            await self.__db_conn.execute(create_attributes_sql())
+            # global totals for the dashboard
+            await self.__db_conn.execute(CREATE_COUNTERS)
+            if self.__reset:
+                await self.__db_conn.execute(COUNTERS_RESET, list(MARKET_COUNTERS))
 
         except Exception as e:
             self.__log(f"market_collector failed to start: {e}", "ERROR")
             return False
 
-        connector = aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=99999)
-        self.__markets_cli = aiohttp.ClientSession(connector=connector)
+        if self.__http_session is not None:
+            self.__markets_cli = self.__http_session
+        else:
+            connector = aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=99999)
+            self.__markets_cli = aiohttp.ClientSession(connector=connector)
 
         self.__running = True
         self.__log("market_collector started", "INFO")
@@ -89,21 +127,21 @@ class market_collector:
     async def __clean_up(self):
         self.__log("market_collector cleanup started", "DEBUG")
 
-        if self.__markets_cli is not None:
+        if self.__markets_cli is not None and self.__markets_cli is not self.__http_session:
             try:
                 await self.__markets_cli.close()
                 self.__log("market_collector closed markets aiohttp client", "DEBUG")
             except Exception as e:
                 self.__log(f"market_collector error closing markets aiohttp client: {e}", "ERROR")
-            self.__markets_cli = None
+        self.__markets_cli = None
 
-        if self.__db_conn is not None:
+        if self.__db_conn is not None and self.__db_conn is not self.__db_pool:
             try:
                 await self.__db_conn.close()
                 self.__log("market_collector closed DB connection", "DEBUG")
             except Exception as e:
                 self.__log(f"market_collector error closing DB connection: {e}", "ERROR")
-            self.__db_conn = None
+        self.__db_conn = None
             
         self.__running = False
         self.__log("market_collector cleanup finished", "INFO")
@@ -114,8 +152,19 @@ class market_collector:
             now_iso = datetime.now(timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z")
             print(f"[{now_iso}] [{level}] {msg}")
 
+    @contextlib.asynccontextmanager
+    async def __connection(self):
+        """A single connection, checked out of the pool when one was injected."""
+        if self.__db_conn is self.__db_pool:
+            async with self.__db_pool.acquire() as conn:
+                yield conn
+        else:
+            yield self.__db_conn
+
     async def __query_markets(self) -> bool:
         url = self.__markets_url.format(offset=self.__market_offset)
+        self.__requests.inc()
+        request_start = time.perf_counter()
         try:
             resp = await self.__markets_cli.get(url)
             if resp.status != 200:
@@ -127,6 +176,7 @@ class market_collector:
         except aiohttp.ClientError as e:
             self.__log(f"market_collector request failed: {e}", "ERROR")
             return False
+        self.__request_latency.observe(time.perf_counter() - request_start)
 
         new_market_count = len(market_arr)
         self.__log(f"market_collector fetched {new_market_count} markets", "DEBUG")
@@ -168,18 +218,36 @@ class market_collector:
                 return False
             
             negrisk_id = market_obj.get("negRiskMarketID", None)
+            insert_start = time.perf_counter()
             try:
-                await self.__db_conn.execute("""
-                    INSERT INTO markets (collector_version, market_id, token_id1, token_id2, negrisk_id)
-                    VALUES ($1, $2, $3, $4, $5)
-                """, self.__version, market_id, token_ids[0], token_ids[1], negrisk_id)
+                # the market, its attributes and its counts are stored together or not at all
+                async with self.__connection() as conn, conn.transaction():
+                    # a negRisk group is counted once, by whichever market claims it first
+                    new_negrisk = bool(negrisk_id) and await conn.fetchval(
+                        "INSERT INTO negrisk_groups (negrisk_id) VALUES ($1) ON CONFLICT DO NOTHING RETURNING negrisk_id",
+                        negrisk_id
+                    ) is not None
+                    await conn.execute("""
+                        INSERT INTO markets (collector_version, market_id, token_id1, token_id2, negrisk_id)
+                        VALUES ($1, $2, $3, $4, $5)
+                    """, self.__version, market_id, token_ids[0], token_ids[1], negrisk_id)
+                    await conn.execute(
+                        self.__upsert_attributes, self.__version, token_ids[0], token_ids[1], *attribute_values(market_obj)
+                    )
+                    await conn.executemany(COUNTERS_UPSERT, counter_rows({
+                        "markets": 1, "tokens": len(token_ids), "negrisks": int(new_negrisk),
+                    }))
             except Exception as e:
                 self.__log(f"market_collector failed insert new market row with version {self.__version} , : {e}", "ERROR")
                 return False
+            self.__insert_latency.observe(time.perf_counter() - insert_start)
+            self.__markets_inserted.inc()
             self.__log(f"market_collector found new non-closed market {market_id} with tokens {token_ids[0]} and {token_ids[1]}, and negrisk {negrisk_id}", "INFO")
             
         
         self.__market_offset += new_market_count
+        self.__markets_fetched.inc(new_market_count)
+        self.__offset_gauge.set(self.__market_offset)
         if new_market_count > 0:
             self.__log(f"market_collector found {new_market_count} new markets", "INFO")
         return True
\ No newline at end of file
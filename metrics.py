@@ -0,0 +1,193 @@
+import bisect
+import math
+import time
+
+# seconds, tuned for single-row inserts up to slow HTTP round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class counter:
+    __slots__ = ("name", "help", "labels", "value")
+    type = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name + "_total", self.labels, self.value)]
+
+
+class gauge:
+    __slots__ = ("name", "help", "labels", "value")
+    type = "gauge"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class histogram:
+    """Fixed-bucket histogram. observe() is a bisect and two additions."""
+
+    __slots__ = ("name", "help", "labels", "bounds", "counts", "sum", "count")
+    type = "histogram"
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(sorted(buckets))
+        # last slot is the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bucket bound below which a fraction q of observations fall."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            samples.append((self.name + "_bucket", dict(self.labels, le=repr(bound)), cumulative))
+        samples.append((self.name + "_bucket", dict(self.labels, le="+Inf"), self.count))
+        samples.append((self.name + "_sum", self.labels, self.sum))
+        samples.append((self.name + "_count", self.labels, self.count))
+        return samples
+
+
+class metrics_registry:
+    """In-process registry of counters, gauges and histograms.
+
+    Metrics are identified by name plus labels, so repeated lookups with the
+    same arguments return the same object; collectors look theirs up once in
+    __init__ and only touch the object on hot paths.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__last_sample = {}  # consumer -> metric key -> (value, time)
+
+    def __get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            metric = cls(name, help, labels, **kwargs)
+            self.__metrics[key] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(f"metric {name} already registered as {metric.type}")
+        return metric
+
+    def counter(self, name, help="", **labels) -> counter:
+        return self.__get(counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels) -> gauge:
+        return self.__get(gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels) -> histogram:
+        return self.__get(histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self, consumer="default") -> dict:
+        """JSON-serializable view of every metric.
+
+        Counters carry a per-second rate since the previous snapshot taken for
+        the same consumer, so the stats command and a metrics scraper each see
+        their own interval. Histograms carry approximate p50/p99 from their
+        buckets.
+        """
+        now = time.monotonic()
+        last_sample = self.__last_sample.setdefault(consumer, {})
+        families = {}
+        for key, metric in self.__metrics.items():
+            family = families.setdefault(metric.name, {"type": metric.type, "help": metric.help, "metrics": []})
+            entry = {"labels": metric.labels}
+            if metric.type == "histogram":
+                entry.update(count=metric.count, sum=metric.sum,
+                             p50=metric.quantile(0.5), p99=metric.quantile(0.99),
+                             samples=metric.samples())
+            else:
+                entry["value"] = metric.value
+                entry["samples"] = metric.samples()
+            if metric.type == "counter":
+                last = last_sample.get(key)
+                if last is not None and now > last[1]:
+                    entry["rate"] = (metric.value - last[0]) / (now - last[1])
+                last_sample[key] = (metric.value, now)
+            family["metrics"].append(entry)
+        return families
+
+
+def render_prometheus(snapshots) -> str:
+    """Render (extra_labels, snapshot) pairs as Prometheus text exposition.
+
+    Families with the same name from several snapshots (for instance the same
+    collector class running in several workers) are merged under one HELP/TYPE
+    header and told apart by their extra labels.
+    """
+    merged = {}
+    for extra_labels, snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.setdefault(name, {"type": family["type"], "help": family["help"], "samples": []})
+            for entry in family["metrics"]:
+                for sample_name, labels, value in entry["samples"]:
+                    target["samples"].append((sample_name, dict(labels, **extra_labels), value))
+
+    lines = []
+    for name, family in merged.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample_name, labels, value in family["samples"]:
+            if labels:
+                label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{sample_name}{{{label_str}}} {_format_value(value)}")
+            else:
+                lines.append(f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = metrics_registry()
@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+from rollups import RESOLUTIONS
+
+# table a query reads -> tables whose watermark column grows whenever it changes,
+# token_stats is written in the same transaction as the event rows it counts
+WATERMARK_TABLES = {
+    "attributes": ("attributes",),
+    "token_stats": ("changes", "books", "tick_changes"),
+    # book_metrics is upserted in the same transaction as the analytics rows
+    "book_metrics": ("analytics",),
+    # bars are upserted together with the event rows they roll up
+    **{table: ("changes", "books") for table in RESOLUTIONS},
+}
+
+# attributes rows are updated in place, their update_index moves on every write;
+# every other source is append-only and marked by row_index
+WATERMARK_COLUMNS = {"attributes": "update_index"}
+
+
+class query_cache:
+    """LRU of serialized query responses, valid while the data they were read from is unchanged.
+
+    Every entry remembers the high-water marks (WATERMARK_COLUMNS, else
+    row_index) of the tables its query touched. The marks are read with one indexed MAX per table, at most
+    once every `mark_interval` seconds for all requests together, so a
+    repeated query between two mark reads costs a dictionary lookup. Once a
+    table changes, every entry that read it misses and is dropped.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, mark_interval=1.0):
+        self.__entries = OrderedDict()  # key -> (marks, body)
+        self.__size = 0
+        self.__max_bytes = max_bytes
+        self.__mark_interval = mark_interval
+        self.__marks = {}
+        self.__marks_time = 0.0
+
+        self.__hits = REGISTRY.counter("query_cache_hits", "query results served from the cache")
+        self.__misses = REGISTRY.counter("query_cache_misses", "query results that had to be computed")
+        self.__bytes = REGISTRY.gauge("query_cache_bytes", "bytes of cached query results")
+
+    async def marks(self, connect, tables, timeout=None) -> tuple:
+        """Current high-water marks of everything `tables` is derived from.
+
+        connect() gives an async context manager yielding a connection, such
+        as pool.acquire, and is only called when the marks are refreshed.
+        """
+        sources = sorted({src for table in tables for src in WATERMARK_TABLES.get(table, ())})
+        now = time.monotonic()
+        if now - self.__marks_time > self.__mark_interval or not all(src in self.__marks for src in sources):
+            # known sources are refreshed together so every entry sees the same snapshot
+            known = sorted(set(self.__marks) | set(sources))
+            async with connect() as conn:
+                row = await conn.fetchrow("SELECT " + ", ".join(
+                    f"(SELECT COALESCE(MAX({WATERMARK_COLUMNS.get(src, 'row_index')}), 0) FROM {src}) AS {src}"
+                    for src in known
+                ), timeout=timeout)
+            self.__marks = dict(row)
+            self.__marks_time = now
+        return tuple(self.__marks[src] for src in sources)
+
+    def get(self, key, marks):
+        entry = self.__entries.get(key)
+        if entry is None or entry[0] != marks:
+            if entry is not None:
+                self.__drop(key)
+            self.__misses.inc()
+            return None
+        self.__entries.move_to_end(key)
+        self.__hits.inc()
+        return entry[1]
+
+    def put(self, key, marks, body: bytes):
+        if len(body) > self.__max_bytes:
+            return
+        if key in self.__entries:
+            self.__drop(key)
+        self.__entries[key] = (marks, body)
+        self.__size += len(body)
+        while self.__size > self.__max_bytes:
+            self.__drop(next(iter(self.__entries)))
+        self.__bytes.set(self.__size)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+        self.__marks = {}
+        self.__marks_time = 0.0
+        self.__bytes.set(0)
+
+    def __drop(self, key):
+        _, body = self.__entries.pop(key)
+        self.__size -= len(body)
+        self.__bytes.set(self.__size)
+
+    def status(self) -> dict:
+        return {"entries": len(self.__entries), "bytes": self.__size, "max_bytes": self.__max_bytes}
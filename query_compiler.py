@@ -0,0 +1,314 @@
+import json
+import re
+from datetime import datetime, timezone
+
+from market_attributes import ATTRIBUTES
+
+# DSL field -> (type, SQL expression, table it comes from)
+FIELDS = {f"MARKET_{key}": (kind, f"a.{column}", "attributes") for key, column, kind in ATTRIBUTES}
+FIELDS.update({
+    "market_found": ("time", "a.insert_time", "attributes"),
+    "EVENTS_books_count": ("number", "s.book_count", "token_stats"),
+    "EVENTS_price_change_count": ("number", "s.price_change_count", "token_stats"),
+    "EVENTS_last_trade_price_count": ("number", "s.last_trade_count", "token_stats"),
+    "EVENTS_tick_size_change_count": ("number", "s.tick_size_change_count", "token_stats"),
+    "BOOK_spread": ("number", "m.spread", "book_metrics"),
+    "BOOK_depth": ("number", "m.depth", "book_metrics"),
+    "BOOK_asymmetry": ("number", "m.asymmetry", "book_metrics"),
+    "BOOK_discrepency": ("number", "m.discrepancy", "book_metrics"),
+})
+
+JOINS = {
+    "book_metrics": "LEFT JOIN book_metrics m ON m.token_id = t.token_id",
+    "token_stats": "LEFT JOIN token_stats s ON s.token_id = t.token_id",
+}
+
+ARITHMETIC = ("+", "-", "*")
+COMPARISONS = {"=": "=", "!=": "<>", ">": ">", "<": "<", ">=": ">=", "<=": "<="}
+LOGICAL = {"&": "AND", "|": "OR"}
+
+# same tokens as webpage/main.js, multi-character operators first
+TOKEN_RE = re.compile(r'\s*(>=|<=|!=|[()!&|+\-*=><]|\d+(?:\.\d+)?|"(?:\\"|[^"])*"|\w+)\s*')
+
+
+class query_error(ValueError):
+    pass
+
+
+def tokenize(text: str) -> list:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if match is None:
+            raise query_error(f"Unexpected character {text[pos]!r} at {pos}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def node(type, value=None, children=None) -> dict:
+    """AST node in the shape of main.js ASTNode, so client-side trees can be posted as JSON."""
+    return {"type": type, "value": value, "children": children or []}
+
+
+def parse(text: str) -> dict:
+    """Port of main.js parseExpression, with the same precedence and associativity."""
+    tokens = tokenize(text)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def consume():
+        nonlocal pos
+        tok = peek()
+        pos += 1
+        return tok
+
+    def factor():
+        tok = peek()
+        if tok is None:
+            raise query_error("Unexpected end of input")
+        if tok == "(":
+            consume()
+            inner = expr()
+            if consume() != ")":
+                raise query_error("Missing closing parenthesis")
+            return inner
+        consume()
+        if re.fullmatch(r"\d+(?:\.\d+)?", tok):
+            return node("number", float(tok))
+        if tok.startswith('"'):
+            return node("string", tok[1:-1].replace('\\"', '"'))
+        return node("identifier", tok)
+
+    def term():
+        left = factor()
+        while peek() in ARITHMETIC:
+            op = consume()
+            left = node("operator", op, [left, factor()])
+        return left
+
+    def comparison():
+        left = term()
+        while peek() in COMPARISONS:
+            op = consume()
+            left = node("operator", op, [left, term()])
+        return left
+
+    def logical():
+        if peek() == "!":
+            consume()
+            return node("operator", "!", [logical()])
+        left = comparison()
+        while peek() in LOGICAL:
+            op = consume()
+            # main.js only allows '!' at the start, "a & !b" is accepted here too
+            left = node("operator", op, [left, logical() if peek() == "!" else comparison()])
+        return left
+
+    def expr():
+        return logical()
+
+    tree = expr()
+    if pos != len(tokens):
+        raise query_error(f"Unexpected token: {peek()}")
+    return tree
+
+
+def as_ast(expression):
+    """Accept either DSL text or an AST posted by the browser; None and "None" mean no expression."""
+    if expression is None or (isinstance(expression, str) and expression.strip() in ("", "None")):
+        return None
+    if isinstance(expression, str):
+        return parse(expression)
+    if isinstance(expression, dict) and "type" in expression:
+        return expression
+    raise query_error(f"Invalid expression {expression!r}")
+
+
+def infer_type(tree):
+    """Same rules as main.js inferType, plus a string literal may stand for a time."""
+    kind = tree.get("type")
+    if kind in ("number", "string"):
+        return kind
+    if kind == "identifier":
+        field = FIELDS.get(tree.get("value"))
+        return field[0] if field else None
+    if kind != "operator":
+        return None
+
+    op = tree.get("value")
+    children = tree.get("children") or []
+    types = [infer_type(child) for child in children]
+    if op == "!":
+        return "predicate" if len(types) == 1 and types[0] == "predicate" else None
+    if len(types) != 2:
+        return None
+    a, b = types
+    if op in ARITHMETIC:
+        return "number" if a == b == "number" else None
+    if op in COMPARISONS:
+        if a is None or b is None:
+            return None
+        if a == b or {a, b} <= {"number", "time"}:
+            return "predicate"
+        if {a, b} == {"string", "time"} and "string" in (children[0]["type"], children[1]["type"]):
+            return "predicate"
+        return None
+    if op in LOGICAL:
+        return "predicate" if a == b == "predicate" else None
+    return None
+
+
+class compiled_query:
+    """Parameterized SQL for one filter/order request, one row per token."""
+
+    def __init__(self, sql, params, tables, fields, keyset):
+        self.sql = sql
+        self.params = params
+        self.tables = tables
+        self.fields = fields
+        self.keyset = keyset
+
+    def cursor(self, row) -> list:
+        """`after` value for the page following `row`."""
+        return [row[name] for name in self.keyset]
+
+    def key(self) -> str:
+        """Normalized form, equal for requests that compile to the same SQL and parameters."""
+        return json.dumps([self.sql, self.params], default=str)
+
+
+class _compiler:
+    def __init__(self):
+        self.params = []
+        self.tables = {"attributes"}
+        self.fields = []
+
+    def param(self, value, cast):
+        self.params.append(value)
+        return f"${len(self.params)}::{cast}"
+
+    def keyset_param(self, value, kind):
+        if value is None:
+            raise query_error("after cannot contain null")
+        if kind == "index":
+            return self.param(int(value), "integer")
+        if kind in ("number", "time"):
+            return self.literal(node("number" if isinstance(value, (int, float)) else "string", value), kind)
+        return self.param(str(value), "text")
+
+    def literal(self, tree, want):
+        value = tree["value"]
+        if want == "time":
+            if tree["type"] == "number":
+                # unix seconds, as typed in the UI
+                return self.param(float(value), "double precision").join(("to_timestamp(", ")"))
+            try:
+                parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+            except ValueError:
+                raise query_error(f"Invalid time {value!r}")
+            return self.param(parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc), "timestamptz")
+        if tree["type"] == "number" or want == "number":
+            return self.param(float(value), "double precision")
+        return self.param(str(value), "text")
+
+    def compile(self, tree, want=None) -> str:
+        kind = tree["type"]
+        if kind in ("number", "string"):
+            return self.literal(tree, want)
+        if kind == "identifier":
+            name = tree["value"]
+            _, sql, table = FIELDS[name]
+            self.tables.add(table)
+            if name not in self.fields:
+                self.fields.append(name)
+            return sql
+
+        op = tree["value"]
+        children = tree["children"]
+        if op == "!":
+            return f"(NOT {self.compile(children[0])})"
+        left, right = children
+        if op in LOGICAL:
+            return f"({self.compile(left)} {LOGICAL[op]} {self.compile(right)})"
+        if op in ARITHMETIC:
+            return f"({self.compile(left)} {op} {self.compile(right)})"
+        # comparisons: a literal next to a time field is read as a time
+        left_type, right_type = infer_type(left), infer_type(right)
+        left_want = "time" if right_type == "time" and left["type"] in ("number", "string") else None
+        right_want = "time" if left_type == "time" and right["type"] in ("number", "string") else None
+        return f"({self.compile(left, left_want)} {COMPARISONS[op]} {self.compile(right, right_want)})"
+
+
+def compile_query(filter=None, order=None, direction="desc", limit=100, after=None) -> compiled_query:
+    """Compile a filter predicate and an order expression into one parameterized SELECT.
+
+    The order expression and LIMIT are part of the SQL, so Postgres can walk
+    an index on the ordered column and stop after `limit` rows. Rows where
+    the order expression is NULL are left out, which keeps that index usable
+    in both directions. `after` is the keyset of the last row of the previous
+    page (compiled_query.cursor), so later pages seek instead of OFFSET;
+    limit=None leaves the LIMIT out for streamed exports.
+    """
+    filter_tree = as_ast(filter)
+    order_tree = as_ast(order)
+    if direction not in ("asc", "desc"):
+        raise query_error(f"Invalid direction {direction!r}, expected asc or desc")
+
+    compiler = _compiler()
+    where = []
+    if filter_tree is not None:
+        if infer_type(filter_tree) != "predicate":
+            raise query_error("Filter must be a predicate")
+        where.append(compiler.compile(filter_tree))
+
+    columns = ["a.row_index", "a.market_id", "a.question", "t.token_id"]
+    if order_tree is not None:
+        order_type = infer_type(order_tree)
+        if order_type not in ("number", "time"):
+            raise query_error("Order must be a number or a time")
+        order_sql = compiler.compile(order_tree)
+        where.append(f"{order_sql} IS NOT NULL")
+        columns.append(f"{order_sql} AS sort_key")
+        keyset = [(order_sql, "sort_key", order_type), ("a.market_id", "market_id", "string"),
+                  ("t.token_id", "token_id", "string")]
+        order_by = ", ".join(f"{sql} {direction.upper()}" for sql, _, _ in keyset)
+    else:
+        keyset = [("a.row_index", "row_index", "index"), ("t.token_id", "token_id", "string")]
+        order_by = "a.row_index, t.token_id"
+        direction = "asc"
+
+    if after is not None:
+        if not isinstance(after, (list, tuple)) or len(after) != len(keyset):
+            raise query_error(f"after must be a list of {len(keyset)} values")
+        values = [compiler.keyset_param(value, kind) for value, (_, _, kind) in zip(after, keyset)]
+        where.append(f"({', '.join(sql for sql, _, _ in keyset)}) {'<' if direction == 'desc' else '>'} "
+                     f"({', '.join(values)})")
+
+    limit_sql = compiler.param(int(limit), "bigint") if limit is not None else None
+    columns += [f'{FIELDS[name][1]} AS "{name}"' for name in compiler.fields if FIELDS[name][1] not in columns]
+    joins = [JOINS[table] for table in sorted(compiler.tables) if table in JOINS]
+
+    sql = "\n".join([
+        f"SELECT {', '.join(columns)}",
+        "FROM attributes a",
+        "CROSS JOIN LATERAL (VALUES (a.token_id1), (a.token_id2)) AS t(token_id)",
+        *joins,
+        f"WHERE {' AND '.join(where)}" if where else "",
+        f"ORDER BY {order_by}",
+        f"LIMIT {limit_sql}" if limit_sql else "",
+    ])
+    return compiled_query(sql, compiler.params, sorted(compiler.tables), compiler.fields,
+                          [name for _, name, _ in keyset])
+
+
+async def estimate_cost(conn, query: compiled_query, timeout=None) -> float:
+    """Planner total cost of the query, from EXPLAIN without running it."""
+    plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query.sql}", *query.params, timeout=timeout)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return float(plan[0]["Plan"]["Total Cost"])
@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+
+from query_compiler import query_error
+
+# event tables that can be exported, each has a (token_id, server_time) index
+EVENT_TABLES = ("changes", "books", "tick_changes")
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def events_sql(table, token_id=None, start=None, end=None) -> tuple:
+    """(sql, params) selecting one event table in row_index order, optionally for one token and server_time range."""
+    if table not in EVENT_TABLES:
+        raise query_error(f"Unknown table {table!r}, expected one of {', '.join(EVENT_TABLES)}")
+    where, params = [], []
+    for column, op, value, cast in (("token_id", "=", token_id, str), ("server_time", ">=", start, int),
+                                    ("server_time", "<=", end, int)):
+        if value is not None:
+            params.append(cast(value))
+            where.append(f"{column} {op} ${len(params)}")
+    order = "server_time, row_index" if token_id is not None else "row_index"
+    return (f"SELECT * FROM {table}{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY {order}", params)
+
+
+class row_writer:
+    """Encodes record chunks as NDJSON lines or CSV rows, CSV with a header before the first chunk."""
+
+    def __init__(self, fmt):
+        if fmt not in CONTENT_TYPES:
+            raise query_error(f"Unknown format {fmt!r}, expected one of {', '.join(CONTENT_TYPES)}")
+        self.format = fmt
+        self.content_type = CONTENT_TYPES[fmt]
+        self.__header = fmt == "csv"
+
+    def encode(self, rows) -> bytes:
+        if self.format == "ndjson":
+            return "".join(json.dumps(dict(row), default=str) + "\n" for row in rows).encode()
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if self.__header and rows:
+            writer.writerow(list(rows[0].keys()))
+            self.__header = False
+        writer.writerows(row.values() for row in rows)
+        return buf.getvalue().encode()
+
+
+async def stream_rows(response, conn, sql, params, writer: row_writer, chunk_size=5000, timeout=None) -> int:
+    """Write the result of `sql` to a prepared StreamResponse chunk by chunk, returns the row count.
+
+    Rows come from a server-side cursor, and every chunk is written before the
+    next one is fetched, so the server holds at most one chunk whatever the
+    result size, and a slow client slows down the fetching. timeout bounds
+    every fetch, not the whole export.
+    """
+    count = 0
+    async with conn.transaction(readonly=True):
+        cursor = await conn.cursor(sql, *params)
+        while True:
+            rows = await cursor.fetch(chunk_size, timeout=timeout)
+            if not rows:
+                break
+            await response.write(writer.encode(rows))
+            count += len(rows)
+    return count
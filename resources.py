@@ -0,0 +1,98 @@
+import os
+import pathlib
+
+import aiohttp
+import asyncpg
+
+RESOURCE_KINDS = ("pg_pool", "http_session")
+
+
+def pg_pool_options(options=None) -> dict:
+    """asyncpg pool arguments, defaulting to the local socket cluster set up by scripts/start_pg.sh."""
+    defaults = {
+        "user": os.getenv("PG_USER", "client"),
+        "password": os.getenv("PG_PASSWORD", "clientpass"),
+        "database": os.getenv("PG_DATABASE", "data"),
+        "host": os.getenv("PG_HOST", str(pathlib.Path("../.pgsocket").resolve())),
+        "port": int(os.getenv("PG_PORT", 5432)),
+        "min_size": 1,
+        "max_size": 10,
+    }
+    defaults.update(options or {})
+    return defaults
+
+
+async def create_resource(kind, options=None):
+    options = dict(options or {})
+    if kind == "pg_pool":
+        return await asyncpg.create_pool(**pg_pool_options(options))
+    if kind == "http_session":
+        connector = aiohttp.TCPConnector(
+            limit=options.get("limit", 100),
+            limit_per_host=options.get("limit_per_host", 4),
+            keepalive_timeout=options.get("keepalive_timeout", 99999)
+        )
+        return aiohttp.ClientSession(connector=connector)
+    raise ValueError(f"Unknown resource kind {kind}, expected one of {RESOURCE_KINDS}")
+
+
+async def close_resource(kind, obj):
+    if kind == "pg_pool":
+        await obj.close()
+    elif kind == "http_session":
+        await obj.close()
+
+
+class resource_registry:
+    """Named connection resources shared by every instance in one process.
+
+    Instances receive them as constructor keyword arguments and must not close
+    them; the registry closes a resource when it is removed or on shutdown.
+    """
+
+    def __init__(self):
+        self.__resources = {}
+
+    def __contains__(self, name):
+        return name in self.__resources
+
+    async def add(self, name, kind, options=None):
+        if name in self.__resources:
+            raise ValueError(f"Resource {name} already exists")
+        obj = await create_resource(kind, options)
+        self.__resources[name] = {"kind": kind, "options": dict(options or {}), "object": obj, "users": set()}
+
+    def spec(self, name) -> tuple:
+        entry = self.__resources[name]
+        return entry["kind"], entry["options"]
+
+    def acquire(self, name, user):
+        entry = self.__resources[name]
+        entry["users"].add(user)
+        return entry["object"]
+
+    def release(self, user):
+        for entry in self.__resources.values():
+            entry["users"].discard(user)
+
+    async def remove(self, name):
+        entry = self.__resources[name]
+        if entry["users"]:
+            raise ValueError(f"Resource {name} is used by {sorted(entry['users'])}")
+        del self.__resources[name]
+        await close_resource(entry["kind"], entry["object"])
+
+    async def close_all(self):
+        for name in list(self.__resources):
+            entry = self.__resources.pop(name)
+            try:
+                await close_resource(entry["kind"], entry["object"])
+            except Exception as e:
+                print(f"[Server] Failed to close resource {name}: {e}")
+
+    def describe(self) -> dict:
+        return {
+            name: {"kind": entry["kind"], "options": {k: v for k, v in entry["options"].items() if k != "password"},
+                   "users": sorted(entry["users"])}
+            for name, entry in self.__resources.items()
+        }
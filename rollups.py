@@ -0,0 +1,103 @@
+# bar table -> bucket width in ms, finest first
+RESOLUTIONS = {
+    "bars_1s": 1000,
+    "bars_1m": 60_000,
+    "bars_1h": 3_600_000,
+}
+
+BAR_COLUMNS = (
+    "token_id", "bucket", "open", "high", "low", "close", "open_time", "close_time",
+    "volume", "trade_count", "update_count",
+)
+
+
+def create_bars_sql() -> str:
+    return "\n".join(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            token_id VARCHAR(100),
+            bucket BIGINT, --ms unix utc start of the bar
+            open REAL, --mids, from book and price_change best bid/ask
+            high REAL,
+            low REAL,
+            close REAL,
+            open_time BIGINT,
+            close_time BIGINT,
+            volume REAL, --last_trade_price sizes
+            trade_count INTEGER,
+            update_count INTEGER, --book and price_change events
+            PRIMARY KEY (token_id, bucket)
+        );""" for table in RESOLUTIONS)
+
+
+def bars_upsert_sql(table) -> str:
+    """Merge a partial bar into the stored one, whichever order the parts arrive in."""
+    return f"""
+        INSERT INTO {table} ({", ".join(BAR_COLUMNS)})
+        VALUES ({", ".join(f"${i + 1}" for i in range(len(BAR_COLUMNS)))})
+        ON CONFLICT (token_id, bucket) DO UPDATE SET
+            open = CASE WHEN {table}.open_time IS NULL OR EXCLUDED.open_time < {table}.open_time
+                THEN EXCLUDED.open ELSE {table}.open END,
+            open_time = LEAST({table}.open_time, EXCLUDED.open_time),
+            close = CASE WHEN {table}.close_time IS NULL OR EXCLUDED.close_time >= {table}.close_time
+                THEN EXCLUDED.close ELSE {table}.close END,
+            close_time = GREATEST({table}.close_time, EXCLUDED.close_time),
+            high = GREATEST({table}.high, EXCLUDED.high),
+            low = LEAST({table}.low, EXCLUDED.low),
+            volume = {table}.volume + EXCLUDED.volume,
+            trade_count = {table}.trade_count + EXCLUDED.trade_count,
+            update_count = {table}.update_count + EXCLUDED.update_count
+    """
+
+
+class bar_batch:
+    """Partial bars of one insert batch at every resolution, upserted with bars_upsert_sql."""
+
+    def __init__(self):
+        self.__bars = {table: {} for table in RESOLUTIONS}
+
+    def __entries(self, token, ts):
+        for table, width in RESOLUTIONS.items():
+            bucket = ts - ts % width
+            entry = self.__bars[table].get((token, bucket))
+            if entry is None:
+                entry = dict.fromkeys(BAR_COLUMNS)
+                entry.update(token_id=token, bucket=bucket, volume=0.0, trade_count=0, update_count=0)
+                self.__bars[table][(token, bucket)] = entry
+            yield entry
+
+    def mid(self, token, ts, best_bid, best_ask):
+        if not token or ts is None:
+            return
+        mid = (best_bid + best_ask) / 2 if best_bid is not None and best_ask is not None else None
+        for entry in self.__entries(token, ts):
+            entry["update_count"] += 1
+            if mid is None:
+                continue
+            if entry["open_time"] is None or ts < entry["open_time"]:
+                entry["open"], entry["open_time"] = mid, ts
+            if entry["close_time"] is None or ts >= entry["close_time"]:
+                entry["close"], entry["close_time"] = mid, ts
+            entry["high"] = mid if entry["high"] is None else max(entry["high"], mid)
+            entry["low"] = mid if entry["low"] is None else min(entry["low"], mid)
+
+    def trade(self, token, ts, size):
+        if not token or ts is None:
+            return
+        for entry in self.__entries(token, ts):
+            entry["trade_count"] += 1
+            entry["volume"] += size or 0.0
+
+    def rows(self):
+        """(table, rows) pairs for every resolution with bars in this batch."""
+        return [
+            (table, [tuple(entry[column] for column in BAR_COLUMNS) for entry in bars.values()])
+            for table, bars in self.__bars.items() if bars
+        ]
+
+
+def pick_resolution(start, end, points) -> str:
+    """Coarsest bar table that still has at least `points` buckets in [start, end], else the finest."""
+    for table, width in reversed(RESOLUTIONS.items()):
+        if (end - start) // width >= points:
+            return table
+    return next(iter(RESOLUTIONS))
@@ -6,10 +6,11 @@ import aiohttp
 from dotenv import load_dotenv
 import websockets
 import time
+from metrics import REGISTRY
 
 
 class rpc_collector:
-    def __init__(self, data_dir="data", read_sleep = 0.5, verbosity="DEBUG"):
+    def __init__(self, data_dir="data", read_sleep = 0.5, verbosity="DEBUG", http_session=None):
         self.__data_dir = data_dir
         self.__verbosity = verbosity
         self.__infura_wss_url = None
@@ -19,7 +20,15 @@ class rpc_collector:
         self.__running = False
         self.__wss_cli = None
         self.__https_cli = None
+        # session shared by collection_manager, used but never closed here
+        self.__http_session = http_session
         self.__read_sleep = read_sleep
+
+        # metrics
+        self.__heads = REGISTRY.counter("rpc_collector_heads", "newHeads notifications received")
+        self.__fetch_latency = REGISTRY.histogram("rpc_collector_fetch_seconds", "eth_getBlockByNumber latency")
+        self.__insert_latency = REGISTRY.histogram("rpc_collector_insert_seconds", "blocks row insert and commit latency")
+        self.__blocks_inserted = REGISTRY.counter("rpc_collector_inserted_blocks", "blocks inserted into blocks.db")
     
     async def start(self) -> bool:
         if self.__running:
@@ -66,8 +75,11 @@ class rpc_collector:
         self.__log(f"rpc_collector created collector.db at {blocks_db_path}", "DEBUG")
 
         # Create aiohttp client session with persistent connections
-        connector = aiohttp.TCPConnector(limit_per_host=3, keepalive_timeout=99999)
-        self.__https_cli = aiohttp.ClientSession(connector=connector)
+        if self.__http_session is not None:
+            self.__https_cli = self.__http_session
+        else:
+            connector = aiohttp.TCPConnector(limit_per_host=3, keepalive_timeout=99999)
+            self.__https_cli = aiohttp.ClientSession(connector=connector)
 
         # Mark running
         self.__running = True
@@ -106,10 +118,10 @@ class rpc_collector:
             self.__log(f"rpc_collector error closing wss: {e}", "ERROR")
 
         try:
-            if self.__https_cli:
+            if self.__https_cli and self.__https_cli is not self.__http_session:
                 await self.__https_cli.close()
                 self.__log("rpc_collector https client closed", "DEBUG")
-                self.__https_cli = None
+            self.__https_cli = None
         except Exception as e:
             self.__log(f"rpc_collector error closing https client: {e}", "ERROR")
 
@@ -155,6 +167,7 @@ class rpc_collector:
             await asyncio.sleep(self.__read_sleep)
 
             return True
+        self.__heads.inc()
         msg_json = json.loads(message)
 
         if not isinstance(msg_json, dict):
@@ -183,6 +196,7 @@ class rpc_collector:
                 "id": 1
         }
 
+        fetch_start = time.perf_counter()
         try:
             response = await self.__https_cli.post(self.__infura_https_url, json=payload)
             if response.status != 200:
@@ -195,11 +209,13 @@ class rpc_collector:
         except aiohttp.ClientError as e:
             self.__log(f"rpc_collector https request failed: {e}", "ERROR")
             return False
+        self.__fetch_latency.observe(time.perf_counter() - fetch_start)
             
         self.__log(f"rpc_collector fetched block number {block_number}", "DEBUG")
 
         block_number_int = int(block_number, 16)
 
+        insert_start = time.perf_counter()
         try:
             ts = int(time.time())
             cur = self.__blocks_db.cursor()
@@ -211,6 +227,8 @@ class rpc_collector:
         except sqlite3.Error as e:
             self.__log(f"rpc_collector failed to insert block number {block_number}: {e}", "ERROR")
             return False
+        self.__insert_latency.observe(time.perf_counter() - insert_start)
+        self.__blocks_inserted.inc()
             
         self.__log(f"rpc_collector inserted block number {block_number} into blocks.db", "DEBUG")
         return True
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import traceback
+
+RESTART_POLICIES = ("never", "on_failure", "always")
+
+
+class supervised_task:
+    """Runs an invoked coroutine function as a background task and restarts it
+    with exponential backoff according to its restart policy.
+
+    A run counts as a failure when it raises or returns False, which is how the
+    collectors report an aborted start().
+    """
+
+    def __init__(self, name, func, args=None, restart="never", max_restarts=None,
+                 backoff_initial=1.0, backoff_max=60.0, cleanup=None):
+        if restart not in RESTART_POLICIES:
+            raise ValueError(f"Unknown restart policy {restart}, expected one of {RESTART_POLICIES}")
+        self.name = name
+        self.func = func
+        self.args = args or {}
+        self.restart = restart
+        self.max_restarts = max_restarts
+        self.backoff_initial = float(backoff_initial)
+        self.backoff_max = float(backoff_max)
+        self.cleanup = cleanup
+
+        self.state = "pending"
+        self.created_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.next_restart = None
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.result = None
+        self.exception = None
+        self.traceback = None
+
+        self.__task = None
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run(), name=self.name)
+        return self.__task
+
+    def active(self) -> bool:
+        return self.__task is not None and not self.__task.done()
+
+    async def cancel(self):
+        if self.__task is None:
+            return
+        self.__task.cancel()
+        try:
+            await self.__task
+        except asyncio.CancelledError:
+            pass
+        await self.__cleanup()
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "restart": self.restart,
+            "max_restarts": self.max_restarts,
+            "created_time": self.created_time,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "uptime": (time.time() - self.start_time) if self.state == "running" else None,
+            "next_restart": self.next_restart,
+            "restarts": self.restarts,
+            "consecutive_failures": self.consecutive_failures,
+            "result": self.result if isinstance(self.result, (bool, int, float, str, type(None))) else repr(self.result),
+            "exception": self.exception,
+            "traceback": self.traceback,
+        }
+
+    async def __call(self):
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(**self.args)
+        return self.func(**self.args)
+
+    async def __cleanup(self):
+        if self.cleanup is None:
+            return
+        try:
+            result = self.cleanup()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            print(f"[Server] {self.name} cleanup failed: {e}")
+
+    def __should_restart(self, failed) -> bool:
+        if self.restart == "never" or (self.restart == "on_failure" and not failed):
+            return False
+        return self.max_restarts is None or self.restarts < self.max_restarts
+
+    async def __run(self):
+        while True:
+            self.state = "running"
+            self.start_time = time.time()
+            self.next_restart = None
+            failed = False
+            try:
+                self.result = await self.__call()
+                if self.result is False:
+                    failed = True
+                    self.exception = f"{self.name} returned False"
+                    self.traceback = None
+            except asyncio.CancelledError:
+                self.state = "cancelled"
+                self.end_time = time.time()
+                raise
+            except Exception as e:
+                failed = True
+                self.exception = f"{type(e).__name__}: {e}"
+                self.traceback = traceback.format_exc()
+            self.end_time = time.time()
+
+            # a run that stayed up longer than the backoff cap resets the backoff
+            if self.end_time - self.start_time >= self.backoff_max:
+                self.consecutive_failures = 0
+            if failed:
+                self.consecutive_failures += 1
+                print(f"[Server] {self.name} crashed: {self.exception}")
+
+            if not self.__should_restart(failed):
+                self.state = "failed" if failed else "finished"
+                return
+
+            await self.__cleanup()
+            delay = min(self.backoff_initial * (2 ** max(self.consecutive_failures - 1, 0)), self.backoff_max)
+            self.state = "backoff"
+            self.next_restart = time.time() + delay
+            print(f"[Server] {self.name} restarting in {delay:.1f}s (restart {self.restarts + 1})")
+            await asyncio.sleep(delay)
+            self.restarts += 1
@@ -1,64 +1,76 @@
 import asyncio
-import aiohttp
-from aiohttp import web
-import sqlite3
+import contextlib
 import json
-import os
-from datetime import datetime, timezone
 import time
-import shutil
+import asyncpg
+from aiohttp import WSMsgType, web
 
-
-class analytics:
-    def __init__(self, data_dir="data", verbosity="DEBUG"):
-        # data sql resources
-        self.__data_dir = data_dir
-        self.__markets_db = None
-        self.__last_market_row = 0
-
-        self.__attributes_db = None
-        self.__last_attribute_row = 0
-
-        self.__events_db = None
-        self.__last_row_for_event = {}
-
-        self.__rpc_db = None
-        self.__last_rpc_row = 0
+import resources
+from counters import counters_view
+from delta_feed import delta_feed
+from live_books import live_books
+from query_cache import query_cache
+from query_compiler import compile_query, estimate_cost, query_error
+from query_export import events_sql, row_writer, stream_rows
+from rollups import RESOLUTIONS, pick_resolution
 
 
-        self.__general_stats = {
-            "markets",
-            "tokens",
-            "negrisks",
-            "events",
-            "price_changes",
+class analytics:
+    def __init__(self, verbosity="DEBUG", db_pool=None, default_limit=100, max_limit=1000, max_cost=1_000_000,
+                 cache_bytes=64 * 2**20, cache_interval=1.0, export_chunk_size=5000, feed_interval=1.0,
+                 book_rate=5.0, book_tokens=500, stats_interval=1.0, pool_size=10, query_timeout=10.0,
+                 heavy_queries=2, heavy_wait=5.0):
+        # data sql resources; the pool created here runs read-only sessions with a statement_timeout,
+        # an injected pool gets neither and must already be read-only (default_transaction_read_only)
+        self.__db_pool = db_pool
+        self.__owns_pool = db_pool is None
+        self.__pool_size = pool_size
+        # seconds any one statement or pool checkout may take
+        self.__query_timeout = query_timeout
+        # uncached queries and exports share heavy_queries slots, so light requests always find a connection
+        self.__heavy = asyncio.Semaphore(heavy_queries)
+        self.__heavy_wait = heavy_wait
+
+        # query limits, max_cost is in planner cost units from EXPLAIN
+        self.__default_limit = default_limit
+        self.__max_limit = max_limit
+        self.__max_cost = max_cost
+        self.__export_chunk_size = export_chunk_size
+
+        # serialized query responses, invalidated when the tables they read grow
+        self.__cache = query_cache(max_bytes=cache_bytes, mark_interval=cache_interval)
 
-        }
+        # logging
+        self.__verbosity = verbosity.upper()
 
+        # new markets and attributes pushed to every open dashboard
+        self.__feed_interval = feed_interval
+        self.__feed = None
 
+        # live top of book, book_rate caps the updates per second a client can ask for
+        self.__book_rate = book_rate
+        self.__books = live_books(max_tokens=book_tokens, log=self.__log)
 
-        # attribute type cache
-        self.__attribute_types = {
-            ""
-        }
-
-        # logging
-        self.__verbosity = verbosity.upper()
+        # general stats from the collectors' counters, read at most once per stats_interval
+        self.__stats = counters_view(interval=stats_interval)
 
         # aiohttp app/server
-        self.__app = web.Application()
+        self.__app = web.Application(middlewares=[self.__timeouts])
         self.__runner = None
         self.__site = None
 
     async def start(self, host="127.0.0.1", port=8080):
-        # open dbs
-        self.__markets_db = sqlite3.connect(
-            os.path.join(self.__data_dir, "markets/markets.db")
-        )
-        self.__attributes_db = sqlite3.connect(
-            os.path.join(self.__data_dir, "markets/attributes.db")
-        )
-        # TODO: events.db, rpc.db similarly
+        if self.__db_pool is None:
+            self.__db_pool = await resources.create_resource("pg_pool", {
+                "max_size": self.__pool_size,
+                "server_settings": {
+                    "default_transaction_read_only": "on",
+                    "statement_timeout": str(int(self.__query_timeout * 1000)),
+                },
+            })
+        self.__feed = delta_feed(self.__db_pool, interval=self.__feed_interval, log=self.__log)
+        await self.__feed.start()
+        await self.__books.start()
 
         # set up routes
         self.__app.router.add_get("/", self.__handle_get_index)
@@ -66,7 +78,14 @@ class analytics:
         self.__app.router.add_get("/css", self.__handle_get_css)
         self.__app.router.add_get("/script", self.__handle_get_script)
         self.__app.router.add_get("/attributes", self.__handle_get_attributes)
+        self.__app.router.add_get("/attributes/stream", self.__handle_get_attributes_stream)
+        self.__app.router.add_get("/books/ws", self.__handle_books_ws)
+        self.__app.router.add_get("/bars", self.__handle_get_bars)
+        self.__app.router.add_get("/stats", self.__handle_get_stats)
         self.__app.router.add_post("/query", self.__handle_post_query)
+        self.__app.router.add_post("/refresh", self.__handle_post_refresh)
+        self.__app.router.add_get("/export", self.__handle_export)
+        self.__app.router.add_post("/export", self.__handle_export)
 
         self.__runner = web.AppRunner(self.__app)
         await self.__runner.setup()
@@ -79,16 +98,16 @@ class analytics:
 
     async def __clean_up(self):
         self.__log("analytics cleanup started", "DEBUG")
+        if self.__feed:
+            # ends the open event streams first, otherwise the runner waits on them
+            await self.__feed.stop()
+        await self.__books.stop()
         if self.__runner:
             await self.__runner.cleanup()
-        if self.__markets_db:
-            self.__markets_db.close()
-        if self.__attributes_db:
-            self.__attributes_db.close()
-        if self.__events_db:
-            self.__events_db.close()
-        if self.__rpc_db:
-            self.__rpc_db.close()
+        self.__cache.clear()
+        if self.__owns_pool and self.__db_pool is not None:
+            await resources.close_resource("pg_pool", self.__db_pool)
+            self.__db_pool = None
         self.__log("analytics cleanup finished", "INFO")
 
     def __log(self, msg, level="INFO"):
@@ -96,6 +115,40 @@ class analytics:
         if levels.index(level) >= levels.index(self.__verbosity):
             print(f"[{level}] {msg}")
 
+    @staticmethod
+    def __dumps(data) -> str:
+        # timestamps and numerics from asyncpg are not JSON types
+        return json.dumps(data, default=str)
+
+    def __json(self, data, status=200):
+        return web.json_response(data, status=status, dumps=self.__dumps)
+
+    @contextlib.asynccontextmanager
+    async def __read_conn(self, heavy=False):
+        """Pool connection for one request, heavy ones first wait for a free heavy slot."""
+        if heavy:
+            try:
+                await asyncio.wait_for(self.__heavy.acquire(), self.__heavy_wait)
+            except asyncio.TimeoutError:
+                raise web.HTTPServiceUnavailable(
+                    text=self.__dumps({"error": "too many heavy queries running, retry later"}),
+                    content_type="application/json",
+                )
+        try:
+            async with self.__db_pool.acquire(timeout=self.__query_timeout) as conn:
+                yield conn
+        finally:
+            if heavy:
+                self.__heavy.release()
+
+    @web.middleware
+    async def __timeouts(self, request, handler):
+        try:
+            return await handler(request)
+        except (asyncio.TimeoutError, asyncpg.exceptions.QueryCanceledError) as e:
+            self.__log(f"analytics request {request.path} timed out: {e!r}", "WARNING")
+            return self.__json({"error": "database timeout"}, status=504)
+
     # ---- HTTP handlers ----
 
     async def __handle_get_index(self, request):
@@ -108,52 +161,231 @@ class analytics:
         return web.FileResponse("./webpage/main.js")
 
     async def __handle_get_attributes(self, request):
-        offset = int(request.query.get("offset", 0))
-        cursor = self.__attributes_db.cursor()
-        cursor.execute("SELECT * FROM attributes WHERE row_index > ?", (offset,))
-        rows = cursor.fetchall()
+        try:
+            offset = int(request.query.get("offset", 0))
+            limit = min(int(request.query.get("limit", self.__max_limit)), self.__max_limit)
+        except ValueError as e:
+            return self.__json({"error": f"invalid offset or limit: {e}"}, status=400)
+
+        async with self.__read_conn() as conn:
+            rows = await conn.fetch(
+                "SELECT * FROM attributes WHERE row_index > $1 ORDER BY row_index LIMIT $2", offset, limit,
+                timeout=self.__query_timeout
+            )
+        return self.__json([dict(row) for row in rows])
+
+    async def __handle_get_attributes_stream(self, request):
+        """Server-sent events with new markets and attributes rows as they are inserted.
+
+        A reconnecting EventSource sends Last-Event-ID and is sent the rows it
+        missed first; ?offset= picks up after an attributes row_index like the
+        polling endpoint does.
+        """
+        last_marks = delta_feed.parse_last_id(request.headers.get("Last-Event-ID"))
+        if last_marks is None and "offset" in request.query:
+            try:
+                offset = int(request.query["offset"])
+            except ValueError as e:
+                return self.__json({"error": f"invalid offset: {e}"}, status=400)
+            # markets rows are not resent, the attributes rows carry their tokens
+            last_marks = {"markets": float("inf"), "attributes": offset}
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        try:
+            async for event in self.__feed.subscribe(last_marks):
+                await response.write(event)
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def __handle_books_ws(self, request):
+        """Websocket of live top of book updates for the tokens the client subscribes to.
+
+        The client sends {"subscribe": [token_id, ...]}, {"unsubscribe": [...]}
+        and {"max_rate": updates_per_second}. It gets {"type": "top", "data":
+        [...]} with the latest state of every token that changed since its
+        last update, never more often than its rate.
+        """
+        ws = web.WebSocketResponse(heartbeat=20)
+        await ws.prepare(request)
+        client = self.__books.client(max_rate=self.__book_rate)
+
+        async def send_updates():
+            async for tops in client.updates():
+                await ws.send_str(self.__dumps({"type": "top", "data": tops}))
+
+        sender = asyncio.create_task(send_updates())
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(msg.data)
+                    if "max_rate" in data:
+                        client.max_rate = min(max(float(data["max_rate"]), 0.1), self.__book_rate)
+                    self.__books.unsubscribe(client, [str(t) for t in data.get("unsubscribe", [])])
+                    refused = self.__books.subscribe(client, [str(t) for t in data.get("subscribe", [])])
+                except (TypeError, ValueError, AttributeError) as e:
+                    await ws.send_str(self.__dumps({"type": "error", "error": f"invalid message: {e}"}))
+                    continue
+                if refused:
+                    await ws.send_str(self.__dumps({"type": "refused", "tokens": refused}))
+        finally:
+            sender.cancel()
+            with contextlib.suppress(asyncio.CancelledError, ConnectionResetError):
+                await sender
+            self.__books.remove(client)
+        return ws
+
+    async def __handle_get_stats(self, request):
+        """Totals of markets, tokens, negrisks and events, plus per second rates over the last 1m, 5m and 1h."""
+        try:
+            stats = await self.__stats.read(self.__read_conn, self.__query_timeout)
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            self.__log(f"analytics failed to read counters: {e}", "ERROR")
+            return self.__json({"error": "counters unavailable"}, status=503)
+        return self.__json({"status": "ok", **stats})
 
-        # convert to list of dicts
-        col_names = [desc[0] for desc in cursor.description]
-        response = [dict(zip(col_names, row)) for row in rows]
-        return web.json_response(response)
+    async def __handle_get_bars(self, request):
+        """OHLCV bars of one token: ?token_id=&start=&end= (ms) and the number of points wanted.
+
+        The answer comes from the coarsest bar table with at least `points`
+        buckets in the range, one column per field. Without `end` the range
+        is open, so the cached answer stays valid until new events arrive.
+        """
+        try:
+            token_id = request.query["token_id"]
+            end = int(request.query.get("end", 0)) or None
+            start = int(request.query["start"])
+            points = int(request.query.get("points", 300))
+            if (end is not None and start > end) or points < 1:
+                raise ValueError("start must not be after end and points must be positive")
+        except (KeyError, ValueError) as e:
+            return self.__json({"error": f"invalid bars request: {e}"}, status=400)
+
+        table = pick_resolution(start, end or int(time.time() * 1000), points)
+        key = self.__dumps(["bars", table, token_id, start, end or "now"])
+        marks = await self.__cache.marks(self.__read_conn, [table], self.__query_timeout)
+        body = self.__cache.get(key, marks)
+        if body is None:
+            async with self.__read_conn() as conn:
+                rows = await conn.fetch(
+                    f"""SELECT bucket, open, high, low, close, volume, trade_count, update_count FROM {table}
+                    WHERE token_id = $1 AND bucket >= $2 AND ($3::BIGINT IS NULL OR bucket <= $3) ORDER BY bucket""",
+                    token_id, start - start % RESOLUTIONS[table], end, timeout=self.__query_timeout
+                )
+            columns = ("bucket", "open", "high", "low", "close", "volume", "trade_count", "update_count")
+            body = self.__dumps({
+                "status": "ok", "token_id": token_id, "resolution": table, "width_ms": RESOLUTIONS[table],
+                **{column: [row[column] for row in rows] for column in columns},
+            }).encode()
+            self.__cache.put(key, marks, body)
+        return web.Response(body=body, content_type="application/json")
 
     async def __handle_post_query(self, request):
+        """Body: {"filter": expr, "order": expr, "direction": "asc"|"desc", "limit": n, "after": cursor}.
+
+        Expressions are DSL text or an AST. A full page carries "next", post it
+        back as "after" for the following page.
+        """
         try:
             data = await request.json()
         except Exception as e:
-            return web.json_response({"error": f"invalid JSON: {e}"}, status=400)
+            return self.__json({"error": f"invalid JSON: {e}"}, status=400)
 
         self.__log(f"analytics query: {json.dumps(data)}", "DEBUG")
+        return await self.__run_query(
+            data.get("filter"), data.get("order"), data.get("direction", "desc"), data.get("limit"), data.get("after")
+        )
 
-        # TODO: actually run query against DB
-        query = data.get("query", None)
-        if query:
-            self.__handle_query(query)
-        stats = data.get("stats", None)
-        if stats:
-            self.__handle_stats(stats)
-        
-        # send back /data/response.csv
-        return web.json_response({"status": "ok", "data": []})
-
-        def __handle_query(query):
-            tokens = []
-            filter = query.get("filter", None)
-            if filter:
-                sql_markets_filter  = filter.get("markets", None)
-
-                tokens = sql_b_events_filter = filter.get("book", None)
-                sql_pc_events_filter = filter.get("price_change", None)
-                sql_ltp_events_filter = filter.get("last_trade_price", None)
-                sql_tsc_events_filter = filter.get("tick_size_change", None)
-                book_filter = fitler.get("book", None)
-
-            order = query.get("order", None)
-            if ordered:
-                order_by_date = order.get("order_by_date", None)
-                order_by_numbers = order.get("order_by_")
-
-
-                
-            
+    async def __handle_post_refresh(self, request):
+        """Body as sent by main.js refresh(): the applied filter and order as displayed, "None" when unset."""
+        try:
+            data = await request.json()
+        except Exception as e:
+            return self.__json({"error": f"invalid JSON: {e}"}, status=400)
+
+        order = (data.get("curr_order") or "None").strip()
+        direction = "desc"
+        for suffix, value in ((" (Asc)", "asc"), (" (Desc)", "desc")):
+            if order.endswith(suffix):
+                order, direction = order[:-len(suffix)], value
+        return await self.__run_query(data.get("curr_filter"), order, direction, data.get("limit"))
+
+    async def __run_query(self, filter, order, direction, limit, after=None):
+        try:
+            limit = self.__default_limit if limit is None else int(limit)
+            if not 0 < limit <= self.__max_limit:
+                raise query_error(f"limit must be between 1 and {self.__max_limit}")
+            query = compile_query(filter, order, str(direction).lower(), limit, after)
+        except (query_error, TypeError, ValueError) as e:
+            return self.__json({"error": str(e)}, status=400)
+
+        key = query.key()
+        marks = await self.__cache.marks(self.__read_conn, query.tables, self.__query_timeout)
+        body = self.__cache.get(key, marks)
+        if body is not None:
+            return web.Response(body=body, content_type="application/json")
+
+        async with self.__read_conn(heavy=True) as conn:
+            # the planner estimate is cheap and keeps one query from scanning everything
+            cost = await estimate_cost(conn, query, timeout=self.__query_timeout)
+            if cost > self.__max_cost:
+                self.__log(f"analytics query rejected, cost {cost:.0f}: {query.sql}", "WARNING")
+                return self.__json({"error": "query too expensive", "cost": cost}, status=422)
+            rows = await conn.fetch(query.sql, *query.params, timeout=self.__query_timeout)
+
+        body = self.__dumps({
+            "status": "ok", "cost": cost, "fields": query.fields, "data": [dict(row) for row in rows],
+            "next": query.cursor(rows[-1]) if len(rows) == limit else None,
+        }).encode()
+        self.__cache.put(key, marks, body)
+        return web.Response(body=body, content_type="application/json")
+
+    async def __handle_export(self, request):
+        """Stream a whole result as NDJSON or CSV.
+
+        Parameters come from the query string, plus the JSON body for POST:
+        "table" (changes, books or tick_changes) with optional "token_id",
+        "start" and "end" server times exports raw events; otherwise "filter",
+        "order" and "direction" export a DSL query without a limit.
+        """
+        params = dict(request.query)
+        if request.method == "POST" and request.can_read_body:
+            try:
+                params.update(await request.json())
+            except Exception as e:
+                return self.__json({"error": f"invalid JSON: {e}"}, status=400)
+
+        try:
+            writer = row_writer(params.get("format", "ndjson"))
+            if params.get("table"):
+                sql, args = events_sql(params["table"], params.get("token_id"), params.get("start"), params.get("end"))
+                name = params["table"]
+            else:
+                query = compile_query(params.get("filter"), params.get("order"),
+                                      str(params.get("direction", "desc")).lower(), None)
+                sql, args, name = query.sql, query.params, "query"
+        except (query_error, TypeError, ValueError) as e:
+            return self.__json({"error": str(e)}, status=400)
+
+        response = web.StreamResponse(headers={
+            "Content-Type": writer.content_type,
+            "Content-Disposition": f'attachment; filename="{name}.{writer.format}"',
+        })
+        # an export holds a heavy slot until its last row is written
+        async with self.__read_conn(heavy=True) as conn:
+            await response.prepare(request)
+            try:
+                count = await stream_rows(response, conn, sql, args, writer, self.__export_chunk_size,
+                                          self.__query_timeout)
+            except Exception as e:
+                # headers are already sent, all that is left is cutting the stream short
+                self.__log(f"analytics export of {name} failed: {e}", "ERROR")
+                return response
+        await response.write_eof()
+        self.__log(f"analytics exported {count} rows of {name}", "DEBUG")
+        return response
@@ -4,7 +4,7 @@
 
 // ------------------- Globals -------------------
 const numbers = ["MARKET_umaBond", "MARKET_umaReward", "MARKET_orderPriceMinTickSize", "MARKET_orderMinSize", 
-	"MARKET_customLiveness", "MARKTE_competitive", "MARKET_rewardsMinSize", "MARKET_rewardsMaxSpread", "MARKET_spread", 
+	"MARKET_customLiveness", "MARKET_competitive", "MARKET_rewardsMinSize", "MARKET_rewardsMaxSpread", "MARKET_spread", 
 	"MARKET_bestBid", "MARKET_bestAsk", "EVENTS_books_count", "EVENTS_price_change_count", "EVENTS_last_trade_price_count", 
 	"EVENTS_tick_size_change_count", "BOOK_asymmetry", "BOOK_depth", "BOOK_discrepency", "BOOK_spread"];     // numeric fields identifiers
 const times = ["MARKET_startDate", "MARKET_endDate", "MARKET_createdAt", "MARKET_updatedAt",
@@ -15,7 +15,7 @@ const predicates = ["MARKET_negRisk", "MARKET_enableOrderBook", "MARKET_acceptin
 
 // ------------------- Tokenizer -------------------
 function tokenize(input) {
-    const regex = /\s*([()!&|+\-\*]|>=|<=|!=|=|>|<|\d+(?:\.\d+)?|"(?:\\"|[^"])*"|\w+)\s*/g;
+    const regex = /\s*(>=|<=|!=|[()!&|+\-\*]|=|>|<|\d+(?:\.\d+)?|"(?:\\"|[^"])*"|\w+)\s*/g;
     let tokens = [];
     let match;
     while ((match = regex.exec(input)) !== null) {